@@ -1,12 +1,27 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import json
 import base64
+import bisect
+import collections
+import copy
 import uuid
 from datetime import datetime, timezone, timedelta
 import os
+import random
+import sqlite3
+import time
+import threading
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import Request
+
+try:
+    # 選用：安裝 pypinyin 後，材料搜尋可以用拼音或注音找到中文名稱
+    from pypinyin import lazy_pinyin, Style
+except ImportError:
+    lazy_pinyin = None
 
 # 設定台灣時區
 TAIWAN_TZ = timezone(timedelta(hours=8))
@@ -17,27 +32,202 @@ SCOPES = [
     'https://www.googleapis.com/auth/drive'
 ]
 
+def get_setting(key, default):
+    """從 Streamlit secrets 讀取設定值，未設定時使用預設值"""
+    try:
+        return st.secrets.get(key, default)
+    except Exception:
+        return default
+
+# Google Sheets 連線快取設定（可在 secrets 中覆寫）
+SHEETS_CLIENT_TTL = int(get_setting("sheets_client_ttl", 3600))  # 共用連線存活秒數
+SHEETS_HEALTH_CHECK_INTERVAL = int(get_setting("sheets_health_check_interval", 300))  # 健康檢查間隔秒數
+
+
+# Google Sheets 配額設定（可在 secrets 中覆寫）
+# 每分鐘可送出的請求數（至少 1，0 或負數會讓 token bucket 永遠無法補充）
+SHEETS_QUOTA_PER_MINUTE = max(1, int(get_setting("sheets_quota_per_minute", 60)))
+SHEETS_MAX_RETRIES = int(get_setting("sheets_max_retries", 5))  # 遇到配額或暫時性錯誤時的最大重試次數
+
+
+class SheetsRequestScheduler:
+    """所有 Google Sheets / Drive 請求的排程器：token bucket 限速、隨機退避重試與每分鐘計數"""
+
+    RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+    def __init__(self, quota_per_minute, max_retries):
+        self.capacity = quota_per_minute
+        self.tokens = float(quota_per_minute)
+        self.refill_rate = quota_per_minute / 60
+        self.max_retries = max_retries
+        self.refilled_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.calls = collections.deque()
+        self.throttled = collections.deque()
+
+    def acquire(self):
+        """取得一個請求配額，配額用完時等待補充"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.refill_rate)
+                self.refilled_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.calls.append(now)
+                    return
+                wait = (1 - self.tokens) / self.refill_rate
+            time.sleep(wait)
+
+    def should_retry(self, response):
+        if response.status_code in self.RETRY_STATUS_CODES:
+            return True
+        # Drive API 超過配額時回傳 403
+        return response.status_code == 403 and ('usageLimits' in response.text or 'rateLimitExceeded' in response.text)
+
+    def backoff_delay(self, attempt, response):
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return float(retry_after)
+        # 指數退避加上隨機抖動，避免多個 session 同時重試
+        base = min(64, 2 ** attempt)
+        return base / 2 + random.uniform(0, base / 2)
+
+    def execute(self, send):
+        """取得配額後送出請求，遇到配額或暫時性錯誤時退避重試"""
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            response = send()
+            if response.ok or attempt == self.max_retries or not self.should_retry(response):
+                return response
+            with self.lock:
+                self.throttled.append(time.monotonic())
+            time.sleep(self.backoff_delay(attempt, response))
+
+    def stats(self):
+        """最近一分鐘的請求數與被限流次數"""
+        with self.lock:
+            cutoff = time.monotonic() - 60
+            for events in (self.calls, self.throttled):
+                while events and events[0] < cutoff:
+                    events.popleft()
+            return {'calls': len(self.calls), 'throttled': len(self.throttled), 'quota': self.capacity}
+
+
+@st.cache_resource(show_spinner=False)
+def get_request_scheduler():
+    """取得全程序共用的請求排程器"""
+    return SheetsRequestScheduler(SHEETS_QUOTA_PER_MINUTE, SHEETS_MAX_RETRIES)
+
+
+class QuotaAwareHTTPClient(gspread.HTTPClient):
+    """讓 gspread 的每個請求都經過 SheetsRequestScheduler"""
+
+    def request(self, method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+        response = get_request_scheduler().execute(lambda: self.session.request(
+            method=method,
+            url=endpoint,
+            json=json,
+            params=params,
+            data=data,
+            files=files,
+            headers=headers,
+            timeout=self.timeout,
+        ))
+        if response.ok:
+            return response
+        raise gspread.exceptions.APIError(response)
+
+
+class SheetsConnection:
+    """跨 session 共用的 Google Sheets 連線（client、spreadsheet 與工作表快取）"""
+
+    def __init__(self, credentials, client, spreadsheet):
+        self.credentials = credentials
+        self.client = client
+        self.spreadsheet = spreadsheet
+        self.worksheets = {}
+        self.last_health_check = time.monotonic()
+        self.lock = threading.RLock()
+
+    def ensure_token(self):
+        """token 過期時主動更新，避免多個 session 同時各自 refresh"""
+        with self.lock:
+            if not self.credentials.valid:
+                self.credentials.refresh(Request())
+
+    def check_health(self):
+        """超過檢查間隔時以輕量的 metadata 請求確認連線仍可用"""
+        if time.monotonic() - self.last_health_check < SHEETS_HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            self.ensure_token()
+            self.spreadsheet.fetch_sheet_metadata(params={"fields": "spreadsheetId"})
+            self.last_health_check = time.monotonic()
+            return True
+        except Exception:
+            return False
+
+    def worksheet(self, title, rows, cols, headers):
+        """取得工作表（不存在時建立並寫入標題），結果會快取"""
+        with self.lock:
+            if title not in self.worksheets:
+                try:
+                    worksheet = self.spreadsheet.worksheet(title)
+                except gspread.WorksheetNotFound:
+                    # 如果不存在，創建新的
+                    worksheet = self.spreadsheet.add_worksheet(title=title, rows=rows, cols=cols)
+                    # 寫入標題
+                    worksheet.append_row(headers)
+                self.worksheets[title] = worksheet
+            return self.worksheets[title]
+
+
+@st.cache_resource(ttl=SHEETS_CLIENT_TTL, show_spinner=False)
+def get_sheets_connection():
+    """建立共用的 Google Sheets 連線（所有 session 與 rerun 共用，TTL 到期後重建）"""
+    # 從 Streamlit secrets 讀取服務帳號資訊
+    service_account_info = {
+        "type": st.secrets["type"],
+        "project_id": st.secrets["project_id"],
+        "private_key_id": st.secrets["private_key_id"],
+        "private_key": st.secrets["private_key"],
+        "client_email": st.secrets["client_email"],
+        "client_id": st.secrets["client_id"],
+        "auth_uri": st.secrets["auth_uri"],
+        "token_uri": st.secrets["token_uri"],
+        "auth_provider_x509_cert_url": st.secrets["auth_provider_x509_cert_url"],
+        "client_x509_cert_url": st.secrets["client_x509_cert_url"]
+    }
+    credentials = Credentials.from_service_account_info(
+        service_account_info, scopes=SCOPES
+    )
+    client = gspread.authorize(credentials, http_client=QuotaAwareHTTPClient)
+
+    # 從 secrets 取得 spreadsheet URL
+    spreadsheet_url = st.secrets["spreadsheet"]
+    # 從 URL 中提取 spreadsheet ID
+    spreadsheet_id = spreadsheet_url.split('/d/')[1].split('/')[0]
+
+    # 開啟 spreadsheet
+    spreadsheet = client.open_by_key(spreadsheet_id)
+    return SheetsConnection(credentials, client, spreadsheet)
+
+
+def get_active_connection():
+    """取得健康的共用連線，健康檢查失敗時重建一次"""
+    connection = get_sheets_connection()
+    if not connection.check_health():
+        get_sheets_connection.clear()
+        connection = get_sheets_connection()
+    connection.ensure_token()
+    return connection
+
+
 def get_google_sheets_client():
     """取得 Google Sheets 客戶端"""
     try:
-        # 從 Streamlit secrets 讀取服務帳號資訊
-        service_account_info = {
-            "type": st.secrets["type"],
-            "project_id": st.secrets["project_id"],
-            "private_key_id": st.secrets["private_key_id"],
-            "private_key": st.secrets["private_key"],
-            "client_email": st.secrets["client_email"],
-            "client_id": st.secrets["client_id"],
-            "auth_uri": st.secrets["auth_uri"],
-            "token_uri": st.secrets["token_uri"],
-            "auth_provider_x509_cert_url": st.secrets["auth_provider_x509_cert_url"],
-            "client_x509_cert_url": st.secrets["client_x509_cert_url"]
-        }
-        credentials = Credentials.from_service_account_info(
-            service_account_info, scopes=SCOPES
-        )
-        client = gspread.authorize(credentials)
-        return client
+        return get_active_connection().client
     except Exception as e:
         st.error(f"無法連接到 Google Sheets: {e}")
         return None
@@ -45,22 +235,687 @@ def get_google_sheets_client():
 def get_google_sheet():
     """取得指定的 Google Sheet"""
     try:
-        client = get_google_sheets_client()
-        if not client:
-            return None
-        
-        # 從 secrets 取得 spreadsheet URL
-        spreadsheet_url = st.secrets["spreadsheet"]
-        # 從 URL 中提取 spreadsheet ID
-        spreadsheet_id = spreadsheet_url.split('/d/')[1].split('/')[0]
-        
-        # 開啟 spreadsheet
-        sheet = client.open_by_key(spreadsheet_id)
-        return sheet
+        return get_active_connection().spreadsheet
     except Exception as e:
         st.error(f"無法取得 Google Sheet: {e}")
         return None
 
+
+class SheetsWritePlan:
+    """一次同步要送出的寫入，多個資料集的計畫會合併成最少的 API 請求"""
+
+    def __init__(self):
+        self.value_updates = []  # 合併成單一 values batchUpdate
+        self.appends = []  # (工作表, 資料列)
+        self.structural_requests = []  # 合併成單一 spreadsheet batchUpdate（刪除列）
+        self.clear_ranges = []  # 合併成單一 values batchClear
+
+    def update_rows(self, worksheet, start_row, rows):
+        self.value_updates.append({'range': f"'{worksheet.title}'!A{start_row}", 'values': rows})
+
+    def overwrite(self, worksheet, rows):
+        """覆寫整個工作表：先寫入新資料再清除多餘的舊列，避免工作表出現空白的時間窗"""
+        self.update_rows(worksheet, 1, rows)
+        last_column = gspread.utils.rowcol_to_a1(1, max(len(row) for row in rows)).rstrip('0123456789')
+        self.clear_ranges.append(f"'{worksheet.title}'!A{len(rows) + 1}:{last_column}")
+
+    def append_rows(self, worksheet, rows):
+        self.appends.append((worksheet, rows))
+
+    def delete_rows(self, worksheet, row_numbers):
+        """刪除指定列（由下往上，連續的列合併成一個範圍）"""
+        ranges = []
+        for row_number in sorted(row_numbers, reverse=True):
+            if ranges and ranges[-1][0] == row_number + 1:
+                ranges[-1][0] = row_number
+            else:
+                ranges.append([row_number, row_number])
+        for start, end in ranges:
+            self.structural_requests.append({
+                'deleteDimension': {
+                    'range': {
+                        'sheetId': worksheet.id,
+                        'dimension': 'ROWS',
+                        'startIndex': start - 1,
+                        'endIndex': end
+                    }
+                }
+            })
+
+
+def execute_write_plans(plans):
+    """把多個寫入計畫合併後送出：值更新、附加、刪除列、清除舊列"""
+    spreadsheet = get_active_connection().spreadsheet
+    value_updates = [update for plan in plans for update in plan.value_updates]
+    structural_requests = [request for plan in plans for request in plan.structural_requests]
+    clear_ranges = [clear_range for plan in plans for clear_range in plan.clear_ranges]
+
+    if value_updates:
+        spreadsheet.values_batch_update({'valueInputOption': 'RAW', 'data': value_updates})
+    for plan in plans:
+        for worksheet, rows in plan.appends:
+            worksheet.append_rows(rows)
+    # 刪除列在更新之後執行，列號才不會錯位
+    if structural_requests:
+        spreadsheet.batch_update({'requests': structural_requests})
+    if clear_ranges:
+        spreadsheet.values_batch_clear(body={'ranges': clear_ranges})
+
+
+def row_changes(full=None, upserts=None, deletes=()):
+    """逐列同步的變更內容：full 為整批重寫（key -> 列），否則只包含新增/更新與刪除的列"""
+    return {'full': full, 'upserts': dict(upserts or {}), 'deletes': set(deletes)}
+
+
+def merge_row_changes(pending, new):
+    """合併同一時間窗內的逐列變更（較新的變更覆蓋較舊的）"""
+    if new['full'] is not None:
+        return new
+    merged = row_changes(
+        dict(pending['full']) if pending['full'] is not None else None,
+        pending['upserts'],
+        pending['deletes']
+    )
+    for key, row in new['upserts'].items():
+        merged['upserts'][key] = row
+        merged['deletes'].discard(key)
+    for key in new['deletes']:
+        merged['upserts'].pop(key, None)
+        merged['deletes'].add(key)
+    if merged['full'] is not None:
+        # 尚未寫出的整批重寫：直接把增量套用到整批資料上
+        for key in merged['deletes']:
+            merged['full'].pop(key, None)
+        merged['full'].update(merged['upserts'])
+        merged['upserts'] = {}
+        merged['deletes'] = set()
+    return merged
+
+
+def read_row_keys(worksheet, key_columns=1):
+    """讀取工作表最左邊的 key 欄位（包含標題列），用來定位列號"""
+    last_column = gspread.utils.rowcol_to_a1(1, key_columns).rstrip('0123456789')
+    rows = worksheet.get(f"A1:{last_column}")
+    return [list(row) + [''] * (key_columns - len(row)) for row in rows]
+
+
+def plan_row_sync(plan, worksheet, upsert_rows, delete_keys, key_columns=1, key_rows=None):
+    """依 key 欄位逐列同步：新資料 append、既有資料只更新該列、刪除只移除該列"""
+    # 只讀取 key 欄位來定位列號（第 1 列為標題）
+    if key_rows is None:
+        key_rows = read_row_keys(worksheet, key_columns)
+    row_numbers = {}
+    for index, key_row in enumerate(key_rows[1:], start=2):
+        key = str(key_row[0]) if key_columns == 1 else tuple(str(value) for value in key_row[:key_columns])
+        if key_row[0] != '':
+            row_numbers[key] = index
+
+    def normalize(key):
+        return str(key) if key_columns == 1 else tuple(str(value) for value in key)
+
+    appends = []
+    for key, row in upsert_rows.items():
+        row_number = row_numbers.get(normalize(key))
+        if row_number:
+            plan.update_rows(worksheet, row_number, [row])
+        else:
+            appends.append(row)
+    if appends:
+        plan.append_rows(worksheet, appends)
+
+    delete_rows = [row_numbers[normalize(key)] for key in delete_keys if normalize(key) in row_numbers]
+    if delete_rows:
+        plan.delete_rows(worksheet, delete_rows)
+
+
+def plan_row_changes(worksheet, headers, changes, key_columns=1, key_rows=None):
+    """依變更內容產生寫入計畫：整批重寫或逐列同步"""
+    plan = SheetsWritePlan()
+    if changes['full'] is not None:
+        plan.overwrite(worksheet, [headers] + list(changes['full'].values()))
+    else:
+        plan_row_sync(plan, worksheet, changes['upserts'], changes['deletes'], key_columns, key_rows)
+    return plan
+
+
+# 背景寫入設定（可在 secrets 中覆寫）
+SAVE_COALESCE_SECONDS = float(get_setting("save_coalesce_seconds", 1.5))  # 合併同一資料集儲存的時間窗
+SYNC_RETRY_SECONDS = float(get_setting("sync_retry_seconds", 30))  # 同步失敗後重試的間隔秒數
+
+
+class WriteBehindQueue:
+    """背景寫入佇列：合併短時間內對同一資料集的多次儲存，由背景執行緒複寫到 Google Sheets
+
+    本地 SQLite 是資料的主要來源，Google Sheets 只是非同步的副本；
+    寫入失敗時工作會保留在佇列中稍後重試。尚未同步的資料集同時記錄在本地資料庫，
+    程序重新啟動後以本地資料整批補寫，不會遺失變更。
+    """
+
+    DATASET_LABELS = {
+        "materials": "材料",
+        "material_yields": "預設熟成率",
+        "material_units": "採購單位",
+        "price_history": "價格歷史",
+        "recipes": "食譜",
+        "accounting": "記帳",
+        "categories": "類別設定"
+    }
+
+    def __init__(self, delay, store, before_sync=None, after_sync=None):
+        self.delay = delay
+        self.store = store
+        self.before_sync = before_sync
+        self.after_sync = after_sync
+        self.pending = {}
+        self.in_flight = set()
+        self.last_synced_at = None
+        self.last_error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="sheets-write-behind", daemon=True)
+        self.thread.start()
+
+    def submit(self, dataset, writer, payload, merge=None):
+        """排入一次儲存；時間窗內同一資料集的儲存會合併成一次寫入"""
+        # 先在本地資料庫標記為尚未同步，寫入成功後才清除
+        token = self.store.mark_dirty(dataset)
+        now = time.monotonic()
+        with self.condition:
+            job = self.pending.get(dataset)
+            if job and merge:
+                payload = merge(job['payload'], payload)
+            first_submitted = job['first_submitted'] if job else now
+            self.pending[dataset] = {
+                'writer': writer,
+                'payload': payload,
+                'merge': merge,
+                'token': token,
+                'first_submitted': first_submitted,
+                # 持續有新儲存時延後寫入，但最多延遲 5 個時間窗
+                'due': min(now + self.delay, first_submitted + self.delay * 5)
+            }
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if any(job['due'] <= now for job in self.pending.values()):
+                        break
+                    timeout = min((job['due'] for job in self.pending.values()), default=None)
+                    self.condition.wait(None if timeout is None else timeout - now)
+                # 有工作到期時，佇列中其他資料集也一併寫出，合併成同一批請求
+                jobs = list(self.pending.items())
+                self.pending.clear()
+                self.in_flight.update(dataset for dataset, _ in jobs)
+            self._flush(jobs)
+
+    def _flush(self, jobs):
+        plans = []
+        planned_jobs = []
+        failed_jobs = []
+        for dataset, job in jobs:
+            try:
+                plans.append(job['writer'](job['payload']))
+                planned_jobs.append((dataset, job))
+            except Exception as e:
+                failed_jobs.append((dataset, job, e))
+        before = None
+        try:
+            if plans:
+                # 寫入前的狀態（例如 Google Sheets 的版本），寫入完成後交給 after_sync 比對
+                before = self.before_sync() if self.before_sync else None
+                execute_write_plans(plans)
+                self.last_synced_at = get_taiwan_time()
+                self.last_error = None
+                for dataset, job in planned_jobs:
+                    self.store.clear_dirty(dataset, job['token'])
+        except Exception as e:
+            failed_jobs.extend((dataset, job, e) for dataset, job in planned_jobs)
+        for dataset, job, error in failed_jobs:
+            self._retry_later(dataset, job, error)
+        with self.condition:
+            self.in_flight.difference_update(dataset for dataset, _ in jobs)
+        if plans and len(failed_jobs) < len(jobs) and self.after_sync:
+            try:
+                self.after_sync(before)
+            except Exception:
+                pass
+
+    def _retry_later(self, dataset, job, error):
+        """如果 Google Sheets 失敗，保留工作稍後重試（期間若有新的儲存則與之合併）"""
+        self.last_error = f"{self.DATASET_LABELS.get(dataset, dataset)}：{error}"
+        with self.condition:
+            newer = self.pending.get(dataset)
+            if newer:
+                # 較新的工作保留自己的標記（本地資料庫中記錄的是最新一次儲存）
+                if job['merge']:
+                    newer['payload'] = job['merge'](job['payload'], newer['payload'])
+            else:
+                job['first_submitted'] = time.monotonic()
+                job['due'] = job['first_submitted'] + SYNC_RETRY_SECONDS
+                self.pending[dataset] = job
+                self.condition.notify()
+
+    def status(self):
+        """回傳目前的同步狀態，供側邊欄顯示"""
+        with self.condition:
+            waiting = sorted(set(self.pending) | self.in_flight)
+        return {
+            'waiting': [self.DATASET_LABELS.get(dataset, dataset) for dataset in waiting],
+            'last_synced_at': self.last_synced_at,
+            'last_error': self.last_error
+        }
+
+
+@st.cache_resource(show_spinner=False)
+def get_write_behind_queue():
+    """取得全程序共用的背景寫入佇列，並補寫上次程序結束前尚未同步的資料集"""
+    store = get_local_store()
+    queue = WriteBehindQueue(
+        SAVE_COALESCE_SECONDS,
+        store,
+        before_sync=read_sheets_revision,
+        after_sync=record_sheets_revision
+    )
+    for dataset in store.dirty_datasets():
+        writer, payload, merge = DATASETS[dataset]['resync'](store)
+        queue.submit(dataset, writer, payload, merge)
+    return queue
+
+
+# 本地資料庫設定（可在 secrets 中覆寫）
+DATABASE_PATH = get_setting("database_path", "meatbobo.db")
+
+
+class LocalStore:
+    """本地 SQLite 資料庫：所有讀寫的主要來源，Google Sheets 由背景佇列非同步複寫"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS materials (
+            name TEXT PRIMARY KEY,
+            price REAL NOT NULL,
+            position INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_materials_position ON materials (position);
+        CREATE TABLE IF NOT EXISTS material_yields (
+            name TEXT PRIMARY KEY,
+            yield_rate REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS material_units (
+            name TEXT PRIMARY KEY,
+            unit TEXT NOT NULL,
+            pack_size REAL,
+            pack_unit TEXT,
+            density REAL
+        );
+        CREATE TABLE IF NOT EXISTS price_history (
+            name TEXT NOT NULL,
+            recorded_at TEXT NOT NULL,
+            price REAL NOT NULL,
+            PRIMARY KEY (name, recorded_at)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS recipes (
+            name TEXT PRIMARY KEY,
+            total_cost REAL NOT NULL,
+            position INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_recipes_position ON recipes (position);
+        CREATE TABLE IF NOT EXISTS accounting (
+            id TEXT PRIMARY KEY,
+            date TEXT,
+            type TEXT,
+            category TEXT,
+            buyer TEXT,
+            amount REAL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_accounting_date ON accounting (date);
+        CREATE INDEX IF NOT EXISTS idx_accounting_type_date ON accounting (type, date);
+        CREATE INDEX IF NOT EXISTS idx_accounting_buyer ON accounting (buyer);
+        CREATE TABLE IF NOT EXISTS categories (
+            name TEXT PRIMARY KEY,
+            position INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+
+    # 材料
+    def load_materials(self):
+        with self.lock:
+            rows = self.db.execute("SELECT name, price FROM materials ORDER BY position").fetchall()
+        return {name: price for name, price in rows}
+
+    def replace_materials(self, materials):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM materials")
+            self.db.executemany(
+                "INSERT INTO materials (name, price, position) VALUES (?, ?, ?)",
+                [(name, price, position) for position, (name, price) in enumerate(materials.items())]
+            )
+
+    # 材料預設熟成率
+    def load_material_yields(self):
+        with self.lock:
+            rows = self.db.execute("SELECT name, yield_rate FROM material_yields ORDER BY rowid").fetchall()
+        return {name: yield_rate for name, yield_rate in rows}
+
+    def replace_material_yields(self, material_yields):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM material_yields")
+            self.db.executemany(
+                "INSERT INTO material_yields (name, yield_rate) VALUES (?, ?)",
+                list(material_yields.items())
+            )
+
+    # 材料採購單位
+    def load_material_units(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, unit, pack_size, pack_unit, density FROM material_units ORDER BY rowid"
+            ).fetchall()
+        return {
+            name: {"unit": unit, "pack_size": pack_size, "pack_unit": pack_unit, "density": density}
+            for name, unit, pack_size, pack_unit, density in rows
+        }
+
+    def replace_material_units(self, material_units):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM material_units")
+            self.db.executemany(
+                "INSERT INTO material_units (name, unit, pack_size, pack_unit, density) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (name, spec['unit'], spec.get('pack_size'), spec.get('pack_unit'), spec.get('density'))
+                    for name, spec in material_units.items()
+                ]
+            )
+
+    # 材料價格歷史（只會新增，依材料與時間排序）
+    def load_price_history(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, recorded_at, price FROM price_history ORDER BY name, recorded_at"
+            ).fetchall()
+        history = {}
+        for name, recorded_at, price in rows:
+            times, prices = history.setdefault(name, ([], []))
+            times.append(recorded_at)
+            prices.append(price)
+        return history
+
+    def load_price_updated_at(self):
+        """每個材料最後一次改價的時間"""
+        with self.lock:
+            rows = self.db.execute("SELECT name, MAX(recorded_at) FROM price_history GROUP BY name").fetchall()
+        return dict(rows)
+
+    def append_price_history(self, entries):
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO price_history (name, recorded_at, price) VALUES (?, ?, ?)",
+                entries
+            )
+
+    def rename_price_history(self, name, new_name):
+        """把材料的價格歷史移到新名稱（同一時間新名稱已有記錄時保留新名稱的記錄）"""
+        with self.lock, self.db:
+            self.db.execute("UPDATE OR IGNORE price_history SET name = ? WHERE name = ?", (new_name, name))
+            self.db.execute("DELETE FROM price_history WHERE name = ?", (name,))
+
+    def replace_price_history(self, history):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM price_history")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO price_history (name, recorded_at, price) VALUES (?, ?, ?)",
+                [
+                    (name, recorded_at, price)
+                    for name, (times, prices) in history.items()
+                    for recorded_at, price in zip(times, prices)
+                ]
+            )
+
+    # 食譜
+    def load_recipes(self):
+        with self.lock:
+            rows = self.db.execute("SELECT name, data FROM recipes ORDER BY position").fetchall()
+        return {name: json.loads(data) for name, data in rows}
+
+    def replace_recipes(self, recipes):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM recipes")
+            self.db.executemany(
+                "INSERT INTO recipes (name, total_cost, position, data) VALUES (?, ?, ?, ?)",
+                [
+                    (name, recipe.get('total_cost', 0), position, json.dumps(recipe, ensure_ascii=False))
+                    for position, (name, recipe) in enumerate(recipes.items())
+                ]
+            )
+
+    def load_recipes_by_name(self, names):
+        names = list(names)
+        if not names:
+            return {}
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT name, data FROM recipes WHERE name IN ({','.join('?' * len(names))}) ORDER BY position",
+                names
+            ).fetchall()
+        return {name: json.loads(data) for name, data in rows}
+
+    def apply_recipe_changes(self, upserts, deletes):
+        """只寫入變動的食譜（upserts 為名稱 -> 食譜，既有食譜保留原本的位置）"""
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM recipes WHERE name = ?", [(name,) for name in deletes])
+            (position,) = self.db.execute("SELECT COALESCE(MAX(position), -1) FROM recipes").fetchone()
+            rows = []
+            for name, recipe in upserts.items():
+                position += 1
+                rows.append((name, recipe.get('total_cost', 0), position, json.dumps(recipe, ensure_ascii=False)))
+            self.db.executemany(
+                "INSERT INTO recipes (name, total_cost, position, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET total_cost = excluded.total_cost, data = excluded.data",
+                rows
+            )
+
+    # 記帳
+    @staticmethod
+    def _accounting_row(record):
+        return (
+            record.get('id', ''),
+            record.get('date', ''),
+            record.get('type', ''),
+            record.get('category', ''),
+            record.get('buyer', ''),
+            record.get('amount', 0),
+            json.dumps(record, ensure_ascii=False)
+        )
+
+    def load_accounting(self):
+        with self.lock:
+            rows = self.db.execute("SELECT data FROM accounting ORDER BY rowid").fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def replace_accounting(self, records):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM accounting")
+            self.db.executemany(
+                "INSERT INTO accounting (id, date, type, category, buyer, amount, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [self._accounting_row(record) for record in records]
+            )
+
+    def apply_accounting_changes(self, upserts, deletes):
+        """只寫入變動的記帳記錄（新增或更新 upserts，刪除 deletes）"""
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO accounting (id, date, type, category, buyer, amount, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET date = excluded.date, type = excluded.type, "
+                "category = excluded.category, buyer = excluded.buyer, "
+                "amount = excluded.amount, data = excluded.data",
+                [self._accounting_row(record) for record in upserts]
+            )
+            self.db.executemany("DELETE FROM accounting WHERE id = ?", [(record_id,) for record_id in deletes])
+
+    # 類別
+    def load_categories(self):
+        with self.lock:
+            rows = self.db.execute("SELECT name FROM categories ORDER BY position").fetchall()
+        return [name for (name,) in rows]
+
+    def replace_categories(self, categories):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM categories")
+            self.db.executemany(
+                "INSERT OR IGNORE INTO categories (name, position) VALUES (?, ?)",
+                [(name, position) for position, name in enumerate(categories)]
+            )
+
+    def replace_all(self, all_data):
+        """以下載的資料覆蓋本地資料庫（只覆蓋 all_data 中有的資料集）"""
+        with self.lock:
+            for dataset, data in all_data.items():
+                getattr(self, f'replace_{dataset}')(data)
+            self.set_meta('initialized', '1')
+            for dataset in all_data:
+                self.set_meta(f'stale:{dataset}', None)
+
+    def mark_dirty(self, dataset):
+        """標記資料集有尚未同步到 Google Sheets 的變更，回傳這次標記的 token"""
+        token = uuid.uuid4().hex
+        self.set_meta(f'dirty:{dataset}', token)
+        return token
+
+    def clear_dirty(self, dataset, token):
+        """同步成功後清除標記；同步期間又有新的儲存（token 不同）時保留"""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM meta WHERE key = ? AND value = ?", (f'dirty:{dataset}', token))
+
+    def is_dirty(self, dataset):
+        return bool(self.get_meta(f'dirty:{dataset}'))
+
+    def dirty_datasets(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key FROM meta WHERE key LIKE 'dirty:%' AND value IS NOT NULL ORDER BY key"
+            ).fetchall()
+        return [key[len('dirty:'):] for (key,) in rows]
+
+    def mark_stale(self, datasets, reason):
+        """標記需要從 Google Sheets 重新下載的資料集（實際下載延後到第一次用到時）"""
+        with self.lock:
+            for dataset in datasets:
+                self.set_meta(f'stale:{dataset}', reason)
+
+    def load_all(self):
+        return {
+            "materials": self.load_materials(),
+            "material_yields": self.load_material_yields(),
+            "material_units": self.load_material_units(),
+            "price_history": self.load_price_history(),
+            "recipes": self.load_recipes(),
+            "accounting": self.load_accounting(),
+            "categories": self.load_categories()
+        }
+
+
+@st.cache_resource(show_spinner=False)
+def get_local_store():
+    """取得全程序共用的本地資料庫"""
+    return LocalStore(DATABASE_PATH)
+
+
+class SharedDataCache:
+    """全程序共用、帶版本號的資料快取
+
+    快取中的資料與衍生資料是唯讀的快照：session 載入時各自複製一份再修改，
+    儲存時發布新的快照並遞增版本，其他 session 在下次 rerun 時才複製新版本。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.derived_entries = {}
+        self.versions = collections.Counter()
+
+    def get(self, dataset, loader):
+        """回傳 (版本, 資料)；快取中沒有時以 loader 載入"""
+        with self.lock:
+            if dataset in self.entries:
+                return self.entries[dataset]
+            version = self.versions[dataset]
+        data = loader()
+        with self.lock:
+            # 載入期間已有其他 session 發布新版本時，以新版本為準
+            if self.versions[dataset] == version:
+                self.entries[dataset] = (version, data)
+            return self.entries.get(dataset, (version, data))
+
+    def derived(self, dataset, name, builder, depends=()):
+        """回傳由資料集目前版本建立的衍生資料（例如反向索引），版本變動時才重建
+
+        depends 為衍生資料另外依賴的資料集，builder 依序接收各資料集的資料；
+        任一資料集的版本變動都會重建。
+        """
+        datasets = (dataset,) + tuple(depends)
+        with self.lock:
+            entries = [self.entries.get(key, (None, None)) for key in datasets]
+            version = entries[0][0] if not depends else tuple(entry[0] for entry in entries)
+            cached = self.derived_entries.get((dataset, name))
+            if cached and cached[0] == version:
+                return cached[1]
+        value = builder(*[data if data is not None else {} for _, data in entries])
+        with self.lock:
+            current = [self.entries.get(key, (None, None))[0] for key in datasets]
+            if current == [entry[0] for entry in entries]:
+                self.derived_entries[(dataset, name)] = (version, value)
+        return value
+
+    def publish(self, dataset, data, derived=None):
+        """發布儲存後的資料並遞增版本；derived 為已隨資料更新的衍生資料（名稱 -> 值）"""
+        with self.lock:
+            self.versions[dataset] += 1
+            self.entries[dataset] = (self.versions[dataset], data)
+            for name, value in (derived or {}).items():
+                self.derived_entries[(dataset, name)] = (self.versions[dataset], value)
+            return self.versions[dataset]
+
+    def invalidate(self, dataset):
+        """本地資料庫被外部資料覆蓋時，丟棄快取並遞增版本"""
+        with self.lock:
+            self.versions[dataset] += 1
+            self.entries.pop(dataset, None)
+
+
+@st.cache_resource(show_spinner=False)
+def get_shared_data_cache():
+    """取得全程序共用的資料快取"""
+    return SharedDataCache()
+
 def get_taiwan_time():
     """取得台灣時間"""
     return datetime.now(TAIWAN_TZ)
@@ -71,6 +926,74 @@ def get_material_options(materials_dict):
     """快取材料選項列表，避免重複計算"""
     return list(materials_dict.keys())
 
+
+# 沒有輸入搜尋時，材料選單最多顯示的數量
+MATERIAL_PICKER_LIMIT = 60
+# 注音的聲調符號（搜尋時忽略聲調）
+ZHUYIN_TONES = str.maketrans('', '', 'ˉˊˇˋ˙')
+
+
+def material_search_keys(name):
+    """材料名稱可以被搜尋的字串：名稱本身；有安裝 pypinyin 時另外加上拼音、注音與它們的首字母"""
+    keys = [name.lower()]
+    if lazy_pinyin is not None:
+        for style in (Style.NORMAL, Style.BOPOMOFO):
+            syllables = [syllable.translate(ZHUYIN_TONES).lower() for syllable in lazy_pinyin(name, style=style)]
+            keys.append("".join(syllables))
+            keys.append("".join(syllable[:1] for syllable in syllables))
+    return keys
+
+
+def search_grams(text):
+    """搜尋用的 n-gram：單字與相鄰兩字"""
+    return {text[i:i + n] for n in (1, 2) for i in range(len(text) - n + 1)}
+
+
+class MaterialSearchIndex:
+    """材料名稱的 n-gram 索引：查詢先以索引交集找出候選，再確認子字串是否相符"""
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.keys = [material_search_keys(name) for name in self.names]
+        self.grams = collections.defaultdict(set)
+        for position, keys in enumerate(self.keys):
+            for key in keys:
+                for gram in search_grams(key):
+                    self.grams[gram].add(position)
+
+    def search(self, query, starred=()):
+        """回傳符合查詢的名稱：標記的材料優先，其次是開頭相符，最後依原本順序"""
+        query = query.strip().lower()
+        if not query:
+            positions = range(len(self.names))
+        else:
+            grams = [query[i:i + 2] for i in range(len(query) - 1)] or [query]
+            candidates = set.intersection(*(self.grams.get(gram, set()) for gram in grams))
+            positions = [
+                position for position in candidates
+                if any(query in key for key in self.keys[position])
+            ]
+        return [
+            self.names[position]
+            for position in sorted(positions, key=lambda position: (
+                self.names[position] not in starred,
+                bool(query) and not any(key.startswith(query) for key in self.keys[position]),
+                position
+            ))
+        ]
+
+
+def get_material_search_index():
+    """取得材料與子食譜的搜尋索引；只有材料或食譜儲存後（版本變動）才重建"""
+    return get_shared_data_cache().derived(
+        "materials",
+        "search_index",
+        lambda materials, recipes: MaterialSearchIndex(
+            list(materials) + [sub_recipe_key(recipe_name) for recipe_name in recipes]
+        ),
+        depends=("recipes",)
+    )
+
 # 載入自訂類別
 def load_custom_categories():
     if os.path.exists('custom_categories.json'):
@@ -154,6 +1077,12 @@ if 'material_weights' not in st.session_state:
     st.session_state.material_weights = {}
 if 'material_yield_rates' not in st.session_state:
     st.session_state.material_yield_rates = {}
+if 'material_default_yields' not in st.session_state:
+    st.session_state.material_default_yields = {}
+if 'material_units' not in st.session_state:
+    st.session_state.material_units = {}
+if 'material_price_history' not in st.session_state:
+    st.session_state.material_price_history = {}
 if 'show_save_success' not in st.session_state:
     st.session_state.show_save_success = False
 if 'saved_recipe_name' not in st.session_state:
@@ -185,39 +1114,47 @@ if 'editing_record' not in st.session_state:
 
 if 'recipe_expander_states' not in st.session_state:
     st.session_state.recipe_expander_states = {}
+if 'production_plan' not in st.session_state:
+    st.session_state.production_plan = {}
+if 'price_adjustments' not in st.session_state:
+    st.session_state.price_adjustments = []
+if 'target_margins' not in st.session_state:
+    st.session_state.target_margins = {}
 
-# 載入已儲存的材料資料
-def load_saved_materials():
-    try:
-        # 嘗試從 Google Sheets 載入
-        sheet = get_google_sheet()
-        if sheet:
-            # 嘗試取得材料工作表
+# 各工作表的標題列
+MATERIALS_HEADERS = ['材料名稱', '單價', '更新時間']
+MATERIAL_YIELDS_HEADERS = ['材料名稱', '預設熟成率']
+MATERIAL_UNITS_HEADERS = ['材料名稱', '採購單位', '每包數量', '每包單位', '密度']
+# 價格歷史只會附加新列，記錄時間為台灣時間的 ISO 格式（可直接以字串排序）
+PRICE_HISTORY_HEADERS = ['材料名稱', '單價', '記錄時間']
+# 食譜採逐列格式：每個食譜一列標題列（材料名稱留空），每個材料一列
+RECIPES_HEADERS = [
+    '食譜名稱', '材料名稱', '克數', '單價', '熟成率', '成本',
+    '總成本', '創建時間', '更新時間'
+]
+ACCOUNTING_HEADERS = [
+    'ID', '日期', '類型', '類別', '細項', '金額',
+    '地點', '購買人', '產品', '備註', '創建時間'
+]
+SETTINGS_HEADERS = ['類別名稱']
+
+# 解析材料工作表的資料列
+def parse_materials_rows(data):
+    materials = {}
+    
+    for row in data:
+        if row.get('材料名稱') and row.get('單價') is not None:
             try:
-                worksheet = sheet.worksheet("材料")
-            except:
-                # 如果不存在，創建新的
-                worksheet = sheet.add_worksheet(title="材料", rows=1000, cols=10)
-                # 寫入標題
-                worksheet.append_row(['材料名稱', '單價', '更新時間'])
-            
-            # 讀取資料
-            data = worksheet.get_all_records()
-            materials = {}
-            
-            for row in data:
-                if row.get('材料名稱') and row.get('單價') is not None:
-                    try:
-                        price = float(row['單價'])
-                        materials[row['材料名稱']] = price
-                    except ValueError:
-                        continue
-            
-            return materials
-    except Exception as e:
-        st.error(f"從 Google Sheets 載入材料資料時發生錯誤：{e}")
+                price = float(row['單價'])
+                materials[row['材料名稱']] = price
+            except ValueError:
+                continue
     
-    # 如果 Google Sheets 失敗，嘗試從本地檔案載入
+    return materials
+
+
+# 從本地檔案載入材料資料
+def load_local_materials():
     if os.path.exists('saved_materials.json'):
         try:
             with open('saved_materials.json', 'r', encoding='utf-8') as f:
@@ -245,90 +1182,457 @@ def load_saved_materials():
     return {}
 
 
+# 載入已儲存的材料資料（讀取失敗時拋出例外）
+def load_saved_materials():
+    # 取得材料工作表（共用連線，不存在時自動建立）
+    worksheet = get_active_connection().worksheet("材料", 1000, 10, MATERIALS_HEADERS)
+    return parse_materials_rows(worksheet.get_all_records())
+
+
+# 產生材料工作表的寫入計畫（由背景寫入佇列呼叫）
+def plan_materials_sync(materials):
+    worksheet = get_active_connection().worksheet("材料", 1000, 10, MATERIALS_HEADERS)
+    
+    # 準備批量資料
+    batch_data = [MATERIALS_HEADERS]  # 標題行
+    # 更新時間為材料最後一次改價的時間（來自價格歷史），不再每次儲存都覆寫成現在
+    updated_at = get_local_store().load_price_updated_at()
+    
+    # 添加所有資料到批次
+    for material, price in materials.items():
+        batch_data.append([
+            material, 
+            price, 
+            updated_at.get(material, '')[:19].replace('T', ' ')
+        ])
+    
+    # 覆寫工作表（與其他資料集合併成同一批請求）
+    plan = SheetsWritePlan()
+    plan.overwrite(worksheet, batch_data)
+    return plan
+
+
 # 儲存材料資料
 def save_materials_data():
-    try:
-        # 嘗試儲存到 Google Sheets
-        sheet = get_google_sheet()
-        if sheet:
-            # 嘗試取得材料工作表
-            try:
-                worksheet = sheet.worksheet("材料")
-            except:
-                # 如果不存在，創建新的
-                worksheet = sheet.add_worksheet(title="材料", rows=1000, cols=10)
-                # 寫入標題
-                worksheet.append_row(['材料名稱', '單價', '更新時間'])
-            
-            # 準備批量資料
-            batch_data = [['材料名稱', '單價', '更新時間']]  # 標題行
-            
-            # 添加所有資料到批次
-            for material, price in st.session_state.saved_materials.items():
-                batch_data.append([
-                    material, 
-                    price, 
-                    datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                ])
-            
-            # 清空現有資料並批量寫入
-            worksheet.clear()
-            worksheet.update('A1', batch_data)
-            
-            st.success("✅ 資料已同步到 Google Sheets")
-            return
-    except Exception as e:
-        st.error(f"儲存到 Google Sheets 時發生錯誤：{e}")
+    # 先寫入本地資料庫，再排入背景同步到 Google Sheets
+    store = get_local_store()
+    previous = store.load_materials()
+    store.replace_materials(st.session_state.saved_materials)
+    publish_saved_data("materials")
+    # 新增或改價的材料記錄到價格歷史
+    record_price_changes({
+        material: price
+        for material, price in st.session_state.saved_materials.items()
+        if previous.get(material) != price
+    })
+    get_write_behind_queue().submit(
+        "materials",
+        plan_materials_sync,
+        copy.deepcopy(st.session_state.saved_materials)
+    )
+
+
+# 解析預設熟成率工作表的資料列
+def parse_material_yields_rows(data):
+    material_yields = {}
     
-    # 如果 Google Sheets 失敗，儲存到本地檔案
-    try:
-        with open('saved_materials.json', 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.saved_materials, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        st.error(f"儲存材料資料時發生錯誤：{e}")
+    for row in data:
+        yield_rate = normalize_yield_rate(row.get('預設熟成率'))
+        if row.get('材料名稱') and yield_rate is not None:
+            material_yields[str(row['材料名稱'])] = yield_rate
+    
+    return material_yields
+
+
+# 載入材料的預設熟成率（讀取失敗時拋出例外）
+def load_saved_material_yields():
+    # 取得預設熟成率工作表（共用連線，不存在時自動建立）
+    worksheet = get_active_connection().worksheet("熟成率", 1000, 5, MATERIAL_YIELDS_HEADERS)
+    return parse_material_yields_rows(worksheet.get_all_records())
+
+
+# 產生預設熟成率工作表的寫入計畫（由背景寫入佇列呼叫）
+def plan_material_yields_sync(material_yields):
+    worksheet = get_active_connection().worksheet("熟成率", 1000, 5, MATERIAL_YIELDS_HEADERS)
+    plan = SheetsWritePlan()
+    plan.overwrite(worksheet, [MATERIAL_YIELDS_HEADERS] + [list(item) for item in material_yields.items()])
+    return plan
+
+
+# 儲存材料的預設熟成率
+def save_material_yields_data():
+    # 先寫入本地資料庫，再排入背景同步到 Google Sheets
+    get_local_store().replace_material_yields(st.session_state.material_default_yields)
+    publish_saved_data("material_yields")
+    get_write_behind_queue().submit(
+        "material_yields",
+        plan_material_yields_sync,
+        dict(st.session_state.material_default_yields)
+    )
+
+
+# 單位換算表：重量單位 -> 克、容量單位 -> 毫升；包裝單位的內容量由每包數量與每包單位決定
+WEIGHT_UNITS = {"g": 1.0, "kg": 1000.0, "斤": 600.0, "兩": 37.5, "lb": 453.59237, "oz": 28.349523125}
+VOLUME_UNITS = {"ml": 1.0, "L": 1000.0}
+PACK_UNITS = ("包", "箱", "瓶", "罐")
+
+
+def grams_per_unit(spec):
+    """一個採購單位等於多少克；容量單位以密度（g/ml，未設定時為 1）換算，包裝單位需要每包數量"""
+    unit = spec.get('unit') or "g"
+    if unit in WEIGHT_UNITS:
+        return WEIGHT_UNITS[unit]
+    if unit in VOLUME_UNITS:
+        return VOLUME_UNITS[unit] * (spec.get('density') or 1.0)
+    if unit in PACK_UNITS:
+        if not spec.get('pack_size') or spec['pack_size'] <= 0:
+            raise ValueError(f"採購單位「{unit}」需要設定每包數量")
+        return spec['pack_size'] * grams_per_unit({"unit": spec.get('pack_unit') or "g", "density": spec.get('density')})
+    raise ValueError(f"不支援的單位「{unit}」")
+
+
+def build_unit_factors(material_units):
+    """每個材料一個採購單位等於多少克的換算表（沒有設定採購單位的材料為 1，即以克計價）"""
+    factors = {}
+    for material, spec in material_units.items():
+        try:
+            factors[material] = grams_per_unit(spec)
+        except ValueError:
+            continue
+    return factors
+
+
+def get_unit_factors():
+    """取得換算表；只有採購單位儲存後（版本變動）才重新計算"""
+    return get_shared_data_cache().derived("material_units", "unit_factors", build_unit_factors)
+
+
+def describe_unit(spec):
+    """採購單位的顯示文字，例如「箱（12 × 500ml）」"""
+    unit = spec.get('unit') or "g"
+    if unit in PACK_UNITS:
+        return f"{unit}（{spec.get('pack_size') or 0:g}{spec.get('pack_unit') or 'g'}）"
+    return unit
+
+
+# 解析採購單位工作表的資料列
+def parse_material_units_rows(data):
+    material_units = {}
+    
+    for row in data:
+        unit = str(row.get('採購單位') or '')
+        if not row.get('材料名稱') or not unit or unit == "g":
+            continue
+        try:
+            spec = {
+                "unit": unit,
+                "pack_size": float(row['每包數量']) if row.get('每包數量') not in (None, '') else None,
+                "pack_unit": str(row.get('每包單位') or '') or None,
+                "density": float(row['密度']) if row.get('密度') not in (None, '') else None
+            }
+            grams_per_unit(spec)
+        except (TypeError, ValueError):
+            continue
+        material_units[str(row['材料名稱'])] = spec
+    
+    return material_units
+
+
+# 載入材料的採購單位（讀取失敗時拋出例外）
+def load_saved_material_units():
+    # 取得採購單位工作表（共用連線，不存在時自動建立）
+    worksheet = get_active_connection().worksheet("採購單位", 1000, 10, MATERIAL_UNITS_HEADERS)
+    return parse_material_units_rows(worksheet.get_all_records(value_render_option="UNFORMATTED_VALUE"))
+
+
+# 產生採購單位工作表的寫入計畫（由背景寫入佇列呼叫）
+def plan_material_units_sync(material_units):
+    worksheet = get_active_connection().worksheet("採購單位", 1000, 10, MATERIAL_UNITS_HEADERS)
+    plan = SheetsWritePlan()
+    plan.overwrite(worksheet, [MATERIAL_UNITS_HEADERS] + [
+        [name, spec['unit'], spec.get('pack_size') or '', spec.get('pack_unit') or '', spec.get('density') or '']
+        for name, spec in material_units.items()
+    ])
+    return plan
+
+
+# 儲存材料的採購單位
+def save_material_units_data():
+    # 先寫入本地資料庫，再排入背景同步到 Google Sheets
+    get_local_store().replace_material_units(st.session_state.material_units)
+    publish_saved_data("material_units")
+    get_write_behind_queue().submit(
+        "material_units",
+        plan_material_units_sync,
+        copy.deepcopy(st.session_state.material_units)
+    )
+
+
+def update_material_unit(material, new_name=None):
+    """材料改名或刪除（new_name 為 None）時同步更新採購單位，只有內容變動時才儲存"""
+    ensure_data_loaded("material_units")
+    material_units = st.session_state.material_units
+    spec = material_units.pop(material, None)
+    if spec is None:
+        return
+    if new_name is not None:
+        material_units[new_name] = spec
+    save_material_units_data()
+
+
+# 解析價格歷史工作表的資料列
+def parse_price_history_rows(data):
+    entries = []
+    
+    for row in data:
+        try:
+            if row.get('材料名稱') and row.get('記錄時間'):
+                entries.append((str(row['材料名稱']), str(row['記錄時間']), float(row['單價'])))
+        except (TypeError, ValueError):
+            continue
+    
+    # 依材料與時間排序，查詢時才能以二分搜尋找到某個時間點的單價
+    history = {}
+    for name, recorded_at, price in sorted(entries):
+        times, prices = history.setdefault(name, ([], []))
+        if times and times[-1] == recorded_at:
+            prices[-1] = price
+        else:
+            times.append(recorded_at)
+            prices.append(price)
+    return history
+
+
+# 載入材料價格歷史（讀取失敗時拋出例外，不會以空的歷史取代）
+def load_saved_price_history():
+    # 取得價格歷史工作表（共用連線，不存在時自動建立）
+    worksheet = get_active_connection().worksheet("價格歷史", 1000, 5, PRICE_HISTORY_HEADERS)
+    return parse_price_history_rows(worksheet.get_all_records(value_render_option="UNFORMATTED_VALUE"))
+
+
+# 產生價格歷史工作表的寫入計畫（由背景寫入佇列呼叫）
+def plan_price_history_sync(entries):
+    """entries 為要附加的新列；None 表示材料改名後以本地資料庫整批改寫"""
+    worksheet = get_active_connection().worksheet("價格歷史", 1000, 5, PRICE_HISTORY_HEADERS)
+    plan = SheetsWritePlan()
+    if entries is None:
+        history = get_local_store().load_price_history()
+        plan.overwrite(worksheet, [PRICE_HISTORY_HEADERS] + [
+            [name, price, recorded_at]
+            for name, (times, prices) in history.items()
+            for recorded_at, price in zip(times, prices)
+        ])
+    else:
+        plan.append_rows(worksheet, [[name, price, recorded_at] for name, recorded_at, price in entries])
+    return plan
+
+
+def merge_price_history_changes(pending, new):
+    """合併尚未同步的價格歷史變更，任一次需要整批改寫時就整批改寫"""
+    if pending is None or new is None:
+        return None
+    return pending + new
+
+
+def record_price_changes(prices):
+    """把材料的新單價附加到價格歷史（材料名稱 -> 單價），同一秒內的多次改價只保留最後一次"""
+    if not prices:
+        return
+    ensure_data_loaded("price_history")
+    history = st.session_state.material_price_history
+    recorded_at = get_taiwan_time().isoformat(timespec='seconds')
+    entries = []
+    for material, price in prices.items():
+        times, prices_list = history.setdefault(material, ([], []))
+        if times and times[-1] == recorded_at:
+            prices_list[-1] = price
+        else:
+            times.append(recorded_at)
+            prices_list.append(price)
+        entries.append((material, recorded_at, price))
+    get_local_store().append_price_history(entries)
+    publish_saved_data("price_history")
+    get_write_behind_queue().submit(
+        "price_history",
+        plan_price_history_sync,
+        entries,
+        merge=merge_price_history_changes
+    )
+
+
+def rename_price_history(material, new_name):
+    """材料改名時把價格歷史移到新名稱，過去時間點的成本才能繼續查到這個材料的單價"""
+    ensure_data_loaded("price_history")
+    store = get_local_store()
+    store.rename_price_history(material, new_name)
+    st.session_state.material_price_history = store.load_price_history()
+    publish_saved_data("price_history")
+    get_write_behind_queue().submit(
+        "price_history",
+        plan_price_history_sync,
+        None,
+        merge=merge_price_history_changes
+    )
+
+
+def update_material_default_yield(material, new_name=None, yield_rate=None):
+    """材料新增、改名或刪除時同步更新預設熟成率
+
+    new_name 為 None 表示材料已刪除；yield_rate 為 None 時沿用原本的預設熟成率，
+    熟成率為 1 表示不使用熟成率。只有內容變動時才儲存。
+    """
+    material_yields = st.session_state.material_default_yields
+    before = dict(material_yields)
+    old_yield = material_yields.pop(material, None)
+    if new_name is not None:
+        new_yield = normalize_yield_rate(yield_rate) if yield_rate is not None else old_yield
+        if new_yield is not None and new_yield < 1:
+            material_yields[new_name] = new_yield
+    if material_yields != before:
+        save_material_yields_data()
+
+
+def build_effective_prices(materials, material_yields):
+    """每克有效單價表：單價 / 預設熟成率（沒有預設熟成率時即為單價）"""
+    return {
+        material: price / material_yields.get(material, 1.0)
+        for material, price in materials.items()
+    }
+
+
+def get_effective_prices():
+    """取得每克有效單價表；只有單價或預設熟成率儲存後（版本變動）才重新計算"""
+    return get_shared_data_cache().derived(
+        "materials", "effective_prices", build_effective_prices, depends=("material_yields",)
+    )
 
  
-# 載入已儲存的食譜資料
-def load_saved_recipes():
+def normalize_yield_rate(yield_rate):
+    """統一熟成率格式：舊版編輯器會存成勾選狀態 True（即固定 0.8），未使用熟成率時為 None"""
+    if yield_rate is True:
+        return 0.8
     try:
-        # 嘗試從 Google Sheets 載入
-        sheet = get_google_sheet()
-        if sheet:
-            # 嘗試取得食譜工作表
+        yield_rate = float(yield_rate)
+    except (TypeError, ValueError):
+        return None
+    return yield_rate if yield_rate > 0 else None
+
+
+# 解析舊版食譜工作表（材料欄存整個 JSON 字串）
+def parse_legacy_recipes_rows(data):
+    recipes = {}
+    
+    for row in data:
+        if row.get('食譜名稱'):
+            recipe_name = row['食譜名稱']
             try:
-                worksheet = sheet.worksheet("食譜")
-            except:
-                # 如果不存在，創建新的
-                worksheet = sheet.add_worksheet(title="食譜", rows=1000, cols=20)
-                # 寫入標題
-                worksheet.append_row(['食譜名稱', '材料', '總成本', '創建時間'])
-            
-            # 讀取資料
-            data = worksheet.get_all_records()
-            recipes = {}
-            
-            for row in data:
-                if row.get('食譜名稱'):
-                    recipe_name = row['食譜名稱']
-                    try:
-                        # 解析材料資料（假設存儲為 JSON 字串）
-                        materials_str = row.get('材料', '{}')
-                        materials = json.loads(materials_str) if materials_str else {}
-                        
-                        recipes[recipe_name] = {
-                            "materials": materials,
-                            "total_cost": float(row.get('總成本', 0)),
-                            "created_at": row.get('創建時間', datetime.now().isoformat())
-                        }
-                    except Exception as e:
-                        st.warning(f"解析食譜 {recipe_name} 時發生錯誤：{e}")
-                        continue
-            
-            return recipes
-    except Exception as e:
-        st.error(f"從 Google Sheets 載入食譜資料時發生錯誤：{e}")
+                # 解析材料資料（存儲為 JSON 字串）
+                materials_str = row.get('材料', '{}')
+                materials = json.loads(materials_str) if materials_str else {}
+                for line in materials.values():
+                    line['yield_rate'] = normalize_yield_rate(line.get('yield_rate'))
+                
+                recipes[recipe_name] = {
+                    "materials": materials,
+                    "total_cost": float(row.get('總成本', 0)),
+                    "created_at": row.get('創建時間', datetime.now().isoformat())
+                }
+            except Exception as e:
+                st.warning(f"解析食譜 {recipe_name} 時發生錯誤：{e}")
+                continue
+    
+    return recipes
+
+
+# 解析食譜工作表的資料列
+def parse_recipes_rows(data):
+    """以欄為單位（向量化）解析逐列格式的食譜工作表，不需要逐列 json.loads"""
+    frame = pd.DataFrame(data)
+    if frame.empty or '食譜名稱' not in frame.columns:
+        return {}
+    if '材料名稱' not in frame.columns:
+        # 尚未轉換的舊版工作表
+        return parse_legacy_recipes_rows(data)
+    
+    frame = frame.reindex(columns=RECIPES_HEADERS).fillna('')
+    frame['食譜名稱'] = frame['食譜名稱'].astype(str).str.strip()
+    frame['材料名稱'] = frame['材料名稱'].astype(str).str.strip()
+    frame = frame[frame['食譜名稱'] != '']
+    for column in ['克數', '單價', '熟成率', '成本', '總成本']:
+        frame[column] = pd.to_numeric(frame[column], errors='coerce')
+    
+    headers = frame[frame['材料名稱'] == ''].drop_duplicates('食譜名稱', keep='last')
+    lines = frame[frame['材料名稱'] != ''].drop_duplicates(['食譜名稱', '材料名稱'], keep='last').copy()
+    
+    # 計算每個材料的成本（工作表沒有成本時依克數、單價與熟成率重算）
+    lines['克數'] = lines['克數'].fillna(0.0)
+    lines['單價'] = lines['單價'].fillna(0.0)
+    lines['熟成率'] = lines['熟成率'].where(lines['熟成率'] > 0)
+    lines['調整重量'] = (lines['克數'] / lines['熟成率']).fillna(lines['克數'])
+    lines['成本'] = lines['成本'].fillna(lines['調整重量'] * lines['單價'])
+    line_totals = lines.groupby('食譜名稱', sort=False)['成本'].sum()
     
-    # 如果 Google Sheets 失敗，嘗試從本地檔案載入
+    # 依工作表中第一次出現的順序建立食譜
+    recipes = {
+        name: {"materials": {}, "total_cost": 0.0, "created_at": datetime.now().isoformat()}
+        for name in frame['食譜名稱'].drop_duplicates()
+    }
+    for name, total_cost, created_at, updated_at in zip(
+        headers['食譜名稱'], headers['總成本'], headers['創建時間'], headers['更新時間']
+    ):
+        recipe = recipes[name]
+        if pd.notna(total_cost):
+            recipe['total_cost'] = float(total_cost)
+        # 手動輸入的日期以 UNFORMATTED_VALUE 讀回時是日期序號
+        if created_at != '':
+            recipe['created_at'] = sheet_text(created_at)
+        if updated_at != '':
+            recipe['updated_at'] = sheet_text(updated_at)
+    for name, material, weight, price, yield_rate, cost, adjusted_weight in zip(
+        lines['食譜名稱'], lines['材料名稱'], lines['克數'], lines['單價'],
+        lines['熟成率'], lines['成本'], lines['調整重量']
+    ):
+        recipes[name]['materials'][material] = {
+            "weight": float(weight),
+            "price": float(price),
+            "cost": float(cost),
+            "yield_rate": float(yield_rate) if pd.notna(yield_rate) else None,
+            "adjusted_weight": float(adjusted_weight)
+        }
+    # 沒有標題列的食譜以材料成本加總作為總成本
+    missing_header = set(recipes) - set(headers['食譜名稱'])
+    for name in missing_header:
+        recipes[name]['total_cost'] = float(line_totals.get(name, 0.0))
+    
+    return recipes
+
+
+def recipes_to_rows(recipes):
+    """將食譜轉為工作表的列：key 為 (食譜名稱, 材料名稱)，標題列的材料名稱為空字串"""
+    rows = {}
+    for recipe_name, recipe_data in recipes.items():
+        rows[(recipe_name, '')] = [
+            recipe_name, '', '', '', '', '',
+            recipe_data.get('total_cost', 0),
+            recipe_data.get('created_at', ''),
+            recipe_data.get('updated_at', '')
+        ]
+        for material, line in recipe_data.get('materials', {}).items():
+            yield_rate = normalize_yield_rate(line.get('yield_rate'))
+            rows[(recipe_name, material)] = [
+                recipe_name,
+                material,
+                line.get('weight', 0),
+                line.get('price', 0),
+                yield_rate if yield_rate is not None else '',
+                line.get('cost', 0),
+                '', '', ''
+            ]
+    return rows
+
+
+# 從本地檔案載入食譜資料
+def load_local_recipes():
     if os.path.exists('saved_recipes.json'):
         try:
             with open('saved_recipes.json', 'r', encoding='utf-8') as f:
@@ -343,98 +1647,647 @@ def load_saved_recipes():
     return {}
 
 
+# 載入已儲存的食譜資料（讀取失敗時拋出例外）
+def load_saved_recipes():
+    # 取得食譜工作表（共用連線，不存在時自動建立）
+    worksheet = get_active_connection().worksheet("食譜", 1000, 20, RECIPES_HEADERS)
+    return parse_recipes_rows(worksheet.get_all_records())
+
+
+# 產生食譜工作表的寫入計畫（由背景寫入佇列呼叫）
+def plan_recipes_sync(changes):
+    worksheet = get_active_connection().worksheet("食譜", 1000, 20, RECIPES_HEADERS)
+    key_rows = None
+    if changes['full'] is None:
+        # 讀取前兩欄（食譜名稱、材料名稱）定位列號，同時確認工作表格式
+        key_rows = read_row_keys(worksheet, 2)
+        if not key_rows or key_rows[0] != RECIPES_HEADERS[:2]:
+            # 舊版（材料欄存 JSON）的工作表：以本地資料庫整批改寫成逐列格式
+            changes = row_changes(full=recipes_to_rows(get_local_store().load_recipes()))
+    return plan_row_changes(worksheet, RECIPES_HEADERS, changes, key_columns=2, key_rows=key_rows)
+
+
 # 儲存食譜資料
-def save_recipes_data():
-    try:
-        # 嘗試儲存到 Google Sheets
-        sheet = get_google_sheet()
-        if sheet:
-            # 嘗試取得食譜工作表
-            try:
-                worksheet = sheet.worksheet("食譜")
-            except:
-                # 如果不存在，創建新的
-                worksheet = sheet.add_worksheet(title="食譜", rows=1000, cols=20)
-                # 寫入標題
-                worksheet.append_row(['食譜名稱', '材料', '總成本', '創建時間'])
-            
-            # 準備批量資料
-            batch_data = [['食譜名稱', '材料', '總成本', '創建時間']]  # 標題行
-            
-            # 添加所有資料到批次
-            for recipe_name, recipe_data in st.session_state.saved_recipes.items():
-                batch_data.append([
-                    recipe_name,
-                    json.dumps(recipe_data['materials'], ensure_ascii=False),
-                    recipe_data['total_cost'],
-                    recipe_data['created_at']
-                ])
-            
-            # 清空現有資料並批量寫入
-            worksheet.clear()
-            worksheet.update('A1', batch_data)
-            
-            st.success("✅ 食譜資料已同步到 Google Sheets")
+def save_recipes_data(changed=(), deleted=(), full_rewrite=False):
+    """儲存食譜資料到本地資料庫並同步到 Google Sheets
+
+    changed 為新增或修改的食譜名稱、deleted 為刪除的食譜名稱；
+    只同步內容有變動的列（例如只改一個材料的克數就只更新該材料那一列）。
+    只有 full_rewrite=True 時才重寫整個工作表。
+    """
+    store = get_local_store()
+    recipes = st.session_state.saved_recipes
+    if full_rewrite:
+        # 先寫入本地資料庫，再排入背景同步到 Google Sheets
+        store.replace_recipes(recipes)
+        publish_saved_data("recipes")
+        changes = row_changes(full=recipes_to_rows(recipes))
+    else:
+        changed = [name for name in changed if name in recipes]
+        deleted = [name for name in deleted if name not in changed]
+        if not changed and not deleted:
             return
-    except Exception as e:
-        st.error(f"儲存食譜到 Google Sheets 時發生錯誤：{e}")
+        # 子食譜有變動時，一併重算並儲存下游使用它的食譜
+        changed += [name for name in rollup_sub_recipe_costs(changed + deleted) if name not in changed]
+        changed = {name: recipes[name] for name in changed}
+        # 與本地資料庫中的舊版本比對，找出實際變動的列
+        old_recipes = store.load_recipes_by_name(list(changed) + deleted)
+        old_rows = recipes_to_rows(old_recipes)
+        new_rows = recipes_to_rows(changed)
+        # 先寫入本地資料庫，再排入背景同步到 Google Sheets
+        store.apply_recipe_changes(changed, deleted)
+        # 只更新變動食譜在反向索引中的項目
+        index = update_material_index(get_material_index(), old_recipes, changed)
+        publish_saved_data("recipes", derived={"material_index": index})
+        changes = row_changes(
+            upserts={key: row for key, row in new_rows.items() if old_rows.get(key) != row},
+            deletes=set(old_rows) - set(new_rows)
+        )
+        if not changes['upserts'] and not changes['deletes']:
+            return
+    get_write_behind_queue().submit(
+        "recipes",
+        plan_recipes_sync,
+        copy.deepcopy(changes),
+        merge=merge_row_changes
+    )
+
+
+class RecipeCostEngine:
+    """食譜成本引擎
+
+    所有食譜的材料列存成「食譜 × 材料」的稀疏矩陣（COO：列索引、欄索引、調整後重量），
+    食譜總成本 = 矩陣 × 單價向量，以一次 NumPy 運算（bincount）完成。
+    """
+
+    def __init__(self, recipes):
+        self.recipes = recipes
+        self.recipe_names = list(recipes)
+        self.material_names = {}
+        rows, columns, weights, yield_rates, prices = [], [], [], [], []
+        for row, recipe_data in enumerate(recipes.values()):
+            for material, line in recipe_data.get('materials', {}).items():
+                rows.append(row)
+                columns.append(self.material_names.setdefault(material, len(self.material_names)))
+                weights.append(float(line.get('weight') or 0))
+                yield_rates.append(normalize_yield_rate(line.get('yield_rate')) or 1.0)
+                prices.append(float(line.get('price') or 0))
+        self.rows = np.array(rows, dtype=np.intp)
+        self.columns = np.array(columns, dtype=np.intp)
+        self.weights = np.array(weights, dtype=float)
+        # 有熟成率時：重量 / 熟成率；沒有時熟成率視為 1
+        self.yield_rates = np.array(yield_rates, dtype=float)
+        self.adjusted_weights = self.weights / self.yield_rates
+        self.line_prices = np.array(prices, dtype=float)
+        # 每克有效單價（單價 / 熟成率）預先算好，成本只需每列一次乘法
+        self.effective_prices = self.line_prices / self.yield_rates
+
+    def price_vector(self, materials):
+        """依材料單價（名稱 -> 單價）建立單價向量，沒有單價的材料為 NaN"""
+        return np.array([materials.get(material, np.nan) for material in self.material_names], dtype=float)
+
+    def line_costs(self, prices=None):
+        """每一列材料的成本；prices 為單價向量，未指定時使用食譜中記錄的單價"""
+        if prices is None:
+            return self.weights * self.effective_prices
+        line_prices = prices[self.columns]
+        # 單價向量中沒有的材料沿用食譜中記錄的單價
+        line_prices = np.where(np.isnan(line_prices), self.line_prices, line_prices)
+        return self.weights * (line_prices / self.yield_rates)
+
+    def totals(self, prices=None):
+        """所有食譜的總成本（稀疏矩陣 × 單價向量）"""
+        return np.bincount(self.rows, weights=self.line_costs(prices), minlength=len(self.recipe_names))
+
+    def reprice(self, materials):
+        """以目前的材料單價重算整個食譜目錄，回傳 食譜名稱 -> 總成本"""
+        return dict(zip(self.recipe_names, self.totals(self.price_vector(materials)).tolist()))
+
+    def requirements(self, batches):
+        """依每個食譜的份數向量，回傳每個材料需要的克數（含熟成率調整）與成本（使用食譜中記錄的單價）"""
+        line_batches = batches[self.rows]
+        minlength = len(self.material_names)
+        grams = np.bincount(self.columns, weights=self.adjusted_weights * line_batches, minlength=minlength)
+        costs = np.bincount(self.columns, weights=self.line_costs() * line_batches, minlength=minlength)
+        return grams, costs
+
+    def apply(self, prices=None):
+        """把計算結果寫回食譜：每列的 adjusted_weight、cost 與食譜的 total_cost"""
+        line_costs = self.line_costs(prices)
+        totals = np.bincount(self.rows, weights=line_costs, minlength=len(self.recipe_names))
+        lines = (
+            line
+            for recipe_data in self.recipes.values()
+            for line in recipe_data.get('materials', {}).values()
+        )
+        for line, adjusted_weight, cost in zip(lines, self.adjusted_weights.tolist(), line_costs.tolist()):
+            line['adjusted_weight'] = adjusted_weight
+            line['cost'] = cost
+        for recipe_data, total_cost in zip(self.recipes.values(), totals.tolist()):
+            recipe_data['total_cost'] = total_cost
+        return totals
+
+
+def cost_recipe_lines(lines):
+    """計算單一食譜（材料名稱 -> 材料列）每列的成本並寫回，回傳總成本"""
+    recipe_data = {'materials': lines}
+    RecipeCostEngine({'': recipe_data}).apply()
+    return recipe_data['total_cost']
+
+
+def get_cost_engine():
+    """取得整個食譜目錄的成本引擎（隨食譜資料版本快取在全程序共用的快取中）"""
+    return get_shared_data_cache().derived("recipes", "cost_engine", RecipeCostEngine)
+
+
+def build_material_index(recipes):
+    """建立材料 -> 使用該材料的食譜的反向索引（以 dict 保持食譜順序）"""
+    index = collections.defaultdict(dict)
+    for recipe_name, recipe_data in recipes.items():
+        for material in recipe_data.get('materials', {}):
+            index[material][recipe_name] = None
+    # 索引放在共用快取中，發布後視為唯讀，不使用 defaultdict 避免查詢時新增項目
+    return dict(index)
+
+
+def update_material_index(index, old_recipes, new_recipes):
+    """依變動前後的食譜內容建立新的反向索引（刪除的食譜不在 new_recipes 中）
+
+    不修改傳入的索引（其他 session 可能正在讀取），只複製有變動的材料項目，
+    其餘項目與舊索引共用。
+    """
+    updated = dict(index)
+    copied = set()
+    
+    def entry(material):
+        if material not in copied:
+            updated[material] = dict(updated.get(material, {}))
+            copied.add(material)
+        return updated[material]
     
-    # 如果 Google Sheets 失敗，儲存到本地檔案
+    for recipe_name, recipe_data in old_recipes.items():
+        for material in recipe_data.get('materials', {}):
+            entry(material).pop(recipe_name, None)
+    for recipe_name, recipe_data in new_recipes.items():
+        for material in recipe_data.get('materials', {}):
+            entry(material)[recipe_name] = None
+    for material in copied:
+        if not updated[material]:
+            del updated[material]
+    return updated
+
+
+def get_material_index():
+    """取得材料 -> 食譜的反向索引（隨食譜資料版本快取在全程序共用的快取中）"""
+    return get_shared_data_cache().derived("recipes", "material_index", build_material_index)
+
+
+# 子食譜在材料清單中的名稱前綴（例如「📖 麵團」），用來與一般材料區分
+SUB_RECIPE_PREFIX = "📖 "
+
+
+def sub_recipe_key(recipe_name):
+    return f"{SUB_RECIPE_PREFIX}{recipe_name}"
+
+
+def sub_recipe_name(key):
+    """材料名稱為子食譜時回傳食譜名稱，否則回傳 None"""
+    return key[len(SUB_RECIPE_PREFIX):] if key.startswith(SUB_RECIPE_PREFIX) else None
+
+
+def recipe_unit_cost(recipe_data):
+    """食譜每克的成本（總成本 / 所有材料的克數），作為子食譜的單價"""
+    total_weight = sum(line.get('weight') or 0 for line in recipe_data.get('materials', {}).values())
+    return recipe_data.get('total_cost', 0) / total_weight if total_weight > 0 else 0.0
+
+
+def get_ingredient_price(key):
+    """成本計算頁面選項的單價：一般材料為材料單價，子食譜為該食譜每克的成本"""
+    recipe_name = sub_recipe_name(key)
+    if recipe_name is None:
+        return st.session_state.saved_materials[key]
+    return recipe_unit_cost(st.session_state.saved_recipes[recipe_name])
+
+
+def find_recipe_cycle(recipe_name, materials):
+    """檢查食譜使用的子食譜是否直接或間接用到自己，有循環時回傳循環路徑，否則回傳 None"""
+    recipes = st.session_state.saved_recipes
+    stack = [(sub_recipe_name(key), [recipe_name]) for key in materials if sub_recipe_name(key) is not None]
+    visited = set()
+    while stack:
+        name, path = stack.pop()
+        if name == recipe_name:
+            return path + [name]
+        if name in visited or name not in recipes:
+            continue
+        visited.add(name)
+        for key in recipes[name]['materials']:
+            sub_name = sub_recipe_name(key)
+            if sub_name is not None:
+                stack.append((sub_name, path + [name]))
+    return None
+
+
+def sub_recipe_levels(names, recipes):
+    """計算食譜在相依關係圖中的層級（只用到 names 以外子食譜的層級為 0），有循環時拋出 ValueError"""
+    levels = {}
+    visiting = set()
+
+    def visit(name):
+        if name in levels:
+            return levels[name]
+        if name in visiting:
+            raise ValueError(f"食譜「{name}」有循環引用")
+        visiting.add(name)
+        level = 0
+        for key in recipes[name]['materials']:
+            sub_name = sub_recipe_name(key)
+            if sub_name in names:
+                level = max(level, visit(sub_name) + 1)
+        visiting.discard(name)
+        levels[name] = level
+        return level
+
+    for name in names:
+        visit(name)
+    return levels
+
+
+def rollup_sub_recipe_costs(roots):
+    """子食譜成本變動後，只沿著相依關係往下游重算使用它們的食譜
+
+    每個食譜的成本都保存在食譜中（等同於每個節點的記憶化結果），
+    沒有受影響的食譜不會重算。回傳重算過的食譜名稱。
+    """
+    recipes = st.session_state.saved_recipes
+    index = get_material_index()
+    # 透過反向索引找出所有下游食譜
+    downstream = {}
+    stack = list(roots)
+    while stack:
+        for parent in index.get(sub_recipe_key(stack.pop()), ()):
+            if parent in recipes and parent not in downstream:
+                downstream[parent] = None
+                stack.append(parent)
+    if not downstream:
+        return []
     try:
-        with open('saved_recipes.json', 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.saved_recipes, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        st.error(f"儲存食譜資料時發生錯誤：{e}")
+        recost_recipe_levels(downstream)
+    except ValueError as e:
+        st.warning(f"無法更新子食譜成本：{e}")
+        return []
+    return list(downstream)
+
+
+def recost_recipe_levels(names):
+    """依子食譜層級由下往上重算食譜：先更新子食譜列的單價，同一層的食譜以成本引擎一次計算"""
+    recipes = st.session_state.saved_recipes
+    levels = sub_recipe_levels(names, recipes)
+    for level in sorted(set(levels.values())):
+        batch = {name: recipes[name] for name in names if levels[name] == level}
+        for recipe_data in batch.values():
+            for key, line in recipe_data['materials'].items():
+                sub_name = sub_recipe_name(key)
+                if sub_name in recipes:
+                    line['price'] = recipe_unit_cost(recipes[sub_name])
+        RecipeCostEngine(batch).apply()
+
+
+def find_stale_recipes(recipes, materials):
+    """找出成本過期的食譜：材料列記錄的單價與目前材料單價不同，或總成本與重算結果不同（例如子食譜已變動）"""
+    engine = RecipeCostEngine(recipes)
+    prices = engine.price_vector(materials)
+    current_prices = prices[engine.columns]
+    stale_lines = ~np.isnan(current_prices) & ~np.isclose(current_prices, engine.line_prices)
+    stale = np.zeros(len(engine.recipe_names), dtype=bool)
+    stale[engine.rows[stale_lines]] = True
+    recorded_totals = np.array([float(recipe_data.get('total_cost') or 0) for recipe_data in recipes.values()])
+    stale |= ~np.isclose(rollup_totals(engine, prices), recorded_totals)
+    return [recipe_name for recipe_name, is_stale in zip(engine.recipe_names, stale.tolist()) if is_stale]
+
+
+def get_stale_recipes():
+    """取得成本過期的食譜名稱；只有食譜或材料儲存後（版本變動）才重新檢查"""
+    return get_shared_data_cache().derived(
+        "recipes", "stale_recipes", find_stale_recipes, depends=("materials",)
+    )
+
+
+def refresh_stale_recipes(names):
+    """以目前材料單價重算過期的食譜，並以一次批次寫入儲存"""
+    recipes = st.session_state.saved_recipes
+    materials = st.session_state.saved_materials
+    names = [name for name in names if name in recipes]
+    for recipe_name in names:
+        for material, line in recipes[recipe_name]['materials'].items():
+            if material in materials:
+                line['price'] = materials[material]
+    recost_recipe_levels(names)
+    save_recipes_data(changed=names)
+    return names
+
+
+def plan_material_requirements(plan):
+    """計算生產計畫（食譜名稱 -> 份數）需要的材料克數與成本
+
+    子食譜會展開成它的材料：需要的子食譜克數 / 子食譜總克數 = 子食譜份數，
+    一層一層往下展開，每一層都以成本引擎的稀疏矩陣一次計算。
+    回傳材料清單的 DataFrame（材料名稱、需要克數、單價、成本）。
+    """
+    engine = get_cost_engine()
+    recipe_rows = {recipe_name: row for row, recipe_name in enumerate(engine.recipe_names)}
+    batches = np.zeros(len(engine.recipe_names))
+    for recipe_name, quantity in plan.items():
+        if recipe_name in recipe_rows:
+            batches[recipe_rows[recipe_name]] += quantity
+    # 子食譜欄位 -> 子食譜所在的列，以及每個食譜一份的總克數
+    sub_columns, sub_rows = [], []
+    for material, column in engine.material_names.items():
+        recipe_name = sub_recipe_name(material)
+        if recipe_name in recipe_rows:
+            sub_columns.append(column)
+            sub_rows.append(recipe_rows[recipe_name])
+    sub_columns = np.array(sub_columns, dtype=np.intp)
+    sub_rows = np.array(sub_rows, dtype=np.intp)
+    batch_weights = np.bincount(engine.rows, weights=engine.weights, minlength=len(engine.recipe_names))
+    grams = np.zeros(len(engine.material_names))
+    costs = np.zeros(len(engine.material_names))
+    # 子食譜沒有循環時，最多展開「食譜數量」層
+    for _ in range(len(engine.recipe_names) + 1):
+        level_grams, level_costs = engine.requirements(batches)
+        sub_grams = level_grams[sub_columns]
+        level_grams[sub_columns] = 0
+        level_costs[sub_columns] = 0
+        grams += level_grams
+        costs += level_costs
+        batches = np.zeros(len(engine.recipe_names))
+        sub_weights = batch_weights[sub_rows]
+        np.add.at(batches, sub_rows, np.divide(sub_grams, sub_weights, out=np.zeros_like(sub_grams), where=sub_weights > 0))
+        if not batches.any():
+            break
+    needed = grams > 0
+    materials = np.array(list(engine.material_names), dtype=object)
+    requirements = pd.DataFrame({
+        "材料名稱": materials[needed],
+        "需要克數": grams[needed],
+        "單價": costs[needed] / grams[needed],
+        "成本": costs[needed],
+    })
+    return requirements.sort_values("需要克數", ascending=False, ignore_index=True)
+
+
+# 售價的尾數規則：名稱 -> 無條件進位的函式（進位才不會低於目標毛利）
+PRICE_ROUNDING_RULES = {
+    "不調整": lambda prices: prices,
+    "整數": np.ceil,
+    "尾數 5 或 0": lambda prices: np.ceil(prices / 5) * 5,
+    "尾數 0": lambda prices: np.ceil(prices / 10) * 10,
+    "尾數 9": lambda prices: np.ceil((prices + 1) / 10) * 10 - 1,
+}
+
+
+def build_product_sales(records):
+    """彙總每個產品的實際收入：一筆收入記錄有多個產品時平均分攤金額，每筆記錄視為售出一份"""
+    sales = pd.DataFrame(
+        [
+            (record.get('products') or [record.get('product', '')], float(record.get('amount') or 0))
+            for record in records
+            if record.get('type') == "收入"
+        ],
+        columns=["產品", "金額"]
+    )
+    sales["產品"] = sales["產品"].map(lambda products: [product for product in products if product])
+    sales = sales.loc[sales["產品"].map(len) > 0]
+    sales["金額"] = sales["金額"] / sales["產品"].map(len)
+    sales = sales.explode("產品")
+    return sales.groupby("產品")["金額"].agg(銷售筆數="count", 實際收入="sum")
+
+
+def get_product_sales():
+    """取得每個產品的實際收入彙總；只有記帳資料儲存後（版本變動）才重新計算"""
+    return get_shared_data_cache().derived("accounting", "product_sales", build_product_sales)
+
+
+def suggest_menu_prices(recipes, target_margins, default_margin, rounding, product_sales):
+    """依目標毛利率一次計算所有食譜的建議售價，並與記帳中實際收入的平均售價比較
+
+    售價 = 成本 / (1 - 毛利率)，再依尾數規則進位；target_margins 為個別食譜的目標毛利率（%）。
+    """
+    names = list(recipes)
+    costs = np.array([float(recipe_data.get('total_cost') or 0) for recipe_data in recipes.values()])
+    margins = np.array([target_margins.get(name, default_margin) for name in names], dtype=float)
+    prices = PRICE_ROUNDING_RULES[rounding](costs / np.maximum(1 - margins / 100, 0.01))
+    suggestions = pd.DataFrame({
+        "食譜名稱": names,
+        "成本": costs,
+        "目標毛利 %": margins,
+        "建議售價": prices,
+        "建議售價毛利 %": np.divide(prices - costs, prices, out=np.zeros_like(prices), where=prices > 0) * 100,
+    })
+    suggestions = suggestions.join(product_sales, on="食譜名稱")
+    suggestions["平均售價"] = suggestions["實際收入"] / suggestions["銷售筆數"]
+    suggestions["實際毛利 %"] = (suggestions["平均售價"] - suggestions["成本"]) / suggestions["平均售價"] * 100
+    return suggestions.drop(columns=["實際收入"])
+
+
+def as_of_key(day):
+    """日期查詢的時間鍵：記錄時間為 ISO 字串，「T24」排在當天所有時間之後，涵蓋一整天的改價"""
+    return f"{day.isoformat()}T24"
+
+
+def price_as_of(material, when, default=None):
+    """以二分搜尋取得材料在某個時間點的單價；早於第一筆記錄時使用最早的單價，沒有歷史時回傳 default"""
+    history = st.session_state.material_price_history.get(material)
+    if not history:
+        return default
+    times, prices = history
+    position = bisect.bisect_right(times, when)
+    return prices[position - 1] if position else prices[0]
+
+
+def sub_recipe_closure(recipe_name):
+    """食譜與它直接或間接使用的所有子食譜"""
+    recipes = st.session_state.saved_recipes
+    closure = {}
+    stack = [recipe_name]
+    while stack:
+        name = stack.pop()
+        if name in closure or name not in recipes:
+            continue
+        closure[name] = recipes[name]
+        stack.extend(sub_recipe_name(key) for key in recipes[name]['materials'] if sub_recipe_name(key) is not None)
+    return closure
+
+
+def rollup_totals(engine, prices):
+    """以單價向量計算引擎中所有食譜的總成本，子食譜的單價依成本由下往上重算"""
+    prices = prices.copy()
+    recipe_rows = {recipe_name: row for row, recipe_name in enumerate(engine.recipe_names)}
+    sub_columns = [column for material, column in engine.material_names.items() if sub_recipe_name(material) in recipe_rows]
+    sub_rows = [recipe_rows[sub_recipe_name(material)] for material in engine.material_names if sub_recipe_name(material) in recipe_rows]
+    batch_weights = np.bincount(engine.rows, weights=engine.weights, minlength=len(engine.recipe_names))
+    totals = engine.totals(prices)
+    # 子食譜沒有循環時，最多重算「食譜數量」次就會穩定
+    for _ in range(len(engine.recipe_names) if sub_columns else 0):
+        unit_costs = np.divide(totals[sub_rows], batch_weights[sub_rows], out=np.zeros(len(sub_rows)), where=batch_weights[sub_rows] > 0)
+        if np.array_equal(prices[sub_columns], unit_costs):
+            break
+        prices[sub_columns] = unit_costs
+        totals = engine.totals(prices)
+    return totals
+
+
+def costs_as_of(engine, when):
+    """以某個時間點的材料單價重算引擎中所有食譜的總成本（沒有價格歷史的材料使用目前單價）"""
+    materials = st.session_state.saved_materials
+    prices = np.array([
+        price_as_of(material, when, materials.get(material, np.nan))
+        for material in engine.material_names
+    ], dtype=float)
+    return rollup_totals(engine, prices)
+
+
+def apply_price_adjustments(materials, adjustments):
+    """套用假設的單價調整（不儲存），回傳調整後的 材料名稱 -> 單價
+
+    每個調整為 {"materials": [...], "mode": "percent" 或 "price", "value": 數值}，依序套用。
+    """
+    prices = dict(materials)
+    for adjustment in adjustments:
+        for material in adjustment['materials']:
+            if material not in prices:
+                continue
+            if adjustment['mode'] == "percent":
+                prices[material] = prices[material] * (1 + adjustment['value'] / 100)
+            else:
+                prices[material] = adjustment['value']
+    return prices
+
+
+def simulate_price_adjustments(adjustments):
+    """以整個食譜目錄的成本引擎一次計算調整前後的成本，回傳依影響金額排序的 DataFrame"""
+    engine = get_cost_engine()
+    materials = st.session_state.saved_materials
+    current = rollup_totals(engine, engine.price_vector(materials))
+    simulated = rollup_totals(engine, engine.price_vector(apply_price_adjustments(materials, adjustments)))
+    delta = simulated - current
+    changed = ~np.isclose(delta, 0)
+    result = pd.DataFrame({
+        "食譜名稱": np.array(engine.recipe_names, dtype=object)[changed],
+        "目前成本": current[changed],
+        "模擬成本": simulated[changed],
+        "差額": delta[changed],
+        "變動 %": np.divide(delta, current, out=np.full_like(delta, np.nan), where=current != 0)[changed] * 100,
+    })
+    return result.reindex(result["差額"].abs().sort_values(ascending=False).index).reset_index(drop=True)
+
+
+def recipe_cost_as_of(recipe_name, day):
+    """食譜在某一天（以當天結束時的單價）的總成本"""
+    engine = RecipeCostEngine(sub_recipe_closure(recipe_name))
+    return float(costs_as_of(engine, as_of_key(day))[0])
+
+
+def recipe_cost_trend(recipe_name):
+    """食譜成本走勢：在用到的材料每次改價的時間點重算成本，回傳以時間為索引的 Series"""
+    engine = RecipeCostEngine(sub_recipe_closure(recipe_name))
+    history = st.session_state.material_price_history
+    change_times = sorted({
+        recorded_at
+        for material in engine.material_names
+        for recorded_at in history.get(material, ([], []))[0]
+    })
+    costs = [float(costs_as_of(engine, recorded_at)[0]) for recorded_at in change_times]
+    return pd.Series(costs, index=pd.to_datetime(change_times), name="總成本")
+
+
+def recost_recipes_for_material(material, new_name=None, price=None):
+    """材料改名、改價或刪除後，只重算並儲存使用該材料的食譜
+
+    new_name 為 None 時表示材料已刪除：從食譜中移除該材料，食譜沒有材料時一併刪除。
+    回傳 (重算過的食譜, 被刪除的食譜)。
+    """
+    ensure_data_loaded("recipes")
+    recipes = st.session_state.saved_recipes
+    updated_recipes = []
+    emptied_recipes = []
+    for recipe_name in list(get_material_index().get(material, ())):
+        recipe_data = recipes.get(recipe_name)
+        if recipe_data is None or material not in recipe_data['materials']:
+            continue
+        if new_name is None:
+            # 移除材料，沒有材料了就刪除整個食譜
+            del recipe_data['materials'][material]
+            if not recipe_data['materials']:
+                del recipes[recipe_name]
+                emptied_recipes.append(recipe_name)
+                continue
+        else:
+            # 更新材料名稱（如果名稱改變）與價格
+            if new_name != material:
+                recipe_data['materials'][new_name] = recipe_data['materials'].pop(material)
+            recipe_data['materials'][new_name]['price'] = price
+        updated_recipes.append(recipe_name)
+    
+    # 一次重算所有受影響食譜的成本
+    RecipeCostEngine({recipe_name: recipes[recipe_name] for recipe_name in updated_recipes}).apply()
+    if updated_recipes or emptied_recipes:
+        save_recipes_data(changed=updated_recipes, deleted=emptied_recipes)
+    # 改名時價格歷史跟著移到新名稱（刪除的材料保留歷史，過去的成本仍查得到）
+    if new_name is not None and new_name != material:
+        rename_price_history(material, new_name)
+    return updated_recipes, emptied_recipes
 
 
-# 載入記帳資料
-def load_accounting_data():
-    try:
-        # 嘗試從 Google Sheets 載入
-        sheet = get_google_sheet()
-        if sheet:
-            # 嘗試取得記帳工作表
+def recost_recipes_for_prices(prices):
+    """多個材料同時改價後（材料名稱 -> 每克單價），一次重算並儲存所有使用這些材料的食譜，回傳重算過的食譜"""
+    ensure_data_loaded("recipes")
+    recipes = st.session_state.saved_recipes
+    index = get_material_index()
+    updated_recipes = {}
+    for material, price in prices.items():
+        for recipe_name in index.get(material, ()):
+            line = recipes.get(recipe_name, {}).get('materials', {}).get(material)
+            if line is not None:
+                line['price'] = price
+                updated_recipes[recipe_name] = None
+    if updated_recipes:
+        recost_recipe_levels(list(updated_recipes))
+        save_recipes_data(changed=list(updated_recipes))
+    return list(updated_recipes)
+
+
+# 解析記帳工作表的資料列
+def parse_accounting_rows(data):
+    records = []
+    
+    for row in data:
+        if row.get('ID'):
             try:
-                worksheet = sheet.worksheet("記帳")
-            except:
-                # 如果不存在，創建新的
-                worksheet = sheet.add_worksheet(title="記帳", rows=1000, cols=15)
-                # 寫入標題
-                worksheet.append_row([
-                    'ID', '日期', '類型', '類別', '細項', '金額', 
-                    '地點', '購買人', '產品', '備註', '創建時間'
-                ])
-            
-            # 讀取資料
-            data = worksheet.get_all_records()
-            records = []
-            
-            for row in data:
-                if row.get('ID'):
-                    try:
-                        record = {
-                            "id": row['ID'],
-                            "date": row.get('日期', ''),
-                            "type": row.get('類型', ''),
-                            "category": row.get('類別', ''),
-                            "description": row.get('細項', ''),
-                            "amount": float(row.get('金額', 0)),
-                            "location": row.get('地點', ''),
-                            "buyer": row.get('購買人', ''),
-                            "product": row.get('產品', ''),
-                            "remark": row.get('備註', ''),
-                            "created_at": row.get('創建時間', datetime.now().isoformat())
-                        }
-                        records.append(record)
-                    except Exception as e:
-                        st.warning(f"解析記帳記錄時發生錯誤：{e}")
-                        continue
-            
-            return records
-    except Exception as e:
-        st.error(f"從 Google Sheets 載入記帳資料時發生錯誤：{e}")
+                # 以 UNFORMATTED_VALUE 讀取時手動輸入的日期會是序號、文字欄位可能是數字
+                record = {
+                    "id": str(row['ID']),
+                    "date": sheet_text(row.get('日期', '')),
+                    "type": str(row.get('類型', '')),
+                    "category": str(row.get('類別', '')),
+                    "description": str(row.get('細項', '')),
+                    "amount": float(row.get('金額', 0)),
+                    "location": str(row.get('地點', '')),
+                    "buyer": str(row.get('購買人', '')),
+                    "product": str(row.get('產品', '')),
+                    "remark": str(row.get('備註', '')),
+                    "created_at": sheet_text(row.get('創建時間', datetime.now().isoformat()))
+                }
+                records.append(record)
+            except Exception as e:
+                st.warning(f"解析記帳記錄時發生錯誤：{e}")
+                continue
     
-    # 如果 Google Sheets 失敗，嘗試從本地檔案載入
+    return records
+
+
+# 從本地檔案載入記帳資料
+def load_local_accounting():
     if os.path.exists('accounting_records.json'):
         try:
             with open('accounting_records.json', 'r', encoding='utf-8') as f:
@@ -454,111 +2307,466 @@ def load_accounting_data():
     return []
 
 
+# 載入記帳資料（讀取失敗時拋出例外）
+def load_accounting_data():
+    # 取得記帳工作表（共用連線，不存在時自動建立）
+    worksheet = get_active_connection().worksheet("記帳", 1000, 15, ACCOUNTING_HEADERS)
+    return parse_accounting_rows(worksheet.get_all_records())
+
+
+def accounting_record_to_row(record):
+    """將記帳記錄轉為記帳工作表的一列"""
+    return [
+        record.get('id', ''),
+        record.get('date', ''),
+        record.get('type', ''),
+        record.get('category', ''),
+        record.get('description', ''),
+        record.get('amount', 0),
+        record.get('location', ''),
+        record.get('buyer', ''),
+        record.get('product', ''),
+        record.get('remark', ''),
+        record.get('created_at', '')
+    ]
+
+
+# 產生記帳工作表的寫入計畫（由背景寫入佇列呼叫）
+def plan_accounting_sync(changes):
+    worksheet = get_active_connection().worksheet("記帳", 1000, 15, ACCOUNTING_HEADERS)
+    return plan_row_changes(worksheet, ACCOUNTING_HEADERS, changes)
+
+
 # 儲存記帳資料
-def save_accounting_data():
-    try:
-        # 嘗試儲存到 Google Sheets
-        sheet = get_google_sheet()
-        if sheet:
-            # 嘗試取得記帳工作表
-            try:
-                worksheet = sheet.worksheet("記帳")
-            except:
-                # 如果不存在，創建新的
-                worksheet = sheet.add_worksheet(title="記帳", rows=1000, cols=15)
-                # 寫入標題
-                worksheet.append_row([
-                    'ID', '日期', '類型', '類別', '細項', '金額', 
-                    '地點', '購買人', '產品', '備註', '創建時間'
-                ])
-            
-            # 準備批量資料
-            batch_data = [['ID', '日期', '類型', '類別', '細項', '金額', 
-                          '地點', '購買人', '產品', '備註', '創建時間']]  # 標題行
-            
-            # 添加所有資料到批次
-            for record in st.session_state.accounting_records:
-                batch_data.append([
-                    record.get('id', ''),
-                    record.get('date', ''),
-                    record.get('type', ''),
-                    record.get('category', ''),
-                    record.get('description', ''),
-                    record.get('amount', 0),
-                    record.get('location', ''),
-                    record.get('buyer', ''),
-                    record.get('product', ''),
-                    record.get('remark', ''),
-                    record.get('created_at', '')
-                ])
-            
-            # 清空現有資料並批量寫入
-            worksheet.clear()
-            worksheet.update('A1', batch_data)
-            
-            st.success("✅ 記帳資料已同步到 Google Sheets")
+def save_accounting_data(added=(), updated=(), deleted_ids=(), full_rewrite=False):
+    """儲存記帳資料到本地資料庫並同步到 Google Sheets
+
+    預設只同步變動的列：added 的記錄 append、updated 的記錄依 ID 更新該列、
+    deleted_ids 只刪除對應的列。只有 full_rewrite=True 時才重寫整個工作表。
+    """
+    store = get_local_store()
+    if full_rewrite:
+        # 先寫入本地資料庫，再排入背景同步到 Google Sheets
+        store.replace_accounting(st.session_state.accounting_records)
+        publish_saved_data("accounting")
+        changes = row_changes(full={
+            record.get('id', ''): accounting_record_to_row(record)
+            for record in st.session_state.accounting_records
+        })
+    else:
+        upserts = list(added) + list(updated)
+        if not upserts and not deleted_ids:
             return
-    except Exception as e:
-        st.error(f"儲存記帳資料到 Google Sheets 時發生錯誤：{e}")
+        # 先寫入本地資料庫，再排入背景同步到 Google Sheets
+        store.apply_accounting_changes(upserts, deleted_ids)
+        publish_saved_data("accounting")
+        changes = row_changes(
+            upserts={record.get('id', ''): accounting_record_to_row(record) for record in upserts},
+            deletes=deleted_ids
+        )
+    get_write_behind_queue().submit(
+        "accounting",
+        plan_accounting_sync,
+        changes,
+        merge=merge_row_changes
+    )
+
+# 記帳表格的欄位：記錄欄位 -> 表格欄名（產品以逗號分隔的文字顯示與編輯）
+LEDGER_COLUMNS = {
+    "date": "日期",
+    "type": "類型",
+    "category": "類別",
+    "description": "細項",
+    "amount": "金額",
+    "location": "地點",
+    "buyer": "購買人",
+    "products": "產品",
+    "remark": "備註"
+}
+
+
+def ledger_frame(records):
+    """把記帳記錄轉成表格（第一欄為 ID），日期轉成 date 讓表格可以用日期欄位編輯"""
+    rows = []
+    for record in records:
+        # 相容舊資料格式
+        date_str = record.get('date', record.get('datetime', ''))
+        if 'T' in date_str:  # 如果是datetime格式，只取日期部分
+            date_str = date_str.split('T')[0]
+        products = record.get('products', [])
+        if not products:  # 相容舊格式
+            product = record.get('product', '')
+            products = [product] if product else []
+        rows.append([
+            record.get('id', ''),
+            datetime.fromisoformat(date_str).date(),
+            record['type'],
+            record['category'],
+            record['description'],
+            float(record['amount']),
+            record.get('location', ''),
+            record.get('buyer', ''),
+            ", ".join(products),
+            record.get('remark', '')
+        ])
+    return pd.DataFrame(rows, columns=["ID"] + list(LEDGER_COLUMNS.values()))
+
+
+def diff_ledger_frames(original, edited):
+    """比對編輯前後的記帳表格，驗證有變動的列
+
+    回傳 ({記錄 ID: 變動後的欄位}, 錯誤訊息列表)；沒有錯誤時才應該儲存。
+    """
+    same = (original == edited) | (original.isna() & edited.isna())
+    changed_rows = ~same.all(axis=1)
+    changes = {}
+    errors = []
+    for position in np.flatnonzero(changed_rows.to_numpy()):
+        row = edited.iloc[position]
+        label = f"第 {position + 1} 列"
+        if pd.isna(row["日期"]):
+            errors.append(f"{label}：請輸入日期")
+        if row["類型"] not in ("收入", "支出"):
+            errors.append(f"{label}：類型必須是收入或支出")
+        if pd.isna(row["金額"]) or row["金額"] < 0:
+            errors.append(f"{label}：金額必須大於等於 0")
+        if not row["類別"]:
+            errors.append(f"{label}：請選擇類別")
+        fields = {field: row[column] for field, column in LEDGER_COLUMNS.items()}
+        fields["date"] = fields["date"].isoformat() if pd.notna(fields["date"]) else ''
+        fields["amount"] = float(fields["amount"]) if pd.notna(fields["amount"]) else 0.0
+        fields["products"] = [product.strip() for product in str(fields["products"] or '').split(",") if product.strip()]
+        for field in ("category", "description", "location", "buyer", "remark"):
+            fields[field] = '' if pd.isna(fields[field]) else str(fields[field])
+        changes[row["ID"]] = fields
+    return changes, errors
+
+
+# 產生設定工作表的寫入計畫（由背景寫入佇列呼叫）
+def plan_custom_categories_sync(categories):
+    worksheet = get_active_connection().worksheet("設定", 100, 10, SETTINGS_HEADERS)
     
-    # 如果 Google Sheets 失敗，儲存到本地檔案
-    try:
-        with open('accounting_records.json', 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.accounting_records, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        st.error(f"儲存記帳資料時發生錯誤：{e}")
+    # 準備批量資料
+    batch_data = [SETTINGS_HEADERS]  # 標題行
+    
+    # 添加所有類別到批次
+    for category in categories:
+        batch_data.append([category])
+    
+    # 覆寫工作表（與其他資料集合併成同一批請求）
+    plan = SheetsWritePlan()
+    plan.overwrite(worksheet, batch_data)
+    return plan
+
 
 # 儲存自訂類別
 def save_custom_categories():
-    try:
-        # 嘗試儲存到 Google Sheets
-        sheet = get_google_sheet()
-        if sheet:
-            # 嘗試取得設定工作表
-            try:
-                worksheet = sheet.worksheet("設定")
-            except:
-                # 如果不存在，創建新的
-                worksheet = sheet.add_worksheet(title="設定", rows=100, cols=10)
-                # 寫入標題
-                worksheet.append_row(['類別名稱'])
-            
-            # 準備批量資料
-            batch_data = [['類別名稱']]  # 標題行
-            
-            # 添加所有類別到批次
-            for category in st.session_state.custom_categories:
-                batch_data.append([category])
-            
-            # 清空現有資料並批量寫入
-            worksheet.clear()
-            worksheet.update('A1', batch_data)
-            
-            st.success("✅ 類別設定已同步到 Google Sheets")
-            return
-    except Exception as e:
-        st.error(f"儲存類別設定到 Google Sheets 時發生錯誤：{e}")
+    # 先寫入本地資料庫，再排入背景同步到 Google Sheets
+    get_local_store().replace_categories(st.session_state.custom_categories)
+    publish_saved_data("categories")
+    get_write_behind_queue().submit(
+        "categories",
+        plan_custom_categories_sync,
+        list(st.session_state.custom_categories)
+    )
+
+
+# Google Sheets 日期序號的起始日
+SHEETS_EPOCH = datetime(1899, 12, 30)
+
+
+def sheet_text(value):
+    """把以 UNFORMATTED_VALUE 讀到的文字或日期欄位轉為字串
+
+    在工作表中手動輸入的日期會以日期序號（數字）讀回：整數轉為 ISO 日期，
+    帶小數（包含時間）轉為 ISO 日期時間；其他值轉為字串。
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        moment = SHEETS_EPOCH + timedelta(days=value)
+        if float(value).is_integer():
+            return moment.date().isoformat()
+        return moment.isoformat(timespec='seconds')
+    return str(value)
+
+
+def values_to_records(values):
+    """將工作表的原始值（第一列為標題）轉為與 get_all_records 相同格式的字典列表"""
+    if not values:
+        return []
+    headers = values[0]
+    records = []
+    for row in values[1:]:
+        row = list(row) + [''] * (len(headers) - len(row))
+        records.append(dict(zip(headers, row)))
+    return records
+
+
+# 解析設定工作表的資料列
+def parse_categories_rows(data):
+    return [str(row['類別名稱']) for row in data if row.get('類別名稱')]
+
+
+# 解析設定工作表，沒有資料時使用預設類別
+def parse_categories_or_default(data):
+    return parse_categories_rows(data) or load_custom_categories()
+
+
+# 載入類別設定（讀取失敗時拋出例外，工作表沒有資料時使用本地檔案）
+def load_saved_categories():
+    # 取得設定工作表（共用連線，不存在時自動建立）
+    worksheet = get_active_connection().worksheet("設定", 100, 10, SETTINGS_HEADERS)
+    return parse_categories_or_default(worksheet.get_all_records())
+
+
+# 各資料集對應的 session state 欄位、工作表與載入函式
+# （fallback 為無法連線時的舊版本地資料，只用來填入第一次使用、還是空的本地資料庫；
+#   resync 回傳以本地資料庫整批改寫工作表的 (寫入函式, 內容, 合併函式)，用來補寫尚未同步的資料集）
+DATASETS = {
+    "materials": {
+        "state": "saved_materials",
+        "sheet": ("材料", 1000, 10, MATERIALS_HEADERS),
+        "parse": parse_materials_rows,
+        "bootstrap": load_saved_materials,
+        "fallback": load_local_materials,
+        "resync": lambda store: (plan_materials_sync, store.load_materials(), None)
+    },
+    "material_yields": {
+        "state": "material_default_yields",
+        "sheet": ("熟成率", 1000, 5, MATERIAL_YIELDS_HEADERS),
+        "parse": parse_material_yields_rows,
+        "bootstrap": load_saved_material_yields,
+        "fallback": dict,
+        "resync": lambda store: (plan_material_yields_sync, store.load_material_yields(), None)
+    },
+    "material_units": {
+        "state": "material_units",
+        "sheet": ("採購單位", 1000, 10, MATERIAL_UNITS_HEADERS),
+        "parse": parse_material_units_rows,
+        "bootstrap": load_saved_material_units,
+        "fallback": dict,
+        "resync": lambda store: (plan_material_units_sync, store.load_material_units(), None)
+    },
+    "price_history": {
+        "state": "material_price_history",
+        "sheet": ("價格歷史", 1000, 5, PRICE_HISTORY_HEADERS),
+        "parse": parse_price_history_rows,
+        "bootstrap": load_saved_price_history,
+        "fallback": dict,
+        "resync": lambda store: (plan_price_history_sync, None, merge_price_history_changes)
+    },
+    "recipes": {
+        "state": "saved_recipes",
+        "sheet": ("食譜", 1000, 20, RECIPES_HEADERS),
+        "parse": parse_recipes_rows,
+        "bootstrap": load_saved_recipes,
+        "fallback": load_local_recipes,
+        "resync": lambda store: (
+            plan_recipes_sync, row_changes(full=recipes_to_rows(store.load_recipes())), merge_row_changes
+        )
+    },
+    "accounting": {
+        "state": "accounting_records",
+        "sheet": ("記帳", 1000, 15, ACCOUNTING_HEADERS),
+        "parse": parse_accounting_rows,
+        "bootstrap": load_accounting_data,
+        "fallback": load_local_accounting,
+        "resync": lambda store: (
+            plan_accounting_sync,
+            row_changes(full={record.get('id', ''): accounting_record_to_row(record) for record in store.load_accounting()}),
+            merge_row_changes
+        )
+    },
+    "categories": {
+        "state": "custom_categories",
+        "sheet": ("設定", 100, 10, SETTINGS_HEADERS),
+        "parse": parse_categories_or_default,
+        "bootstrap": load_saved_categories,
+        "fallback": load_custom_categories,
+        "resync": lambda store: (plan_custom_categories_sync, store.load_categories(), None)
+    }
+}
+
+
+# 一次載入所有資料
+def load_all_data():
+    """以單一 values batchGet 讀取所有資料集的工作表
+
+    只回傳實際讀到的資料集，尚未建立的工作表不在結果中（保留本地資料）；
+    讀取失敗時直接拋出例外，不會以本地檔案或空資料取代。
+    """
+    connection = get_active_connection()
+    # 先取得既有的工作表清單，避免缺少工作表時整個 batchGet 失敗
+    existing = {worksheet.title for worksheet in connection.spreadsheet.worksheets()}
+    datasets = [dataset for dataset, config in DATASETS.items() if config['sheet'][0] in existing]
+    if not datasets:
+        return {}
     
-    # 如果 Google Sheets 失敗，儲存到本地檔案
+    response = connection.spreadsheet.values_batch_get(
+        [DATASETS[dataset]['sheet'][0] for dataset in datasets],
+        params={"valueRenderOption": "UNFORMATTED_VALUE"}
+    )
+    return {
+        dataset: DATASETS[dataset]['parse'](values_to_records(value_range.get('values', [])))
+        for dataset, value_range in zip(datasets, response['valueRanges'])
+    }
+
+
+def get_sheets_revision():
+    """取得 spreadsheet 在 Drive 上的最後修改時間，作為資料版本"""
+    return get_active_connection().spreadsheet.get_lastUpdateTime()
+
+
+def read_sheets_revision():
+    """讀取目前的版本，無法取得時回傳 None"""
     try:
-        with open('custom_categories.json', 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.custom_categories, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        st.error(f"儲存自訂類別時發生錯誤：{e}")
+        return get_sheets_revision()
+    except Exception:
+        return None
+
+
+def record_sheets_revision(previous):
+    """背景同步完成後記錄新的版本，避免自己的寫入被誤判為外部修改而重新下載
+
+    previous 為寫入前讀到的版本：只有它與已記錄的版本相同（寫入前沒有外部修改）時才更新；
+    否則保留舊版本，讓下一個 session 把沒有未同步變更的資料集標記為過期並重新下載。
+    """
+    store = get_local_store()
+    if previous is None or previous != store.get_meta('sheets_revision'):
+        return
+    store.set_meta('sheets_revision', get_sheets_revision())
+
+
+def download_to_store(revision=None):
+    """從 Google Sheets 下載所有資料並覆蓋本地資料庫
+
+    讀取失敗時拋出例外且不變動本地資料庫，只覆蓋實際讀到的資料集。
+    """
+    store = get_local_store()
+    all_data = load_all_data()
+    store.replace_all(all_data)
+    if revision:
+        store.set_meta('sheets_revision', revision)
+    # 直接發布下載的資料，所有 session 在下次 rerun 時改用
+    cache = get_shared_data_cache()
+    for dataset, data in all_data.items():
+        cache.publish(dataset, data)
+    return all_data
+
+
+def check_sheets_revision():
+    """每個 session 開始時檢查一次 Google Sheets 的版本
+
+    資料庫第一次使用或版本變動時，只把資料集標記為過期，
+    實際下載延後到頁面第一次用到該資料集時（只下載該工作表）。
+    """
+    store = get_local_store()
+    # 啟動背景佇列（會補寫上次程序結束前尚未同步的資料集）
+    get_write_behind_queue()
+    try:
+        revision = get_sheets_revision()
+    except Exception:
+        revision = None
+    if store.get_meta('initialized') != '1':
+        store.mark_stale(DATASETS, 'bootstrap')
+        store.set_meta('initialized', '1')
+    elif revision and revision != store.get_meta('sheets_revision'):
+        # 還有尚未同步的本地變更的資料集以本地資料為準，不重新下載
+        dirty = set(store.dirty_datasets())
+        store.mark_stale([dataset for dataset in DATASETS if dataset not in dirty], 'changed')
+    else:
+        return
+    if revision:
+        store.set_meta('sheets_revision', revision)
+
+
+def refresh_stale_dataset(dataset):
+    """資料集被標記為過期時，只從 Google Sheets 下載該工作表並寫入本地資料庫
+
+    回傳是否實際更新了本地資料庫。
+    """
+    store = get_local_store()
+    stale = store.get_meta(f'stale:{dataset}')
+    if not stale:
+        return False
+    config = DATASETS[dataset]
+    # 本地還有尚未同步的變更時（包含程序重新啟動前留下的），以本地資料為準，稍後再下載
+    if store.is_dirty(dataset):
+        return False
+    if stale == 'bootstrap':
+        # 第一次使用：從 Google Sheets 匯入
+        try:
+            data = config['bootstrap']()
+        except Exception as e:
+            st.error(f"從 Google Sheets 載入{WriteBehindQueue.DATASET_LABELS[dataset]}時發生錯誤：{e}")
+            # 保留過期標記讓下一個 session 重試；本地資料庫還是空的時先匯入舊的本地檔案
+            with store.lock:
+                fallback = config['fallback']()
+                if not fallback or getattr(store, f'load_{dataset}')():
+                    return False
+                getattr(store, f'replace_{dataset}')(fallback)
+            return True
+        if not data:
+            # 工作表沒有資料時保留本地資料庫（可能已匯入舊的本地檔案）
+            store.set_meta(f'stale:{dataset}', None)
+            return False
+    else:
+        try:
+            worksheet = get_active_connection().worksheet(*config['sheet'])
+            data = config['parse'](worksheet.get_all_records(value_render_option="UNFORMATTED_VALUE"))
+        except Exception as e:
+            st.error(f"從 Google Sheets 更新{WriteBehindQueue.DATASET_LABELS[dataset]}時發生錯誤：{e}")
+            return False
+    with store.lock:
+        getattr(store, f'replace_{dataset}')(data)
+        store.set_meta(f'stale:{dataset}', None)
+    return True
+
+
+def ensure_data_loaded(*datasets):
+    """依頁面需要才載入資料集，資料來自全程序共用的快取
+
+    session 第一次用到資料集時才檢查是否需要從 Google Sheets 更新；
+    之後每次 rerun 只比對版本，其他 session 儲存過時才改用新資料。
+    """
+    if 'dataset_versions' not in st.session_state:
+        check_sheets_revision()
+        st.session_state.dataset_versions = {}
+    store = get_local_store()
+    cache = get_shared_data_cache()
+    for dataset in datasets:
+        if dataset not in st.session_state.dataset_versions and refresh_stale_dataset(dataset):
+            cache.invalidate(dataset)
+        version, data = cache.get(dataset, getattr(store, f'load_{dataset}'))
+        if st.session_state.dataset_versions.get(dataset) != version:
+            # 快取是所有 session 共用的快照，session 各自複製一份再修改
+            st.session_state[DATASETS[dataset]['state']] = copy.deepcopy(data)
+            st.session_state.dataset_versions[dataset] = version
+
+
+def publish_saved_data(dataset, derived=None):
+    """儲存後把 session 資料的快照發布到共用快取，讓其他 session 下次 rerun 時取得"""
+    data = copy.deepcopy(st.session_state[DATASETS[dataset]['state']])
+    version = get_shared_data_cache().publish(dataset, data, derived)
+    st.session_state.setdefault('dataset_versions', {})[dataset] = version
 
 
-# 載入已儲存的材料
-if not st.session_state.saved_materials:
-    st.session_state.saved_materials = load_saved_materials()
+def reload_from_google_sheets():
+    """從 Google Sheets 重新載入所有資料；版本未變動時直接使用本地快照
 
+    回傳是否實際下載了資料。
+    """
+    store = get_local_store()
+    revision = get_sheets_revision()
+    if revision == store.get_meta('sheets_revision'):
+        return False
+    download_to_store(revision)
+    return True
 
-# 載入已儲存的食譜
-if not st.session_state.saved_recipes:
-    st.session_state.saved_recipes = load_saved_recipes()
 
-# 載入記帳資料
-if not st.session_state.accounting_records:
-    st.session_state.accounting_records = load_accounting_data()
+# 材料是大部分頁面都會用到的資料，其餘資料集由各頁面需要時才載入
+ensure_data_loaded("materials", "material_yields")
 
 # 標題
 st.markdown("""
@@ -588,6 +2796,10 @@ with st.sidebar:
         st.session_state.current_page = "食譜區"
         st.rerun()
     
+    if st.button("🏭 生產計畫", use_container_width=True, type="primary" if st.session_state.current_page == "生產計畫" else "secondary"):
+        st.session_state.current_page = "生產計畫"
+        st.rerun()
+    
     if st.button("📊 記帳區", use_container_width=True, type="primary" if st.session_state.current_page == "記帳區" else "secondary"):
         st.session_state.current_page = "記帳區"
         st.rerun()
@@ -598,8 +2810,12 @@ with st.sidebar:
     st.markdown("### 📤 資料匯出")
     if st.button("📥 下載所有資料", key="download_btn", use_container_width=True):
         # 準備下載資料
+        ensure_data_loaded("material_units", "price_history", "recipes", "accounting")
         download_data = {
             "materials": st.session_state.saved_materials,
+            "material_yields": st.session_state.material_default_yields,
+            "material_units": st.session_state.material_units,
+            "price_history": st.session_state.material_price_history,
             "recipes": st.session_state.saved_recipes,
             "accounting": st.session_state.accounting_records
         }
@@ -635,13 +2851,21 @@ with st.sidebar:
                 st.session_state.saved_materials = uploaded_data['materials']
                 save_materials_data()
             
+            if 'material_yields' in uploaded_data:
+                st.session_state.material_default_yields = uploaded_data['material_yields']
+                save_material_yields_data()
+            
+            if 'material_units' in uploaded_data:
+                st.session_state.material_units = uploaded_data['material_units']
+                save_material_units_data()
+            
             if 'recipes' in uploaded_data:
                 st.session_state.saved_recipes = uploaded_data['recipes']
-                save_recipes_data()
+                save_recipes_data(full_rewrite=True)
             
             if 'accounting' in uploaded_data:
                 st.session_state.accounting_records = uploaded_data['accounting']
-                save_accounting_data()
+                save_accounting_data(full_rewrite=True)
             
             st.success("✅ 資料匯入成功！")
             st.rerun()
@@ -658,54 +2882,89 @@ with st.sidebar:
     with col1:
         if st.button("📤 上傳到 Google Sheets", use_container_width=True):
             try:
+                ensure_data_loaded(*DATASETS)
                 save_materials_data()
-                save_recipes_data()
-                save_accounting_data()
+                save_material_yields_data()
+                save_material_units_data()
+                save_recipes_data(full_rewrite=True)
+                save_accounting_data(full_rewrite=True)
                 save_custom_categories()
-                st.success("✅ 所有資料已同步到 Google Sheets")
+                st.success("✅ 所有資料已排入背景同步到 Google Sheets")
             except Exception as e:
                 st.error(f"同步失敗：{e}")
     
     with col2:
         if st.button("📥 從 Google Sheets 載入", use_container_width=True):
             try:
-                st.session_state.saved_materials = load_saved_materials()
-                st.session_state.saved_recipes = load_saved_recipes()
-                st.session_state.accounting_records = load_accounting_data()
-                st.session_state.custom_categories = load_custom_categories()
-                st.success("✅ 已從 Google Sheets 載入所有資料")
-                st.rerun()
+                if get_local_store().dirty_datasets():
+                    st.warning("⚠️ 尚有資料正在同步到 Google Sheets，請稍後再載入")
+                elif reload_from_google_sheets():
+                    st.success("✅ 已從 Google Sheets 載入所有資料")
+                    st.rerun()
+                else:
+                    st.success("✅ Google Sheets 沒有變更，已使用本地資料")
+                    st.rerun()
             except Exception as e:
                 st.error(f"載入失敗：{e}")
     
+    # 背景同步狀態
+    sync_status = get_write_behind_queue().status()
+    if sync_status['waiting']:
+        st.caption(f"🔄 同步中：{'、'.join(sync_status['waiting'])}")
+    elif sync_status['last_error']:
+        st.caption(f"⚠️ 同步失敗，資料已存於本地，稍後自動重試（{sync_status['last_error']}）")
+    elif sync_status['last_synced_at']:
+        st.caption(f"✅ 已同步（{sync_status['last_synced_at'].strftime('%H:%M:%S')}）")
+    request_stats = get_request_scheduler().stats()
+    throttled_note = f"，限流重試 {request_stats['throttled']} 次" if request_stats['throttled'] else ""
+    st.caption(f"📈 Sheets 請求：{request_stats['calls']} / {request_stats['quota']} 每分鐘{throttled_note}")
+    
     st.markdown('</div>', unsafe_allow_html=True)
 
-# 根據選擇的頁面顯示不同內容
-if st.session_state.current_page == "成本計算":
-    # 成本計算頁面
-    st.markdown("### 成本計算", help="選擇多個材料並計算總成本")
-    
+@st.fragment
+def render_cost_calculator():
+    """成本計算頁面的材料選擇與克數輸入；在 fragment 中執行，輸入時只重新執行這個區塊"""
     # 多材料選擇介面
     if st.session_state.saved_materials:
-        # 預先計算材料列表，避免重複計算
-        material_options = get_material_options(st.session_state.saved_materials)
+        # 預先計算材料列表，避免重複計算；已儲存的食譜也可以當作材料（子食譜）
+        material_options = get_material_options(st.session_state.saved_materials) + [
+            sub_recipe_key(recipe_name) for recipe_name in st.session_state.saved_recipes
+        ]
         
         st.markdown("#### 選擇材料（可多選）")
         
-        # 使用複選框選擇材料
-        selected_materials = []
+        # 以搜尋索引找出要顯示的材料，只為這些材料建立複選框
+        search_query = st.text_input(
+            "搜尋材料",
+            placeholder="輸入名稱、拼音或注音" if lazy_pinyin is not None else "輸入材料名稱",
+            key="material_search",
+            label_visibility="collapsed"
+        )
+        matched_materials = get_material_search_index().search(search_query, st.session_state.starred_materials)
+        shown_materials = matched_materials[:MATERIAL_PICKER_LIMIT]
+        if len(matched_materials) > len(shown_materials):
+            st.caption(f"顯示 {len(shown_materials)} / {len(matched_materials)} 個材料，請輸入名稱搜尋其他材料")
+        elif search_query and not matched_materials:
+            st.caption("找不到符合的材料")
+        
+        # 使用複選框選擇材料；沒有顯示的材料保留原本的選擇
+        shown_set = set(shown_materials)
+        selected_materials = [
+            material for material in st.session_state.selected_materials
+            if material not in shown_set and material in material_options
+        ]
         
         # 創建兩列佈局來顯示材料選項
         col1, col2 = st.columns(2)
         
-        for i, material in enumerate(material_options):
+        for i, material in enumerate(shown_materials):
             # 交替分配到兩列
             with col1 if i % 2 == 0 else col2:
                 # 檢查是否已選中
                 is_selected = material in st.session_state.selected_materials
 
                 # 使用複選框
-                price_display = st.session_state.saved_materials[material]
+                price_display = round(get_ingredient_price(material), 4)
                 if price_display is not None and price_display == int(price_display):
                     price_display = int(price_display)
 
@@ -740,7 +2999,7 @@ if st.session_state.current_page == "成本計算":
                     else:
                         st.session_state.selected_materials = material_options.copy()
                         st.success("✅ 已全選所有材料")
-                        st.rerun()
+                        st.rerun(scope="fragment")
 
             with col_clear_all:
                 # 檢查是否在確認清除狀態
@@ -752,26 +3011,25 @@ if st.session_state.current_page == "成本計算":
                             st.session_state.selected_materials = []
                             st.session_state.show_clear_confirm = False
                             st.success("✅ 已清除所有選擇")
-                            st.rerun()
+                            st.rerun(scope="fragment")
                     with col_cancel:
                         if st.button("取消", key="cancel_clear_all", use_container_width=True):
                             st.session_state.show_clear_confirm = False
                             st.info("❌ 已取消清除操作")
-                            st.rerun()
+                            st.rerun(scope="fragment")
                 else:
                     if st.button("清除選擇", use_container_width=True, key="clear_all_btn"):
                         if not st.session_state.selected_materials:
                             st.info("✅ 已經沒有選擇任何材料")
                         else:
                             st.session_state.show_clear_confirm = True
-                            st.rerun()
+                            st.rerun(scope="fragment")
 
         if selected_materials:
             st.markdown("---")
             st.markdown("#### 材料重量輸入")
 
             # 為每個選中的材料創建重量輸入
-            total_cost = 0
             recipe_materials = {}
 
             # 根據材料數量決定列數
@@ -780,13 +3038,15 @@ if st.session_state.current_page == "成本計算":
             else:
                 cols = st.columns(3)  # 最多3列
             
+            effective_prices = get_effective_prices()
             for i, material in enumerate(selected_materials):
-                price = st.session_state.saved_materials[material]
+                price = get_ingredient_price(material)
+                default_yield = st.session_state.material_default_yields.get(material)
                 col_index = i % len(cols)
                 
                 with cols[col_index]:
                     # 創建材料卡片
-                    price_display = price
+                    price_display = round(price, 4)
                     if price_display is not None and price_display == int(price_display):
                         price_display = int(price_display)
                     
@@ -800,10 +3060,18 @@ if st.session_state.current_page == "成本計算":
                     # 檢查是否為標記的材料，如果是則加上星號
                     is_starred = material in st.session_state.starred_materials
                     star_prefix = "⭐ " if is_starred else ""
+                    # 有預設熟成率的材料另外顯示每克有效單價
+                    effective_price_html = ""
+                    if default_yield is not None:
+                        effective_price_html = (
+                            f"<p><strong>有效單價：</strong>NT$ {effective_prices.get(material, price):.4f} / 1g"
+                            f"（熟成率 {default_yield:g}）</p>"
+                        )
                     st.markdown(f"""
                     <div class="metric-card">
                         <h4>{star_prefix}{safe_material_name}</h4>
                         <p><strong>單價：</strong>NT$ {price_display} / 1g</p>
+                        {effective_price_html}
                     </div>
                     """, unsafe_allow_html=True)
 
@@ -822,15 +3090,18 @@ if st.session_state.current_page == "成本計算":
                         placeholder="克數"
                     )
                     
-                    # 熟成率勾選（固定0.8）
-                    current_yield_enabled = st.session_state.material_yield_rates.get(
-                        material, False
+                    # 熟成率（預設為材料的預設熟成率，可針對這次計算覆寫；1 表示不使用熟成率）
+                    current_yield = st.session_state.material_yield_rates.get(
+                        material, default_yield or 1.0
                     )
-                    yield_enabled = st.checkbox(
-                        " 使用熟成率 (0.8)",
-                        value=current_yield_enabled,
+                    yield_rate = st.number_input(
+                        f"{safe_material_name} 熟成率",
+                        min_value=0.01,
+                        max_value=1.0,
+                        value=float(current_yield),
+                        step=0.05,
                         key=safe_yield_key,
-                        help=f"勾選後 {safe_material_name} 將使用 0.8 的熟成率計算"
+                        help=f"{safe_material_name} 的預設熟成率為 {default_yield or 1.0:g}，1 表示不使用熟成率"
                     )
                     
                     # 轉換為數字
@@ -843,30 +3114,18 @@ if st.session_state.current_page == "成本計算":
                     if weight != current_weight:
                         st.session_state.material_weights[material] = weight
                     
-                    # 只在熟成率勾選狀態改變時更新session state
-                    if yield_enabled != current_yield_enabled:
-                        st.session_state.material_yield_rates[material] = yield_enabled
-                    
-                    # 計算單個材料成本（考慮熟成率）
-                    if yield_enabled:
-                        # 使用固定熟成率0.8計算：重量 / 0.8 * 單價
-                        adjusted_weight = weight / 0.8
-                        material_cost = adjusted_weight * price
-                        yield_rate = 0.8
-                    else:
-                        # 原本的計算：重量 * 單價
-                        material_cost = weight * price
-                        yield_rate = None
+                    # 只在熟成率改變時更新session state
+                    if yield_rate != current_yield:
+                        st.session_state.material_yield_rates[material] = yield_rate
                     
-                    total_cost += material_cost
                     recipe_materials[material] = {
                         "weight": weight,
                         "price": price,
-                        "cost": material_cost,
-                        "yield_rate": yield_rate,
-                        "adjusted_weight": weight / yield_rate if yield_rate is not None and yield_rate > 0 else weight
+                        "yield_rate": normalize_yield_rate(yield_rate) if yield_rate < 1 else None
                     }
 
+            # 以成本引擎計算每個材料的成本與總成本
+            total_cost = cost_recipe_lines(recipe_materials)
 
 
             # 檢查是否有輸入克數
@@ -1000,33 +3259,551 @@ if st.session_state.current_page == "成本計算":
                 # 保存按鈕
                 if recipe_name:
                     if st.button("保存食譜", type="secondary", use_container_width=True, key="save_recipe_btn"):
-                        # 檢查是否已存在同名食譜
-                        if recipe_name in st.session_state.saved_recipes:
-                            st.warning(f"⚠️ 食譜「{recipe_name}」已存在，將覆蓋原有食譜")
-                        
-                        # 保存食譜
-                        recipe_data = {
-                            "materials": recipe_materials,
-                            "total_cost": total_cost,
-                            "created_at": get_taiwan_time().isoformat()
-                        }
-                        st.session_state.saved_recipes[recipe_name] = recipe_data
-                        save_recipes_data()
-                        
-                        # 設置成功狀態
-                        st.session_state.show_save_success = True
-                        st.session_state.saved_recipe_name = recipe_name
-                        st.success(f"✅ 食譜「{recipe_name}」保存成功！")
-                        st.rerun()
+                        # 檢查子食譜是否會造成循環引用
+                        cycle = find_recipe_cycle(recipe_name, recipe_materials)
+                        if cycle:
+                            st.error(f"❌ 食譜不能直接或間接使用自己：{' → '.join(cycle)}")
+                        else:
+                            # 檢查是否已存在同名食譜
+                            if recipe_name in st.session_state.saved_recipes:
+                                st.warning(f"⚠️ 食譜「{recipe_name}」已存在，將覆蓋原有食譜")
+                            
+                            # 保存食譜
+                            recipe_data = {
+                                "materials": recipe_materials,
+                                "total_cost": total_cost,
+                                "created_at": get_taiwan_time().isoformat()
+                            }
+                            st.session_state.saved_recipes[recipe_name] = recipe_data
+                            save_recipes_data(changed=[recipe_name])
+                            
+                            # 設置成功狀態
+                            st.session_state.show_save_success = True
+                            st.session_state.saved_recipe_name = recipe_name
+                            st.success(f"✅ 食譜「{recipe_name}」保存成功！")
+                            st.rerun()
                 else:
                     st.info("先輸入食譜名稱才能保存")
     else:
-        st.markdown("""
-        <div class="warning-message">
-            <h4>尚未新增材料</h4>
-            <p>先在「材料管理」頁面新增常用的材料！</p>
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown("""
+        <div class="warning-message">
+            <h4>尚未新增材料</h4>
+            <p>先在「材料管理」頁面新增常用的材料！</p>
+        </div>
+        """, unsafe_allow_html=True)
+
+
+@st.fragment
+def render_recipe_editor():
+    """食譜編輯區；在 fragment 中執行，修改克數、單價或熟成率時只重新執行這個區塊並即時更新成本"""
+    # 檢查是否在編輯食譜模式
+    if hasattr(st.session_state, 'editing_recipe') and st.session_state.editing_recipe:
+        st.markdown(f"#### 編輯食譜：{st.session_state.editing_recipe}")
+        
+        # 編輯食譜（不使用表單，修改克數或單價時即時更新成本）
+        edited_recipe_name = st.text_input(
+            "食譜名稱",
+            value=st.session_state.editing_recipe,
+            label_visibility="visible",
+            key=f"edit_recipe_name_{st.session_state.editing_recipe}"
+        )
+        
+        # 顯示材料列表（可編輯）
+        st.markdown("#### 材料清單")
+        recipe_data = st.session_state.editing_recipe_data
+        edited_materials = {}
+        cost_placeholders = {}
+        
+        for material, data in recipe_data['materials'].items():
+            st.markdown(f"**{material}**")
+            col1, col2, col3 = st.columns(3)
+            
+            with col1:
+                weight = st.number_input(
+                    f"{material} 重量 (g)",
+                    value=float(data['weight']),
+                    min_value=0.0,
+                    step=1.0,
+                    key=f"edit_weight_{material}"
+                )
+            
+            with col2:
+                price = st.number_input(
+                    f"{material} 單價",
+                    value=float(data['price']),
+                    min_value=0.0,
+                    step=0.01,
+                    key=f"edit_price_{material}"
+                )
+            
+            with col3:
+                # 這一列的熟成率（覆寫材料的預設熟成率；1 表示不使用熟成率）
+                yield_rate = st.number_input(
+                    f"{material} 熟成率",
+                    value=normalize_yield_rate(data.get('yield_rate')) or 1.0,
+                    min_value=0.01,
+                    max_value=1.0,
+                    step=0.05,
+                    key=f"edit_yield_{material}"
+                )
+            
+            edited_materials[material] = {
+                "weight": weight,
+                "price": price,
+                "yield_rate": yield_rate if yield_rate < 1 else None
+            }
+            
+            # 成本在所有材料輸入完成後一次計算
+            cost_placeholders[material] = st.empty()
+            st.markdown("---")
+        
+        # 以成本引擎計算每個材料的成本與總成本
+        total_cost = cost_recipe_lines(edited_materials)
+        for material, placeholder in cost_placeholders.items():
+            placeholder.markdown(f"成本：NT$ {edited_materials[material]['cost']:.2f}")
+        st.markdown(f"**總成本：NT$ {total_cost:.2f}**")
+        
+        # 添加提交按鈕
+        col_save, col_cancel = st.columns(2)
+        with col_save:
+            submitted = st.button("儲存修改", type="primary", use_container_width=True, key="save_recipe_edit")
+        with col_cancel:
+            if st.button("取消編輯", use_container_width=True, key="cancel_recipe_edit"):
+                st.session_state.editing_recipe = None
+                st.session_state.editing_recipe_data = None
+                st.rerun(scope="fragment")
+    
+        # 處理儲存
+        if submitted:
+            if edited_recipe_name:
+                # 如果名稱改變，需要檢查是否已存在
+                cycle = find_recipe_cycle(edited_recipe_name, edited_materials)
+                if edited_recipe_name != st.session_state.editing_recipe and edited_recipe_name in st.session_state.saved_recipes:
+                    st.error("食譜名稱已存在！")
+                elif cycle:
+                    st.error(f"❌ 食譜不能直接或間接使用自己：{' → '.join(cycle)}")
+                else:
+                    # 同步更新材料管理的單價
+                    for material, data in edited_materials.items():
+                        if material in st.session_state.saved_materials:
+                            # 更新材料管理中的單價
+                            st.session_state.saved_materials[material] = data['price']
+                    
+                    # 儲存材料資料
+                    save_materials_data()
+                    
+                    # 更新食譜
+                    old_name = st.session_state.editing_recipe
+                    updated_recipe_data = {
+                        "materials": edited_materials,
+                        "total_cost": total_cost,
+                        "created_at": recipe_data['created_at'],
+                        "updated_at": get_taiwan_time().isoformat()
+                    }
+                    
+                    # 如果名稱改變，刪除舊食譜，並更新把它當作子食譜的食譜
+                    renamed_parents = []
+                    if edited_recipe_name != old_name:
+                        del st.session_state.saved_recipes[old_name]
+                        old_key, new_key = sub_recipe_key(old_name), sub_recipe_key(edited_recipe_name)
+                        for parent in list(get_material_index().get(old_key, ())):
+                            parent_materials = st.session_state.saved_recipes.get(parent, {}).get('materials', {})
+                            if old_key in parent_materials:
+                                parent_materials[new_key] = parent_materials.pop(old_key)
+                                renamed_parents.append(parent)
+                    
+                    st.session_state.saved_recipes[edited_recipe_name] = updated_recipe_data
+                    save_recipes_data(changed=[edited_recipe_name] + renamed_parents, deleted=[old_name])
+                    st.session_state.editing_recipe = None
+                    st.session_state.editing_recipe_data = None
+                    # 保持食譜展開狀態（改名時沿用舊名稱的狀態）
+                    st.session_state.recipe_expander_states.pop(old_name, None)
+                    st.session_state.recipe_expander_states[edited_recipe_name] = True
+                    st.success(f"✅ 已更新食譜「{edited_recipe_name}」並同步更新材料管理單價")
+                    # 不刷新頁面，只重新渲染當前部分
+                    st.rerun()
+            else:
+                st.error("請輸入食譜名稱！")
+
+
+@st.fragment
+def render_ledger_page(sorted_records):
+    """記帳記錄的分頁表格與編輯；在 fragment 中執行，換頁、勾選與編輯時只重新執行這個區塊"""
+    # 顯示記帳記錄：只建立目前這一頁的表格，編輯與刪除透過勾選列操作
+    col_page, col_size = st.columns([3, 1])
+    with col_size:
+        page_size = st.selectbox(
+            "每頁筆數",
+            [25, 50, 100, 200],
+            index=1,
+            key="ledger_page_size"
+        )
+        page_count = max(1, -(-len(sorted_records) // page_size))
+    with col_page:
+        page = st.number_input(
+            f"頁數（共 {page_count} 頁，{len(sorted_records)} 筆）",
+            min_value=1,
+            max_value=page_count,
+            value=min(st.session_state.get('ledger_page', 1), page_count),
+            step=1
+        )
+    st.session_state.ledger_page = page
+    page_records = sorted_records[(page - 1) * page_size:page * page_size]
+    
+    page_frame = ledger_frame(page_records)
+    ledger_column_config = {
+        "日期": st.column_config.DateColumn(format="YYYY-MM-DD", required=True),
+        "類型": st.column_config.SelectboxColumn(options=["支出", "收入"], required=True),
+        "類別": st.column_config.SelectboxColumn(options=st.session_state.custom_categories, required=True),
+        "金額": st.column_config.NumberColumn(min_value=0.0, format="NT$ %g", required=True),
+        "產品": st.column_config.TextColumn(help="多個產品以逗號分隔"),
+    }
+    
+    # 批量編輯：直接在表格中修改這一頁的記錄，只儲存有變動的列
+    bulk_edit = st.toggle("批量編輯", key="ledger_bulk_edit")
+    if bulk_edit:
+        with st.form(f"ledger_bulk_edit_{page}_{page_size}"):
+            edited_frame = st.data_editor(
+                page_frame,
+                use_container_width=True,
+                hide_index=True,
+                num_rows="fixed",
+                disabled=["ID"],
+                column_order=list(LEDGER_COLUMNS.values()),
+                column_config=ledger_column_config,
+                key=f"ledger_editor_{page}_{page_size}"
+            )
+            bulk_submitted = st.form_submit_button("💾 儲存變更", type="primary", use_container_width=True)
+        if bulk_submitted:
+            changes, errors = diff_ledger_frames(page_frame, edited_frame)
+            if errors:
+                for error in errors:
+                    st.error(error)
+            elif not changes:
+                st.info("沒有變更")
+            else:
+                updated_records = []
+                for record in page_records:
+                    if record.get('id') in changes:
+                        record.update(changes[record['id']])
+                        updated_records.append(record)
+                save_accounting_data(updated=updated_records)
+                st.success(f"✅ 已更新 {len(updated_records)} 筆記錄")
+                st.rerun()
+        selected_records = []
+    else:
+        ledger_selection = st.dataframe(
+            page_frame,
+            use_container_width=True,
+            hide_index=True,
+            column_order=list(LEDGER_COLUMNS.values()),
+            column_config=ledger_column_config,
+            on_select="rerun",
+            selection_mode="multi-row",
+            key=f"ledger_table_{page}_{page_size}"
+        )
+        selected_records = [page_records[row] for row in ledger_selection.selection.rows if row < len(page_records)]
+    selected_ids = [record.get('id', '') for record in selected_records]
+    
+    # 勾選列的操作
+    col_edit, col_delete = st.columns(2)
+    with col_edit:
+        if st.button("✏️ 編輯所選記錄", disabled=len(selected_records) != 1, use_container_width=True, key="edit_selected_record"):
+            st.session_state.editing_record_id = selected_ids[0]
+            st.rerun(scope="fragment")
+    with col_delete:
+        if st.button(f"🗑️ 刪除所選記錄（{len(selected_records)}）", disabled=not selected_records, use_container_width=True, key="delete_selected_records"):
+            st.session_state.confirming_delete_records = selected_ids
+            st.rerun(scope="fragment")
+    
+    # 刪除確認（只有一組確認按鈕，不再為每筆記錄建立狀態）
+    if st.session_state.get('confirming_delete_records'):
+        delete_ids = set(st.session_state.confirming_delete_records)
+        st.warning(f"⚠️ 確定要刪除 {len(delete_ids)} 筆記錄嗎？")
+        col_confirm, col_cancel = st.columns(2)
+        with col_confirm:
+            if st.button("✅ 確認刪除", key="confirm_delete_records", use_container_width=True):
+                st.session_state.accounting_records = [
+                    r for r in st.session_state.accounting_records
+                    if r.get('id', '') not in delete_ids
+                ]
+                save_accounting_data(deleted_ids=list(delete_ids))
+                st.session_state.confirming_delete_records = None
+                st.success(f"✅ 已刪除 {len(delete_ids)} 筆記錄")
+                st.rerun()
+        with col_cancel:
+            if st.button("❌ 取消", key="cancel_delete_records", use_container_width=True):
+                st.session_state.confirming_delete_records = None
+                st.rerun(scope="fragment")
+    
+    # 編輯表單（只為正在編輯的那一筆記錄建立）
+    record = next(
+        (r for r in st.session_state.accounting_records if r.get('id') and r.get('id') == st.session_state.get('editing_record_id')),
+        None
+    )
+    if record is not None:
+        record_id = record['id']
+        # 內嵌編輯表單
+        with st.container():
+            st.markdown("**📝 編輯記錄**")
+            with st.form(f"inline_edit_{record_id}"):
+                col_edit1, col_edit2 = st.columns(2)
+                
+                with col_edit1:
+                    edit_date = st.date_input(
+                        "日期",
+                        value=datetime.fromisoformat(record['date']).date(),
+                        key=f"edit_date_{record_id}"
+                    )
+                    edit_type = st.selectbox(
+                        "類型",
+                        ["支出", "收入"],
+                        index=0 if record['type'] == "支出" else 1,
+                        key=f"edit_type_{record_id}"
+                    )
+                    edit_category = st.selectbox(
+                        "類別",
+                        st.session_state.custom_categories,
+                        index=st.session_state.custom_categories.index(record['category']) if record['category'] in st.session_state.custom_categories else 0,
+                        key=f"edit_category_{record_id}"
+                    )
+                    edit_description = st.text_input(
+                        "細項",
+                        value=record['description'],
+                        key=f"edit_description_{record_id}"
+                    )
+                    edit_amount = st.number_input(
+                        "金額 (NT$)",
+                        min_value=0.0,
+                        value=float(record['amount']),
+                        key=f"edit_amount_{record_id}"
+                    )
+                
+                with col_edit2:
+                    edit_location = st.text_input(
+                        "地點",
+                        value=record.get('location', ''),
+                        key=f"edit_location_{record_id}"
+                    )
+                    edit_buyer = st.text_input(
+                        "購買人",
+                        value=record.get('buyer', ''),
+                        key=f"edit_buyer_{record_id}"
+                    )
+                    
+                    # 產品選擇
+                    product_options = list(st.session_state.saved_recipes.keys())
+                    current_products = record.get('products', [])
+                    if not current_products:
+                        product = record.get('product', '')
+                        current_products = [product] if product else []
+                    
+                    edit_products = st.multiselect(
+                        "產品（可複選）",
+                        product_options,
+                        # 記錄中的產品對應的食譜可能已被刪除，只預選仍存在的食譜
+                        default=[product for product in current_products if product in product_options],
+                        key=f"edit_products_{record_id}"
+                    )
+                    
+                    edit_remark = st.text_area(
+                        "備註",
+                        value=record.get('remark', ''),
+                        height=80,
+                        key=f"edit_remark_{record_id}"
+                    )
+                
+                col_save, col_cancel = st.columns(2)
+                with col_save:
+                    if st.form_submit_button("💾 儲存", type="primary"):
+                        # 更新記錄
+                        record['date'] = edit_date.isoformat()
+                        record['type'] = edit_type
+                        record['category'] = edit_category
+                        record['description'] = edit_description
+                        record['amount'] = edit_amount
+                        record['location'] = edit_location
+                        record['buyer'] = edit_buyer
+                        record['products'] = edit_products
+                        record['remark'] = edit_remark
+                        
+                        save_accounting_data(updated=[record])
+                        st.session_state.editing_record_id = None
+                        st.success("✅ 記錄已更新")
+                        st.rerun()
+                
+                with col_cancel:
+                    if st.form_submit_button("❌ 取消"):
+                        st.session_state.editing_record_id = None
+                        st.rerun(scope="fragment")
+
+
+# 食譜列表的排序方式：顯示名稱 -> (摘要欄位, 是否遞增)
+RECIPE_SORT_OPTIONS = {
+    "預設順序": ("順序", True),
+    "名稱": ("食譜名稱", True),
+    "成本由高到低": ("總成本", False),
+    "成本由低到高": ("總成本", True),
+    "最近更新": ("更新時間", False),
+}
+
+
+def build_recipe_summary(recipes):
+    """食譜列表的摘要索引：名稱、總成本、材料數與更新時間，不包含材料明細"""
+    return pd.DataFrame({
+        "順序": range(len(recipes)),
+        "食譜名稱": list(recipes),
+        "總成本": [float(recipe_data.get('total_cost') or 0) for recipe_data in recipes.values()],
+        "材料數": [len(recipe_data.get('materials', {})) for recipe_data in recipes.values()],
+        "更新時間": [recipe_data.get('updated_at') or recipe_data.get('created_at', '') for recipe_data in recipes.values()],
+    })
+
+
+def get_recipe_summary():
+    """取得食譜摘要索引；只有食譜儲存後（版本變動）才重建"""
+    return get_shared_data_cache().derived("recipes", "recipe_summary", build_recipe_summary)
+
+
+def render_recipe_details(recipe_name, recipe_data):
+    """展開的食譜才建立的詳細內容：材料清單、成本走勢與操作按鈕"""
+    # 顯示食譜詳細資訊
+    st.markdown(f"**創建時間：** {recipe_data['created_at'][:19]}")
+    if 'updated_at' in recipe_data:
+        st.markdown(f"**最後更新：** {recipe_data['updated_at'][:19]}")
+    st.markdown("---")
+    
+    # 顯示材料列表
+    st.markdown("#### 材料清單")
+    
+    # 添加欄位標題
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.markdown("**材料名稱**")
+    with col2:
+        st.markdown("**克數**")
+    with col3:
+        st.markdown("**單價**")
+    with col4:
+        st.markdown("**成本**")
+    
+    st.markdown("---")
+    
+    for material, data in recipe_data['materials'].items():
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.markdown(f"**{material}**")
+        with col2:
+            st.markdown(f"{data['weight']:.1f} g")
+        with col3:
+            price_display = data['price']
+            if price_display == int(price_display):
+                price_display = int(price_display)
+            st.markdown(f"NT$ {price_display}")
+        with col4:
+            cost_display = data['cost']
+            if cost_display == int(cost_display):
+                cost_display = int(cost_display)
+            else:
+                cost_display = f"{data['cost']:.2f}"
+            st.markdown(f"NT$ {cost_display}")
+    
+    st.markdown("---")
+    total_cost_display = recipe_data['total_cost']
+    if total_cost_display == int(total_cost_display):
+        total_cost_display = int(total_cost_display)
+    else:
+        total_cost_display = f"{recipe_data['total_cost']:.2f}"
+    st.markdown(f"**總成本：NT$ {total_cost_display}**")
+
+    # 成本走勢（依材料價格歷史重算過去的成本）
+    if st.checkbox("📈 成本走勢", key=f"cost_trend_{recipe_name}"):
+        ensure_data_loaded("price_history")
+        try:
+            as_of_day = st.date_input(
+                "查詢日期",
+                value=get_taiwan_time().date(),
+                key=f"cost_as_of_{recipe_name}"
+            )
+            st.markdown(f"{as_of_day} 的成本：NT$ {recipe_cost_as_of(recipe_name, as_of_day):.2f}")
+            cost_trend = recipe_cost_trend(recipe_name)
+            if len(cost_trend) > 1:
+                st.line_chart(cost_trend)
+            else:
+                st.caption("材料價格變動後才會顯示成本走勢")
+        except Exception as e:
+            st.error(f"計算成本走勢失敗: {str(e)}")
+
+    # 操作按鈕
+    col_use, col_edit, col_delete = st.columns(3)
+    with col_use:
+        if st.button("使用此食譜", key=f"use_{recipe_name}", use_container_width=True):
+            st.info(f"🔄 正在載入食譜「{recipe_name}」...")
+            # 將食譜材料載入到成本計算頁面
+            st.session_state.selected_materials = list(recipe_data['materials'].keys())
+            st.session_state.material_weights = {
+                material: data['weight'] 
+                for material, data in recipe_data['materials'].items()
+            }
+            st.session_state.material_yield_rates = {
+                material: normalize_yield_rate(data.get('yield_rate')) or 1.0
+                for material, data in recipe_data['materials'].items()
+            }
+            st.session_state.current_page = "成本計算"
+            st.success(f"✅ 已載入食譜「{recipe_name}」到成本計算頁面")
+            st.rerun()
+
+    with col_edit:
+        if st.button("✏️ 編輯", key=f"edit_recipe_{recipe_name}", use_container_width=True):
+            st.session_state.editing_recipe = recipe_name
+            st.session_state.editing_recipe_data = recipe_data
+            # 保持展開狀態
+            st.session_state.recipe_expander_states[recipe_name] = True
+            st.rerun()
+
+    with col_delete:
+        # 檢查是否在確認刪除狀態
+        if st.session_state.get(f'show_delete_recipe_modal_{recipe_name}', False):
+            # 被其他食譜當作子食譜使用時不能刪除，否則上層食譜會留下失效的材料列
+            parents = [
+                parent for parent in get_material_index().get(sub_recipe_key(recipe_name), ())
+                if parent in st.session_state.saved_recipes and parent != recipe_name
+            ]
+            if parents:
+                st.error(
+                    f"❌ 食譜「{recipe_name}」被以下食譜當作子食譜使用，"
+                    f"請先從這些食譜移除「{sub_recipe_key(recipe_name)}」再刪除：{'、'.join(parents)}"
+                )
+            else:
+                st.warning(f"⚠️ 確定要刪除食譜「{recipe_name}」嗎？此操作無法復原！")
+            col_confirm, col_cancel = st.columns(2)
+            with col_confirm:
+                if st.button("確認刪除", key=f"confirm_del_recipe_{recipe_name}", disabled=bool(parents), use_container_width=True):
+                    del st.session_state.saved_recipes[recipe_name]
+                    # 移除展開狀態
+                    if recipe_name in st.session_state.recipe_expander_states:
+                        del st.session_state.recipe_expander_states[recipe_name]
+                    save_recipes_data(deleted=[recipe_name])
+                    st.session_state[f'show_delete_recipe_modal_{recipe_name}'] = False
+                    st.success(f"✅ 已刪除食譜「{recipe_name}」")
+                    st.rerun()
+            with col_cancel:
+                if st.button("取消", key=f"cancel_del_recipe_{recipe_name}", use_container_width=True):
+                    st.session_state[f'show_delete_recipe_modal_{recipe_name}'] = False
+                    st.info(f"❌ 已取消刪除食譜「{recipe_name}」")
+                    st.rerun()
+        else:
+            if st.button("🗑️ 刪除", key=f"del_recipe_{recipe_name}", use_container_width=True):
+                st.session_state[f'show_delete_recipe_modal_{recipe_name}'] = True
+                st.rerun()
+
+
+# 根據選擇的頁面顯示不同內容
+if st.session_state.current_page == "成本計算":
+    # 成本計算頁面
+    st.markdown("### 成本計算", help="選擇多個材料並計算總成本")
+    ensure_data_loaded("recipes")
+    
+    render_cost_calculator()
 
 elif st.session_state.current_page == "材料管理":
     # 材料管理頁面
@@ -1056,6 +3833,15 @@ elif st.session_state.current_page == "材料管理":
                     help="輸入每克的價格，例如：0.0003",
                     label_visibility="visible"
                 )
+                edited_yield = st.number_input(
+                    "預設熟成率",
+                    min_value=0.01,
+                    max_value=1.0,
+                    value=float(st.session_state.material_default_yields.get(st.session_state.editing_material, 1.0)),
+                    step=0.05,
+                    help="計算成本時這個材料預設使用的熟成率，1 表示不使用熟成率",
+                    label_visibility="visible"
+                )
 
                 # 驗證輸入是否為有效數字
                 try:
@@ -1102,41 +3888,11 @@ elif st.session_state.current_page == "材料管理":
                                     idx = st.session_state.custom_material_order.index(old_material_name)
                                     st.session_state.custom_material_order[idx] = edited_name
                             
-                            # 更新食譜中的材料價格和成本
-                            updated_recipes = []
-                            for recipe_name, recipe_data in st.session_state.saved_recipes.items():
-                                if old_material_name in recipe_data['materials']:
-                                    # 更新材料名稱（如果名稱改變）
-                                    if edited_name != old_material_name:
-                                        recipe_data['materials'][edited_name] = recipe_data['materials'].pop(old_material_name)
-                                    
-                                    # 更新材料價格
-                                    recipe_data['materials'][edited_name]['price'] = edited_price
-                                    
-                                    # 重新計算材料成本
-                                    weight = recipe_data['materials'][edited_name]['weight']
-                                    yield_rate = recipe_data['materials'][edited_name].get('yield_rate')
-                                    
-                                    if yield_rate is not None and yield_rate > 0:
-                                        # 使用熟成率計算
-                                        adjusted_weight = weight / yield_rate
-                                        material_cost = adjusted_weight * edited_price
-                                    else:
-                                        # 原本的計算
-                                        material_cost = weight * edited_price
-                                    
-                                    recipe_data['materials'][edited_name]['cost'] = material_cost
-                                    recipe_data['materials'][edited_name]['adjusted_weight'] = adjusted_weight if yield_rate is not None and yield_rate > 0 else weight
-                                    
-                                    # 重新計算食譜總成本
-                                    total_cost = sum(mat_data['cost'] for mat_data in recipe_data['materials'].values())
-                                    recipe_data['total_cost'] = total_cost
-                                    
-                                    updated_recipes.append(recipe_name)
-                            
+                            # 只重算使用這個材料的食譜
                             save_materials_data()
-                            if updated_recipes:
-                                save_recipes_data()
+                            updated_recipes, _ = recost_recipes_for_material(old_material_name, edited_name, edited_price)
+                            update_material_default_yield(old_material_name, edited_name, edited_yield)
+                            update_material_unit(old_material_name, edited_name)
                             
                             st.session_state.editing_material = None
                             st.session_state.editing_price = None
@@ -1169,6 +3925,15 @@ elif st.session_state.current_page == "材料管理":
                         help="輸入每克的價格",
                         label_visibility="visible"
                     )
+                    default_yield = st.number_input(
+                        "預設熟成率",
+                        min_value=0.01,
+                        max_value=1.0,
+                        value=1.0,
+                        step=0.05,
+                        help="計算成本時這個材料預設使用的熟成率，1 表示不使用熟成率",
+                        label_visibility="visible"
+                    )
                     
                     submitted = st.form_submit_button("儲存材料", type="primary", use_container_width=True)
                     if submitted:
@@ -1179,6 +3944,7 @@ elif st.session_state.current_page == "材料管理":
                         else:
                             st.session_state.saved_materials[material_name] = price_per_100g
                             save_materials_data()
+                            update_material_default_yield(material_name, material_name, default_yield)
                             # 記住展開狀態
                             st.session_state.materials_expander_expanded = True
                             # 增加key值來清空輸入框
@@ -1218,6 +3984,24 @@ elif st.session_state.current_page == "材料管理":
         
         # 使用可展開容器顯示材料列表
         with st.expander(f"📋 查看所有材料 ({material_count} 個)", expanded=st.session_state.materials_expander_expanded):
+            # 只顯示符合搜尋的材料（依自訂順序），正在編輯的材料一律顯示
+            material_query = st.text_input(
+                "搜尋材料",
+                placeholder="輸入名稱、拼音或注音" if lazy_pinyin is not None else "輸入材料名稱",
+                key="manage_material_search"
+            )
+            if material_query:
+                matched = set(get_material_search_index().search(material_query))
+                sorted_materials = [
+                    (material, price) for material, price in sorted_materials
+                    if material in matched or material == st.session_state.get('editing_material')
+                ]
+                if not sorted_materials:
+                    st.caption("找不到符合的材料")
+            elif len(sorted_materials) > MATERIAL_PICKER_LIMIT:
+                st.caption(f"顯示前 {MATERIAL_PICKER_LIMIT} / {len(sorted_materials)} 個材料，請輸入名稱搜尋其他材料")
+                sorted_materials = sorted_materials[:MATERIAL_PICKER_LIMIT]
+
             # 並排顯示材料（每行2個）
             materials_per_row = 2
             
@@ -1294,41 +4078,11 @@ elif st.session_state.current_page == "材料管理":
                                                         idx = st.session_state.custom_material_order.index(material)
                                                         st.session_state.custom_material_order[idx] = edited_name
                                                 
-                                                # 更新食譜中的材料價格和成本
-                                                updated_recipes = []
-                                                for recipe_name, recipe_data in st.session_state.saved_recipes.items():
-                                                    if material in recipe_data['materials']:
-                                                        # 更新材料名稱（如果名稱改變）
-                                                        if edited_name != material:
-                                                            recipe_data['materials'][edited_name] = recipe_data['materials'].pop(material)
-                                                        
-                                                        # 更新材料價格
-                                                        recipe_data['materials'][edited_name]['price'] = edited_price
-                                                        
-                                                        # 重新計算材料成本
-                                                        weight = recipe_data['materials'][edited_name]['weight']
-                                                        yield_rate = recipe_data['materials'][edited_name].get('yield_rate')
-                                                        
-                                                        if yield_rate is not None and yield_rate > 0:
-                                                            # 使用熟成率計算
-                                                            adjusted_weight = weight / yield_rate
-                                                            material_cost = adjusted_weight * edited_price
-                                                        else:
-                                                            # 原本的計算
-                                                            material_cost = weight * edited_price
-                                                        
-                                                        recipe_data['materials'][edited_name]['cost'] = material_cost
-                                                        recipe_data['materials'][edited_name]['adjusted_weight'] = adjusted_weight if yield_rate is not None and yield_rate > 0 else weight
-                                                        
-                                                        # 重新計算食譜總成本
-                                                        total_cost = sum(mat_data['cost'] for mat_data in recipe_data['materials'].values())
-                                                        recipe_data['total_cost'] = total_cost
-                                                        
-                                                        updated_recipes.append(recipe_name)
-                                                
+                                                # 只重算使用這個材料的食譜
                                                 save_materials_data()
-                                                if updated_recipes:
-                                                    save_recipes_data()
+                                                updated_recipes, _ = recost_recipes_for_material(material, edited_name, edited_price)
+                                                update_material_default_yield(material, edited_name)
+                                                update_material_unit(material, edited_name)
                                                 
                                                 st.session_state.editing_material = None
                                                 st.session_state.materials_expander_expanded = True
@@ -1478,12 +4232,6 @@ elif st.session_state.current_page == "材料管理":
                                         # 記住展開狀態
                                         st.session_state.materials_expander_expanded = True
                                         
-                                        # 檢查哪些食譜使用了這個材料
-                                        affected_recipes = []
-                                        for recipe_name, recipe_data in st.session_state.saved_recipes.items():
-                                            if material in recipe_data['materials']:
-                                                affected_recipes.append(recipe_name)
-                                        
                                         # 刪除材料
                                         del st.session_state.saved_materials[material]
                                         
@@ -1491,24 +4239,12 @@ elif st.session_state.current_page == "材料管理":
                                         if hasattr(st.session_state, 'custom_material_order') and material in st.session_state.custom_material_order:
                                             st.session_state.custom_material_order.remove(material)
                                         
-                                        # 從食譜中移除該材料並重新計算成本
-                                        for recipe_name in affected_recipes:
-                                            recipe_data = st.session_state.saved_recipes[recipe_name]
-                                            # 移除材料
-                                            del recipe_data['materials'][material]
-                                            
-                                            # 重新計算食譜總成本
-                                            if recipe_data['materials']:  # 如果還有其他材料
-                                                total_cost = sum(mat_data['cost'] for mat_data in recipe_data['materials'].values())
-                                                recipe_data['total_cost'] = total_cost
-                                            else:
-                                                # 如果沒有材料了，刪除整個食譜
-                                                del st.session_state.saved_recipes[recipe_name]
-                                                affected_recipes.remove(recipe_name)
-                                        
+                                        # 只從使用這個材料的食譜中移除並重新計算成本
                                         save_materials_data()
-                                        if affected_recipes:
-                                            save_recipes_data()
+                                        updated_recipes, emptied_recipes = recost_recipes_for_material(material)
+                                        update_material_default_yield(material)
+                                        update_material_unit(material)
+                                        affected_recipes = updated_recipes + emptied_recipes
                                         
                                         # 重置刪除確認狀態
                                         st.session_state[f"show_delete_modal_{material}"] = False
@@ -1539,6 +4275,136 @@ elif st.session_state.current_page == "材料管理":
         </div>
         """, unsafe_allow_html=True)
 
+    # 採購單位與批量改價：以供應商的報價單位輸入價格，換算成每克單價
+    if st.session_state.saved_materials:
+        st.markdown("---")
+        st.markdown("#### 採購單位與批量改價", help="設定每個材料的採購單位（kg、斤、ml、箱…），以採購單價批量更新每克單價")
+        ensure_data_loaded("material_units")
+        unit_factors = get_unit_factors()
+        unit_table = pd.DataFrame({
+            "材料名稱": list(st.session_state.saved_materials),
+            "採購單位": [st.session_state.material_units.get(material, {}).get('unit', "g") for material in st.session_state.saved_materials],
+            "每包數量": [st.session_state.material_units.get(material, {}).get('pack_size') for material in st.session_state.saved_materials],
+            "每包單位": [st.session_state.material_units.get(material, {}).get('pack_unit') for material in st.session_state.saved_materials],
+            "密度 (g/ml)": [st.session_state.material_units.get(material, {}).get('density') for material in st.session_state.saved_materials],
+            "每g單價": list(st.session_state.saved_materials.values()),
+        })
+        unit_table["採購單價"] = unit_table["每g單價"] * unit_table["材料名稱"].map(unit_factors).fillna(1.0)
+        
+        with st.form("material_units_form"):
+            edited_units = st.data_editor(
+                unit_table,
+                use_container_width=True,
+                hide_index=True,
+                disabled=["材料名稱", "每g單價"],
+                column_config={
+                    "採購單位": st.column_config.SelectboxColumn(options=list(WEIGHT_UNITS) + list(VOLUME_UNITS) + list(PACK_UNITS), required=True),
+                    "每包數量": st.column_config.NumberColumn(min_value=0.0, help="包裝單位（包、箱、瓶、罐）的內容量"),
+                    "每包單位": st.column_config.SelectboxColumn(options=list(WEIGHT_UNITS) + list(VOLUME_UNITS)),
+                    "密度 (g/ml)": st.column_config.NumberColumn(min_value=0.0, help="以容量計價的材料每毫升幾克，未設定時為 1"),
+                    "每g單價": st.column_config.NumberColumn(format="NT$ %.4f"),
+                    "採購單價": st.column_config.NumberColumn(min_value=0.0, format="NT$ %.2f", help="每一個採購單位的價格"),
+                },
+                key="material_units_editor"
+            )
+            units_submitted = st.form_submit_button("套用採購單位與單價", type="primary", use_container_width=True)
+        
+        if units_submitted:
+            try:
+                # 表格預填的採購單價（以原本的採購單位換算），用來判斷使用者是否修改了單價
+                prefilled_prices = dict(zip(unit_table["材料名稱"], unit_table["採購單價"]))
+                new_units = {}
+                new_prices = {}
+                for row in edited_units.to_dict('records'):
+                    material = row["材料名稱"]
+                    spec = {
+                        "unit": row["採購單位"] or "g",
+                        "pack_size": row["每包數量"] if pd.notna(row["每包數量"]) else None,
+                        "pack_unit": row["每包單位"] if pd.notna(row["每包單位"]) else None,
+                        "density": row["密度 (g/ml)"] if pd.notna(row["密度 (g/ml)"]) else None
+                    }
+                    try:
+                        factor = grams_per_unit(spec)
+                    except ValueError as e:
+                        raise ValueError(f"{material}：{e}")
+                    if spec["unit"] != "g":
+                        new_units[material] = spec
+                    # 只有採購單價本身被修改時才換算成每克單價；只改採購單位時保留原本的每克單價
+                    if pd.notna(row["採購單價"]) and not np.isclose(row["採購單價"], prefilled_prices[material]):
+                        price = row["採購單價"] / factor
+                        if not np.isclose(price, st.session_state.saved_materials[material]):
+                            new_prices[material] = price
+                if new_units != st.session_state.material_units:
+                    st.session_state.material_units = new_units
+                    save_material_units_data()
+                updated_recipes = []
+                if new_prices:
+                    st.session_state.saved_materials.update(new_prices)
+                    save_materials_data()
+                    updated_recipes = recost_recipes_for_prices(new_prices)
+                st.success(f"✅ 已更新 {len(new_prices)} 個材料的單價，重算了 {len(updated_recipes)} 個食譜的成本")
+                st.rerun()
+            except Exception as e:
+                st.error(f"套用採購單價失敗: {str(e)}")
+
+    # 價格模擬：假設的單價調整只用來計算，不會儲存
+    if st.session_state.saved_materials:
+        st.markdown("---")
+        st.markdown("#### 價格模擬", help="假設材料單價變動，查看所有食譜的成本變化（不會修改材料單價）")
+        
+        with st.form("price_adjustment_form", clear_on_submit=True):
+            name_filter = st.text_input("名稱包含", placeholder="例如：肉（選取所有名稱含「肉」的材料）")
+            adjusted_materials = st.multiselect("或選擇材料", list(st.session_state.saved_materials))
+            col1, col2 = st.columns(2)
+            with col1:
+                adjustment_mode = st.radio("調整方式", ["百分比 (%)", "指定單價 (NT$/g)"], horizontal=True)
+            with col2:
+                adjustment_value = st.number_input("數值", value=0.0, step=1.0, format="%.4f")
+            if st.form_submit_button("加入調整", use_container_width=True):
+                if name_filter:
+                    adjusted_materials += [
+                        material for material in st.session_state.saved_materials
+                        if name_filter in material and material not in adjusted_materials
+                    ]
+                if adjusted_materials:
+                    st.session_state.price_adjustments.append({
+                        "materials": adjusted_materials,
+                        "mode": "percent" if adjustment_mode.startswith("百分比") else "price",
+                        "value": adjustment_value
+                    })
+                else:
+                    st.warning("⚠️ 沒有符合的材料")
+        
+        if st.session_state.price_adjustments:
+            for adjustment in st.session_state.price_adjustments:
+                change = f"{adjustment['value']:+g}%" if adjustment['mode'] == "percent" else f"NT$ {adjustment['value']:g}/g"
+                st.markdown(f"- {'、'.join(adjustment['materials'])}：{change}")
+            if st.button("清除模擬", use_container_width=True, key="clear_price_adjustments"):
+                st.session_state.price_adjustments = []
+                st.rerun()
+            
+            ensure_data_loaded("recipes")
+            try:
+                simulation = simulate_price_adjustments(st.session_state.price_adjustments)
+            except Exception as e:
+                st.error(f"價格模擬失敗: {str(e)}")
+            else:
+                if simulation.empty:
+                    st.info("沒有食譜受到影響")
+                else:
+                    st.caption(f"共 {len(simulation)} 個食譜受到影響，總差額 NT$ {simulation['差額'].sum():+.2f}")
+                    st.dataframe(
+                        simulation,
+                        use_container_width=True,
+                        hide_index=True,
+                        column_config={
+                            "目前成本": st.column_config.NumberColumn(format="NT$ %.2f"),
+                            "模擬成本": st.column_config.NumberColumn(format="NT$ %.2f"),
+                            "差額": st.column_config.NumberColumn(format="NT$ %+.2f"),
+                            "變動 %": st.column_config.NumberColumn(format="%+.1f%%"),
+                        }
+                    )
+
     # 批量操作
     if st.session_state.saved_materials:
         st.markdown("---")
@@ -1578,252 +4444,199 @@ elif st.session_state.current_page == "材料管理":
         #     st.rerun()
 
 elif st.session_state.current_page == "食譜區":
+    ensure_data_loaded("recipes")
     # 食譜區頁面
     st.markdown("### 食譜區")
     
-    # 檢查是否在編輯食譜模式
-    if hasattr(st.session_state, 'editing_recipe') and st.session_state.editing_recipe:
-        st.markdown(f"#### 編輯食譜：{st.session_state.editing_recipe}")
+    render_recipe_editor()
+    
+    if st.session_state.saved_recipes:
+        # 檢查成本是否過期（匯入、從 Google Sheets 載入或直接修改工作表後，材料單價可能已變動）
+        stale_recipes = set(get_stale_recipes())
+        if stale_recipes:
+            col_warning, col_refresh = st.columns([3, 1])
+            with col_warning:
+                st.warning(f"⚠️ 有 {len(stale_recipes)} 個食譜的成本使用舊的材料單價")
+            with col_refresh:
+                if st.button("🔄 全部重算", key="refresh_stale_recipes", use_container_width=True):
+                    try:
+                        refreshed = refresh_stale_recipes(stale_recipes)
+                        st.success(f"✅ 已重算 {len(refreshed)} 個食譜的成本")
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"重算食譜成本失敗: {str(e)}")
         
-        # 編輯食譜表單
-        with st.form("edit_recipe_form"):
-            edited_recipe_name = st.text_input(
-                "食譜名稱",
-                value=st.session_state.editing_recipe,
-                label_visibility="visible"
+        # 食譜列表由摘要索引（名稱、總成本、材料數）建立，只有展開的食譜才建立詳細內容
+        summary = get_recipe_summary()
+        col_search, col_sort, col_size = st.columns([2, 1, 1])
+        with col_search:
+            recipe_query = st.text_input("搜尋食譜", placeholder="輸入食譜名稱", key="recipe_list_search")
+        with col_sort:
+            recipe_sort = st.selectbox("排序", list(RECIPE_SORT_OPTIONS), key="recipe_list_sort")
+        with col_size:
+            recipe_page_size = st.selectbox("每頁數量", [10, 20, 50, 100], index=1, key="recipe_list_page_size")
+        if recipe_query:
+            summary = summary[summary["食譜名稱"].str.contains(recipe_query, case=False, regex=False)]
+        sort_column, ascending = RECIPE_SORT_OPTIONS[recipe_sort]
+        summary = summary.sort_values(sort_column, ascending=ascending, kind="stable")
+        
+        recipe_page_count = max(1, -(-len(summary) // recipe_page_size))
+        if recipe_page_count > 1:
+            recipe_page = st.number_input(
+                f"頁數（共 {recipe_page_count} 頁，{len(summary)} 個食譜）",
+                min_value=1,
+                max_value=recipe_page_count,
+                value=min(st.session_state.get('recipe_list_page', 1), recipe_page_count),
+                step=1
             )
-            
-            # 顯示材料列表（可編輯）
-            st.markdown("#### 材料清單")
-            recipe_data = st.session_state.editing_recipe_data
-            edited_materials = {}
-            
-            for material, data in recipe_data['materials'].items():
-                st.markdown(f"**{material}**")
-                col1, col2 = st.columns(2)
-                
-                with col1:
-                    weight = st.number_input(
-                        f"{material} 重量 (g)",
-                        value=float(data['weight']),
-                        min_value=0.0,
-                        step=1.0,
-                        key=f"edit_weight_{material}"
-                    )
-                
-                with col2:
-                    price = st.number_input(
-                        f"{material} 單價",
-                        value=float(data['price']),
-                        min_value=0.0,
-                        step=0.01,
-                        key=f"edit_price_{material}"
-                    )
-                
-                # 熟成率固定為0.8（不顯示編輯選項）
-                yield_enabled = True
-                
-                # 計算成本
-                if yield_enabled:
-                    # 使用固定熟成率0.8計算：重量 / 0.8 * 單價
-                    adjusted_weight = weight / 0.8
-                    material_cost = adjusted_weight * price
-                    yield_rate = 0.8
-                else:
-                    # 原本的計算：重量 * 單價
-                    material_cost = weight * price
-                    yield_rate = None
-                
-                edited_materials[material] = {
-                    "weight": weight,
-                    "price": price,
-                    "cost": material_cost,
-                    "yield_rate": yield_enabled,  # 儲存勾選狀態
-                    "adjusted_weight": adjusted_weight if yield_enabled else weight
-                }
-                
-                st.markdown(f"成本：NT$ {material_cost:.2f}")
-                st.markdown("---")
-            
-            # 計算總成本
-            total_cost = sum(mat_data['cost'] for mat_data in edited_materials.values())
-            st.markdown(f"**總成本：NT$ {total_cost:.2f}**")
-            
-            # 添加提交按鈕
-            col_save, col_cancel = st.columns(2)
-            with col_save:
-                submitted = st.form_submit_button("儲存修改", type="primary", use_container_width=True)
-            with col_cancel:
-                if st.form_submit_button("取消編輯", use_container_width=True):
-                    st.session_state.editing_recipe = None
-                    st.session_state.editing_recipe_data = None
-                    st.rerun()
+        else:
+            recipe_page = 1
+        st.session_state.recipe_list_page = recipe_page
+        page_summary = summary.iloc[(recipe_page - 1) * recipe_page_size:recipe_page * recipe_page_size]
+        if page_summary.empty:
+            st.caption("找不到符合的食譜")
         
-        # 處理表單提交（在表單外部）
-        if submitted:
-            if edited_recipe_name:
-                # 如果名稱改變，需要檢查是否已存在
-                if edited_recipe_name != st.session_state.editing_recipe and edited_recipe_name in st.session_state.saved_recipes:
-                    st.error("食譜名稱已存在！")
-                else:
-                    # 同步更新材料管理的單價
-                    for material, data in edited_materials.items():
-                        if material in st.session_state.saved_materials:
-                            # 更新材料管理中的單價
-                            st.session_state.saved_materials[material] = data['price']
-                    
-                    # 儲存材料資料
-                    save_materials_data()
-                    
-                    # 更新食譜
-                    old_name = st.session_state.editing_recipe
-                    updated_recipe_data = {
-                        "materials": edited_materials,
-                        "total_cost": total_cost,
-                        "created_at": recipe_data['created_at'],
-                        "updated_at": get_taiwan_time().isoformat()
-                    }
-                    
-                    # 如果名稱改變，刪除舊食譜
-                    if edited_recipe_name != old_name:
-                        del st.session_state.saved_recipes[old_name]
-                    
-                    st.session_state.saved_recipes[edited_recipe_name] = updated_recipe_data
-                    save_recipes_data()
-                    st.session_state.editing_recipe = None
-                    st.session_state.editing_recipe_data = None
-                    # 保持食譜展開狀態
-                    if edited_recipe_name in st.session_state.recipe_expander_states:
-                        st.session_state.recipe_expander_states[edited_recipe_name] = True
-                    st.success(f"✅ 已更新食譜「{edited_recipe_name}」並同步更新材料管理單價")
-                    # 不刷新頁面，只重新渲染當前部分
-                    st.rerun()
-            else:
-                st.error("請輸入食譜名稱！")
+        for recipe_name, total_cost, line_count in zip(page_summary["食譜名稱"], page_summary["總成本"], page_summary["材料數"]):
+            total_cost_display = int(total_cost) if total_cost == int(total_cost) else f"{total_cost:.2f}"
+            is_expanded = st.session_state.recipe_expander_states.get(recipe_name, False)
+            stale_mark = " ⚠️ 成本過期" if recipe_name in stale_recipes else ""
+            if st.button(
+                f"{'▼' if is_expanded else '▶'} 📖 {recipe_name} - NT$ {total_cost_display}（{line_count} 項材料）{stale_mark}",
+                key=f"toggle_recipe_{recipe_name}",
+                use_container_width=True
+            ):
+                st.session_state.recipe_expander_states[recipe_name] = not is_expanded
+                st.rerun()
+            if is_expanded:
+                with st.container(border=True):
+                    render_recipe_details(recipe_name, st.session_state.saved_recipes[recipe_name])
+        
+        # 售價建議：依目標毛利率計算所有食譜的建議售價，並比較記帳中的實際售價
+        st.markdown("---")
+        st.markdown("#### 售價建議", help="建議售價 = 成本 / (1 - 目標毛利率)；實際售價為記帳中標記該產品的收入平均（多個產品時平均分攤）")
+        ensure_data_loaded("accounting")
+        col1, col2 = st.columns(2)
+        with col1:
+            default_margin = st.number_input("預設目標毛利 %", min_value=0.0, max_value=95.0, value=60.0, step=5.0)
+        with col2:
+            rounding = st.selectbox("售價尾數", list(PRICE_ROUNDING_RULES), index=2)
+        try:
+            suggestions = suggest_menu_prices(
+                st.session_state.saved_recipes,
+                st.session_state.target_margins,
+                default_margin,
+                rounding,
+                get_product_sales()
+            )
+            # 只有「目標毛利 %」可以編輯，修改後記錄為該食譜的目標毛利率
+            edited_suggestions = st.data_editor(
+                suggestions,
+                use_container_width=True,
+                hide_index=True,
+                disabled=[column for column in suggestions.columns if column != "目標毛利 %"],
+                column_config={
+                    "成本": st.column_config.NumberColumn(format="NT$ %.2f"),
+                    "目標毛利 %": st.column_config.NumberColumn(min_value=0.0, max_value=95.0, format="%.1f"),
+                    "建議售價": st.column_config.NumberColumn(format="NT$ %.2f"),
+                    "建議售價毛利 %": st.column_config.NumberColumn(format="%.1f"),
+                    "銷售筆數": st.column_config.NumberColumn(format="%d"),
+                    "平均售價": st.column_config.NumberColumn(format="NT$ %.2f"),
+                    "實際毛利 %": st.column_config.NumberColumn(format="%.1f"),
+                },
+                key="menu_price_editor"
+            )
+            edited_margins = dict(zip(edited_suggestions["食譜名稱"], edited_suggestions["目標毛利 %"]))
+            changed_margins = {
+                recipe_name: margin
+                for recipe_name, margin in edited_margins.items()
+                if pd.notna(margin) and margin != st.session_state.target_margins.get(recipe_name, default_margin)
+            }
+            if changed_margins:
+                st.session_state.target_margins.update(changed_margins)
+                st.rerun()
+        except Exception as e:
+            st.error(f"計算建議售價失敗: {str(e)}")
+    else:
+        st.markdown("""
+        <div class="warning-message">
+            <h4>尚未保存任何食譜</h4>
+            <p>請先在「成本計算」頁面創建並保存食譜。</p>
+        </div>
+        """, unsafe_allow_html=True)
+
+elif st.session_state.current_page == "生產計畫":
+    ensure_data_loaded("recipes")
+    # 生產計畫頁面
+    st.markdown("### 生產計畫", help="輸入每個食譜要做的份數，一次計算所有材料需要的克數與總成本")
     
     if st.session_state.saved_recipes:
-        # 顯示已保存的食譜
-        for recipe_name, recipe_data in st.session_state.saved_recipes.items():
-            total_cost_display = recipe_data['total_cost']
-            if total_cost_display == int(total_cost_display):
-                total_cost_display = int(total_cost_display)
+        recipe_names = list(st.session_state.saved_recipes)
+        plan_recipes = st.multiselect(
+            "選擇要生產的食譜",
+            recipe_names,
+            default=[recipe_name for recipe_name in st.session_state.production_plan if recipe_name in st.session_state.saved_recipes]
+        )
+        
+        # 輸入每個食譜的份數
+        production_plan = {}
+        cols = st.columns(3)
+        for i, recipe_name in enumerate(plan_recipes):
+            with cols[i % len(cols)]:
+                production_plan[recipe_name] = st.number_input(
+                    f"{recipe_name} 份數",
+                    min_value=0,
+                    value=int(st.session_state.production_plan.get(recipe_name, 1)),
+                    step=1,
+                    key=f"plan_quantity_{hash(recipe_name) % 1000000}"
+                )
+        st.session_state.production_plan = production_plan
+        
+        if any(production_plan.values()):
+            try:
+                requirements = plan_material_requirements(production_plan)
+            except Exception as e:
+                st.error(f"計算生產計畫失敗: {str(e)}")
             else:
-                total_cost_display = f"{recipe_data['total_cost']:.2f}"
-            
-            # 使用動態展開狀態
-            expander_key = f"recipe_expander_{recipe_name}"
-            is_expanded = st.session_state.recipe_expander_states.get(recipe_name, False)
-            
-            with st.expander(f"📖 {recipe_name} - NT$ {total_cost_display}", expanded=is_expanded):
-                # 更新展開狀態
-                st.session_state.recipe_expander_states[recipe_name] = True
-                
-                # 顯示食譜詳細資訊
-                st.markdown(f"**創建時間：** {recipe_data['created_at'][:19]}")
-                if 'updated_at' in recipe_data:
-                    st.markdown(f"**最後更新：** {recipe_data['updated_at'][:19]}")
-                st.markdown("---")
-                
-                # 顯示材料列表
-                st.markdown("#### 材料清單")
-                
-                # 添加欄位標題
-                col1, col2, col3, col4 = st.columns(4)
+                total_cost = requirements["成本"].sum()
+                col1, col2 = st.columns(2)
                 with col1:
-                    st.markdown("**材料名稱**")
+                    st.metric("總份數", sum(production_plan.values()))
                 with col2:
-                    st.markdown("**克數**")
-                with col3:
-                    st.markdown("**單價**")
-                with col4:
-                    st.markdown("**成本**")
-                
-                st.markdown("---")
+                    st.metric("總成本", f"NT$ {total_cost:.2f}")
                 
-                for material, data in recipe_data['materials'].items():
-                    col1, col2, col3, col4 = st.columns(4)
-                    with col1:
-                        st.markdown(f"**{material}**")
-                    with col2:
-                        st.markdown(f"{data['weight']:.1f} g")
-                    with col3:
-                        price_display = data['price']
-                        if price_display == int(price_display):
-                            price_display = int(price_display)
-                        st.markdown(f"NT$ {price_display}")
-                    with col4:
-                        cost_display = data['cost']
-                        if cost_display == int(cost_display):
-                            cost_display = int(cost_display)
-                        else:
-                            cost_display = f"{data['cost']:.2f}"
-                        st.markdown(f"NT$ {cost_display}")
+                st.markdown("#### 採購清單")
+                st.dataframe(
+                    requirements,
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={
+                        "需要克數": st.column_config.NumberColumn(format="%.2f g"),
+                        "單價": st.column_config.NumberColumn(format="NT$ %.4f"),
+                        "成本": st.column_config.NumberColumn(format="NT$ %.2f"),
+                    }
+                )
                 
-                st.markdown("---")
-                total_cost_display = recipe_data['total_cost']
-                if total_cost_display == int(total_cost_display):
-                    total_cost_display = int(total_cost_display)
-                else:
-                    total_cost_display = f"{recipe_data['total_cost']:.2f}"
-                st.markdown(f"**總成本：NT$ {total_cost_display}**")
-
-                # 操作按鈕
-                col_use, col_edit, col_delete = st.columns(3)
-                with col_use:
-                    if st.button("使用此食譜", key=f"use_{recipe_name}", use_container_width=True):
-                        st.info(f"🔄 正在載入食譜「{recipe_name}」...")
-                        # 將食譜材料載入到成本計算頁面
-                        st.session_state.selected_materials = list(recipe_data['materials'].keys())
-                        st.session_state.material_weights = {
-                            material: data['weight'] 
-                            for material, data in recipe_data['materials'].items()
-                        }
-                        st.session_state.current_page = "成本計算"
-                        st.success(f"✅ 已載入食譜「{recipe_name}」到成本計算頁面")
-                        st.rerun()
-
-                with col_edit:
-                    if st.button("✏️ 編輯", key=f"edit_recipe_{recipe_name}", use_container_width=True):
-                        st.session_state.editing_recipe = recipe_name
-                        st.session_state.editing_recipe_data = recipe_data
-                        # 保持展開狀態
-                        st.session_state.recipe_expander_states[recipe_name] = True
-                        st.rerun()
-
-                with col_delete:
-                    # 檢查是否在確認刪除狀態
-                    if st.session_state.get(f'show_delete_recipe_modal_{recipe_name}', False):
-                        st.warning(f"⚠️ 確定要刪除食譜「{recipe_name}」嗎？此操作無法復原！")
-                        col_confirm, col_cancel = st.columns(2)
-                        with col_confirm:
-                            if st.button("確認刪除", key=f"confirm_del_recipe_{recipe_name}", use_container_width=True):
-                                del st.session_state.saved_recipes[recipe_name]
-                                # 移除展開狀態
-                                if recipe_name in st.session_state.recipe_expander_states:
-                                    del st.session_state.recipe_expander_states[recipe_name]
-                                save_recipes_data()
-                                st.session_state[f'show_delete_recipe_modal_{recipe_name}'] = False
-                                st.success(f"✅ 已刪除食譜「{recipe_name}」")
-                                st.rerun()
-                        with col_cancel:
-                            if st.button("取消", key=f"cancel_del_recipe_{recipe_name}", use_container_width=True):
-                                st.session_state[f'show_delete_recipe_modal_{recipe_name}'] = False
-                                st.info(f"❌ 已取消刪除食譜「{recipe_name}」")
-                                st.rerun()
-                    else:
-                        if st.button("🗑️ 刪除", key=f"del_recipe_{recipe_name}", use_container_width=True):
-                            st.session_state[f'show_delete_recipe_modal_{recipe_name}'] = True
-                            st.rerun()
+                # 匯出採購清單（utf-8-sig 讓 Excel 正確顯示中文）
+                st.download_button(
+                    label="💾 下載採購清單 (CSV)",
+                    data=requirements.to_csv(index=False).encode("utf-8-sig"),
+                    file_name=f"purchase_list_{get_taiwan_time().strftime('%Y%m%d')}.csv",
+                    mime="text/csv",
+                    use_container_width=True
+                )
+        else:
+            st.info("請選擇食譜並輸入份數")
     else:
         st.markdown("""
-        <div class="warning-message">
+        <div class="warning-box">
             <h4>尚未保存任何食譜</h4>
             <p>請先在「成本計算」頁面創建並保存食譜。</p>
         </div>
         """, unsafe_allow_html=True)
 
 elif st.session_state.current_page == "記帳區":
-    # 記帳區頁面
+    # 記帳區頁面（產品選項來自食譜區）
+    ensure_data_loaded("accounting", "categories", "recipes")
     st.markdown("### 記帳區")
     
 
@@ -1957,7 +4770,7 @@ elif st.session_state.current_page == "記帳區":
                     "created_at": get_taiwan_time().isoformat()
                 }
                 st.session_state.accounting_records.append(record)
-                save_accounting_data()
+                save_accounting_data(added=[record])
                 
                 # 增加form key來清空輸入框
                 st.session_state.accounting_form_key += 1
@@ -2113,203 +4926,7 @@ elif st.session_state.current_page == "記帳區":
                 
                 st.markdown(f"**{period_title}記錄：**")
             
-            # 顯示記帳記錄（每行都有編輯和刪除按鈕）
-            # 表頭
-            with st.container():
-                col1, col2, col3, col4, col5, col6, col7, col8, col9, col10 = st.columns([1, 1, 1, 2, 1, 1, 1, 1, 1, 1])
-                
-                with col1:
-                    st.markdown("**日期**")
-                with col2:
-                    st.markdown("**類型**")
-                with col3:
-                    st.markdown("**類別**")
-                with col4:
-                    st.markdown("**細項**")
-                with col5:
-                    st.markdown("**金額**")
-                with col6:
-                    st.markdown("**地點**")
-                with col7:
-                    st.markdown("**購買人**")
-                with col8:
-                    st.markdown("**產品**")
-                with col9:
-                    st.markdown("**備註**")
-                with col10:
-                    st.markdown("**操作**")
-            
-            st.markdown("---")
-            
-            for i, record in enumerate(sorted_records):
-                # 相容舊資料格式
-                date_str = record.get('date', record.get('datetime', ''))
-                if 'T' in date_str:  # 如果是datetime格式，只取日期部分
-                    date_str = date_str.split('T')[0]
-                record_date = datetime.fromisoformat(date_str).strftime("%Y-%m-%d")
-                type_icon = "💰" if record['type'] == "收入" else "💸"
-                record_id = record.get('id', f'legacy_{i}')  # 相容舊資料
-                
-                # 處理產品顯示（支援舊格式和新格式）
-                products = record.get('products', [])
-                if not products:  # 相容舊格式
-                    product = record.get('product', '')
-                    products = [product] if product else []
-                products_display = ", ".join(products) if products else ""
-                
-                # 檢查是否正在編輯此記錄
-                is_editing = st.session_state.get('editing_record_id') == record_id
-                
-                if is_editing:
-                    # 內嵌編輯表單
-                    with st.container():
-                        st.markdown("**📝 編輯記錄**")
-                        with st.form(f"inline_edit_{record_id}"):
-                            col_edit1, col_edit2 = st.columns(2)
-                            
-                            with col_edit1:
-                                edit_date = st.date_input(
-                                    "日期",
-                                    value=datetime.fromisoformat(record['date']).date(),
-                                    key=f"edit_date_{record_id}"
-                                )
-                                edit_type = st.selectbox(
-                                    "類型",
-                                    ["支出", "收入"],
-                                    index=0 if record['type'] == "支出" else 1,
-                                    key=f"edit_type_{record_id}"
-                                )
-                                edit_category = st.selectbox(
-                                    "類別",
-                                    st.session_state.custom_categories,
-                                    index=st.session_state.custom_categories.index(record['category']) if record['category'] in st.session_state.custom_categories else 0,
-                                    key=f"edit_category_{record_id}"
-                                )
-                                edit_description = st.text_input(
-                                    "細項",
-                                    value=record['description'],
-                                    key=f"edit_description_{record_id}"
-                                )
-                                edit_amount = st.number_input(
-                                    "金額 (NT$)",
-                                    min_value=0.0,
-                                    value=float(record['amount']),
-                                    key=f"edit_amount_{record_id}"
-                                )
-                            
-                            with col_edit2:
-                                edit_location = st.text_input(
-                                    "地點",
-                                    value=record.get('location', ''),
-                                    key=f"edit_location_{record_id}"
-                                )
-                                edit_buyer = st.text_input(
-                                    "購買人",
-                                    value=record.get('buyer', ''),
-                                    key=f"edit_buyer_{record_id}"
-                                )
-                                
-                                # 產品選擇
-                                product_options = list(st.session_state.saved_recipes.keys())
-                                current_products = record.get('products', [])
-                                if not current_products:
-                                    product = record.get('product', '')
-                                    current_products = [product] if product else []
-                                
-                                edit_products = st.multiselect(
-                                    "產品（可複選）",
-                                    product_options,
-                                    default=current_products,
-                                    key=f"edit_products_{record_id}"
-                                )
-                                
-                                edit_remark = st.text_area(
-                                    "備註",
-                                    value=record.get('remark', ''),
-                                    height=80,
-                                    key=f"edit_remark_{record_id}"
-                                )
-                            
-                            col_save, col_cancel = st.columns(2)
-                            with col_save:
-                                if st.form_submit_button("💾 儲存", type="primary"):
-                                    # 更新記錄
-                                    record['date'] = edit_date.isoformat()
-                                    record['type'] = edit_type
-                                    record['category'] = edit_category
-                                    record['description'] = edit_description
-                                    record['amount'] = edit_amount
-                                    record['location'] = edit_location
-                                    record['buyer'] = edit_buyer
-                                    record['products'] = edit_products
-                                    record['remark'] = edit_remark
-                                    
-                                    save_accounting_data()
-                                    st.session_state.editing_record_id = None
-                                    st.success("✅ 記錄已更新")
-                                    st.rerun()
-                            
-                            with col_cancel:
-                                if st.form_submit_button("❌ 取消"):
-                                    st.session_state.editing_record_id = None
-                                    st.rerun()
-                else:
-                    # 正常顯示記錄
-                    col1, col2, col3, col4, col5, col6, col7, col8, col9, col10 = st.columns([1, 1, 1, 2, 1, 1, 1, 1, 1, 1])
-                    
-                    with col1:
-                        st.markdown(f"**{record_date}**")
-                    with col2:
-                        st.markdown(f"{type_icon} {record['type']}")
-                    with col3:
-                        st.markdown(f"{record['category']}")
-                    with col4:
-                        st.markdown(f"{record['description']}")
-                    with col5:
-                        st.markdown(f"NT$ {record['amount']}")
-                    with col6:
-                        st.markdown(f"{record.get('location', '')}")
-                    with col7:
-                        st.markdown(f"{record.get('buyer', '')}")
-                    with col8:
-                        st.markdown(f"{products_display}")
-                    with col9:
-                        st.markdown(f"{record.get('remark', '')}")
-                    with col10:
-                        # 編輯和刪除按鈕
-                        col_edit, col_delete = st.columns(2)
-                        with col_edit:
-                            if st.button("✏️", key=f"edit_{record_id}", help="編輯此記錄", use_container_width=True):
-                                st.session_state.editing_record_id = record_id
-                                st.rerun()
-                        with col_delete:
-                            # 檢查是否在刪除確認狀態
-                            if st.session_state.get(f"show_delete_modal_{record_id}", False):
-                                st.warning("⚠️ 確定要刪除這筆記錄嗎？")
-                                col_confirm, col_cancel = st.columns(2)
-                                with col_confirm:
-                                    if st.button("✅", key=f"confirm_del_{record_id}", help="確認刪除", use_container_width=True):
-                                        # 執行刪除
-                                        st.session_state.accounting_records = [
-                                            r for r in st.session_state.accounting_records 
-                                            if r.get('id', '') != record_id
-                                        ]
-                                        save_accounting_data()
-                                        st.session_state[f"show_delete_modal_{record_id}"] = False
-                                        st.success("✅ 記錄已刪除")
-                                        st.rerun()
-                                with col_cancel:
-                                    if st.button("❌", key=f"cancel_del_{record_id}", help="取消刪除", use_container_width=True):
-                                        st.session_state[f"show_delete_modal_{record_id}"] = False
-                                        st.rerun()
-                            else:
-                                if st.button("🗑️", key=f"del_{record_id}", help="刪除此記錄", use_container_width=True):
-                                    # 設定刪除確認狀態
-                                    st.session_state[f"show_delete_modal_{record_id}"] = True
-                                    st.rerun()
-                
-                # 添加分隔線
-                st.markdown("---")
+            render_ledger_page(sorted_records)
         
         else:  # 購買人紀錄
             st.markdown("#### 購買人紀錄")
@@ -2453,7 +5070,7 @@ elif st.session_state.current_page == "記帳區":
             with col_confirm:
                 if st.button("確認清除", type="secondary", use_container_width=True, key="confirm_clear_all"):
                     st.session_state.accounting_records = []
-                    save_accounting_data()
+                    save_accounting_data(full_rewrite=True)
                     st.success("✅ 已清除所有記帳記錄")
                     st.rerun()
             with col_cancel:
@@ -0,0 +1,237 @@
+"""main.py 的單元測試：成本引擎、子食譜重算、Google Sheets 逐列同步計畫與食譜列的轉換
+
+執行：python -m pytest -q test_main.py
+"""
+import os
+import random
+import runpy
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    """在暫存目錄中執行 main.py（空的本地資料庫、沒有 Google Sheets 設定），回傳模組的全域變數"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("app"))
+    try:
+        yield runpy.run_path(MAIN_PATH)
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def session_recipes(app):
+    """把食譜放進 session state（子食譜相關函式從 session 讀取食譜）"""
+    def set_recipes(recipes):
+        app['st'].session_state.saved_recipes = recipes
+        return recipes
+    return set_recipes
+
+
+def line_cost(line):
+    """舊版逐列計算的材料成本：有熟成率時以 克數 / 熟成率 計價（勾選 True 為 0.8）"""
+    yield_rate = 0.8 if line.get('yield_rate') is True else line.get('yield_rate')
+    weight = line['weight'] / yield_rate if yield_rate else line['weight']
+    return weight * line['price']
+
+
+def make_recipes(count=50, material_count=30, seed=0):
+    rng = random.Random(seed)
+    return {
+        f"r{i}": {
+            "materials": {
+                f"m{j}": {
+                    "weight": rng.uniform(1, 500),
+                    "price": rng.uniform(0.01, 2),
+                    "yield_rate": rng.choice([None, True, 0.75, 0.9])
+                }
+                for j in rng.sample(range(material_count), rng.randint(1, 8))
+            }
+        }
+        for i in range(count)
+    }
+
+
+def make_sub_recipes():
+    """三層的子食譜：三明治 使用 麵包，麵包 使用 麵團（子食譜列的單價尚未更新）"""
+    return {
+        "麵團": {"materials": {
+            "麵粉": {"weight": 100.0, "price": 0.05, "yield_rate": None},
+            "水": {"weight": 50.0, "price": 0.0, "yield_rate": None},
+        }},
+        "麵包": {"materials": {
+            "📖 麵團": {"weight": 75.0, "price": 0.0, "yield_rate": None},
+            "奶油": {"weight": 10.0, "price": 0.3, "yield_rate": 0.8},
+        }},
+        "三明治": {"materials": {
+            "📖 麵包": {"weight": 40.0, "price": 0.0, "yield_rate": None},
+            "火腿": {"weight": 20.0, "price": 0.5, "yield_rate": None},
+        }},
+    }
+
+
+# 成本引擎
+
+def test_engine_totals_match_per_line_loop(app):
+    recipes = make_recipes()
+    engine = app['RecipeCostEngine'](recipes)
+    expected = [sum(line_cost(line) for line in recipe['materials'].values()) for recipe in recipes.values()]
+    np.testing.assert_allclose(engine.totals(), expected)
+
+
+def test_engine_reprice_uses_new_prices_and_keeps_recorded_price_for_others(app):
+    recipes = make_recipes(seed=1)
+    prices = {f"m{j}": 0.5 for j in range(0, 30, 2)}
+    totals = app['RecipeCostEngine'](recipes).reprice(prices)
+    for recipe_name, recipe in recipes.items():
+        expected = sum(
+            line_cost(dict(line, price=prices.get(material, line['price'])))
+            for material, line in recipe['materials'].items()
+        )
+        assert totals[recipe_name] == pytest.approx(expected)
+
+
+def test_engine_apply_writes_line_and_total_costs(app):
+    recipes = make_recipes(count=5, seed=2)
+    app['RecipeCostEngine'](recipes).apply()
+    for recipe in recipes.values():
+        for line in recipe['materials'].values():
+            assert line['cost'] == pytest.approx(line_cost(line))
+        assert recipe['total_cost'] == pytest.approx(sum(line_cost(line) for line in recipe['materials'].values()))
+
+
+# 子食譜
+
+def test_recost_recipe_levels_rolls_sub_recipe_costs_bottom_up(app, session_recipes):
+    recipes = session_recipes(make_sub_recipes())
+    app['recost_recipe_levels'](list(recipes))
+    # 麵團 5 元 / 150 g；麵包 75 g 麵團 + 奶油 10 g / 0.8
+    assert recipes['麵團']['total_cost'] == pytest.approx(5.0)
+    assert recipes['麵包']['total_cost'] == pytest.approx(75 * 5 / 150 + 10 / 0.8 * 0.3)
+    bread_unit_cost = recipes['麵包']['total_cost'] / 85
+    assert recipes['三明治']['materials']['📖 麵包']['price'] == pytest.approx(bread_unit_cost)
+    assert recipes['三明治']['total_cost'] == pytest.approx(40 * bread_unit_cost + 20 * 0.5)
+
+
+def test_rollup_sub_recipe_costs_recosts_only_downstream(app, session_recipes):
+    recipes = session_recipes(make_sub_recipes())
+    app['recost_recipe_levels'](list(recipes))
+    recipes['其他'] = {"materials": {"火腿": {"weight": 1.0, "price": 0.5, "yield_rate": None}}, "total_cost": 0.0}
+    # 反向索引來自共用快取，先發布 session 中的食譜
+    app['publish_saved_data']("recipes")
+    recipes['麵團']['materials']['麵粉']['price'] = 0.1
+    app['RecipeCostEngine']({'麵團': recipes['麵團']}).apply()
+
+    updated = app['rollup_sub_recipe_costs'](['麵團'])
+
+    assert sorted(updated) == sorted(['麵包', '三明治'])
+    assert recipes['麵包']['total_cost'] == pytest.approx(75 * 10 / 150 + 10 / 0.8 * 0.3)
+    assert recipes['其他']['total_cost'] == 0.0
+
+
+def test_rollup_totals_matches_recosting_each_level(app, session_recipes):
+    recipes = session_recipes(make_sub_recipes())
+    engine = app['RecipeCostEngine'](recipes)
+    totals = app['rollup_totals'](engine, engine.price_vector({"麵粉": 0.1}))
+    recipes['麵團']['materials']['麵粉']['price'] = 0.1
+    app['recost_recipe_levels'](list(recipes))
+    np.testing.assert_allclose(totals, [recipe['total_cost'] for recipe in recipes.values()])
+
+
+def test_sub_recipe_cycles_are_rejected(app, session_recipes):
+    recipes = session_recipes(make_sub_recipes())
+    materials = {"📖 三明治": {"weight": 5.0, "price": 0.0, "yield_rate": None}}
+    assert app['find_recipe_cycle']('麵團', materials) == ['麵團', '三明治', '麵包', '麵團']
+    assert app['find_recipe_cycle']('新食譜', materials) is None
+
+    recipes['麵團']['materials'].update(materials)
+    with pytest.raises(ValueError):
+        app['sub_recipe_levels'](list(recipes), recipes)
+
+
+# Google Sheets 寫入計畫
+
+def fake_worksheet(title="記帳"):
+    return SimpleNamespace(title=title, id=7)
+
+
+def test_plan_row_sync_updates_appends_and_deletes_by_key(app):
+    worksheet = fake_worksheet()
+    plan = app['SheetsWritePlan']()
+    key_rows = [['ID'], ['a'], ['b'], ['c'], ['d'], ['e']]
+
+    app['plan_row_sync'](plan, worksheet, {'b': ['b', 2], 'z': ['z', 9]}, ['c', 'd', 'missing'], key_rows=key_rows)
+
+    assert plan.value_updates == [{'range': "'記帳'!A3", 'values': [['b', 2]]}]
+    assert plan.appends == [(worksheet, [['z', 9]])]
+    # 連續的列（第 4、5 列）合併成一個刪除範圍
+    assert plan.structural_requests == [{'deleteDimension': {'range': {
+        'sheetId': 7, 'dimension': 'ROWS', 'startIndex': 3, 'endIndex': 5
+    }}}]
+
+
+def test_plan_row_sync_deletes_from_bottom_up(app):
+    plan = app['SheetsWritePlan']()
+    key_rows = [['ID'], ['a'], ['b'], ['c'], ['d']]
+    app['plan_row_sync'](plan, fake_worksheet(), {}, ['a', 'd'], key_rows=key_rows)
+    ranges = [request['deleteDimension']['range'] for request in plan.structural_requests]
+    assert [(r['startIndex'], r['endIndex']) for r in ranges] == [(4, 5), (1, 2)]
+
+
+def test_plan_row_sync_with_two_key_columns(app):
+    worksheet = fake_worksheet("食譜")
+    plan = app['SheetsWritePlan']()
+    key_rows = [['食譜名稱', '材料名稱'], ['a', ''], ['a', '鹽'], ['1', '糖']]
+    upserts = {('a', '鹽'): ['a', '鹽', 5], (1, '糖'): [1, '糖', 3], ('b', ''): ['b', '']}
+
+    app['plan_row_sync'](plan, worksheet, upserts, [('a', '')], key_columns=2, key_rows=key_rows)
+
+    assert plan.value_updates == [
+        {'range': "'食譜'!A3", 'values': [['a', '鹽', 5]]},
+        {'range': "'食譜'!A4", 'values': [[1, '糖', 3]]},
+    ]
+    assert plan.appends == [(worksheet, [['b', '']])]
+    assert plan.structural_requests[0]['deleteDimension']['range']['startIndex'] == 1
+
+
+def test_overwrite_clears_rows_below_new_data(app):
+    plan = app['SheetsWritePlan']()
+    rows = [['h1', 'h2', 'h3'], [1, 2, 3], [4, 5, 6]]
+    plan.overwrite(fake_worksheet(), rows)
+    assert plan.value_updates == [{'range': "'記帳'!A1", 'values': rows}]
+    assert plan.clear_ranges == ["'記帳'!A4:C"]
+
+    wide = app['SheetsWritePlan']()
+    wide.overwrite(fake_worksheet(), [list(range(28))])
+    assert wide.clear_ranges == ["'記帳'!A2:AB"]
+
+
+# 食譜列
+
+def test_recipe_rows_round_trip(app):
+    recipes = {
+        "蛋糕": {
+            "materials": {
+                "麵粉": {"weight": 100.0, "price": 0.05, "yield_rate": None},
+                "奶油": {"weight": 50.0, "price": 0.3, "yield_rate": 0.8},
+            },
+            "created_at": "2024-01-01T00:00:00",
+            "updated_at": "2024-02-01T00:00:00",
+        },
+        "鹽水": {
+            "materials": {"鹽": {"weight": 3.0, "price": 0.01, "yield_rate": None}},
+            "created_at": "2024-03-01T00:00:00",
+        },
+    }
+    app['RecipeCostEngine'](recipes).apply()
+    rows = app['recipes_to_rows'](recipes)
+    values = [app['RECIPES_HEADERS']] + list(rows.values())
+
+    parsed = app['parse_recipes_rows'](app['values_to_records'](values))
+
+    assert parsed == recipes